@@ -0,0 +1,151 @@
+"""
+Several RR-duino busses driven from one process
+
+RR_duino_busses owns one serial_bus (with its RR_duino_transactions) per port and one worker thread
+per bus: the transactions of one bus stay sequential but the busses work in parallel, so fleet wide
+operations (scan, backup, states polling) take the time of the slowest bus instead of the sum of
+all of them.
+The operations are functions taking the transactions of a bus as first argument, run() calls one
+on all busses and merges the results by port.
+
+usage: python3 RR_duino_busses.py [-b baudrate] -p port [-p port ...] scan|poll|backup [file]
+"""
+import argparse,concurrent.futures,json,sys
+import serial_bus,RR_duino_transactions
+import RR_duino_messages as RRduino
+
+M = RRduino.RR_duino_message
+ADDRESSES = range(1,63)
+
+class RR_duino_busses:
+    def __init__(self,ports,baudrate=38400,policy=None):
+        self.transactions = {}  #port -> RR_duino_transactions
+        self.workers = {}       #port -> executor running the transactions of this port
+        for port in ports:
+            bus = serial_bus.serial_bus(port,baudrate)
+            self.transactions[port] = RR_duino_transactions.RR_duino_transactions(bus,policy)
+            self.workers[port] = concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix="bus "+port)
+
+    def start(self):
+        #open all ports, the ones that cannot be opened are removed and returned as {port:exception}
+        errors = {}
+        for port,transactions in list(self.transactions.items()):
+            try:
+                transactions.bus.start()
+            except Exception as e:
+                errors[port] = e
+                del self.transactions[port]
+                self.workers.pop(port).shutdown()
+        return errors
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.shutdown()
+        for transactions in self.transactions.values():
+            transactions.bus.stop()
+
+    def submit(self,port,func,*args,**kwargs):
+        #queue func(transactions of port,*args,**kwargs) on the worker of port, returns a future
+        return self.workers[port].submit(func,self.transactions[port],*args,**kwargs)
+
+    def run(self,func,*args,ports=None,**kwargs):
+        """
+        run func(transactions,*args,**kwargs) on all busses (or on ports) in parallel
+        returns (results,errors): dicts port->result and port->exception
+        """
+        if ports is None:
+            ports = list(self.transactions)
+        futures = {port:self.submit(port,func,*args,**kwargs) for port in ports}
+        results = {}
+        errors = {}
+        for port,future in futures.items():
+            try:
+                results[port] = future.result()
+            except Exception as e:
+                errors[port] = e
+        return results,errors
+
+#operations on one bus
+
+def query_func(transactions):
+    #query function for the multi-part answers of RR_duino_messages
+    return lambda msg: transactions.transact(msg).answer
+
+def scan(transactions,addresses=ADDRESSES):
+    #returns {address:version} of the nodes answering, absent nodes are not retried
+    no_retry = RR_duino_transactions.RR_duino_retry_policy(retries=0)
+    nodes = {}
+    for add in addresses:
+        result = transactions.transact(M.build_version_cmd(add),policy=no_retry)
+        if result.ok():
+            nodes[add] = result.answer.get_version()
+    return nodes
+
+def backup(transactions,addresses):
+    #returns {address:{"sensors":[configs],"turnouts":[configs]}} (configs as iterated by the show answers)
+    nodes = {}
+    query = query_func(transactions)
+    for add in addresses:
+        node = {}
+        for name,answers in (("sensors",RRduino.show_sensors_answers(query,add)),
+                             ("turnouts",RRduino.show_turnouts_answers(query,add))):
+            node[name] = list(answers)
+            if answers.error is not None:
+                node["error"] = answers.error
+                break
+        nodes[add] = node
+    return nodes
+
+def poll_states(transactions,addresses):
+    """
+    read all sensors and turnouts of each node
+    returns {address:{"sensors":mask,"turnouts":mask}}, bit i of a mask is the value of the i-th
+    device in subaddress order, None if the node did not answer
+    """
+    states = {}
+    for add in addresses:
+        node = {}
+        for name,for_sensor in (("sensors",True),("turnouts",False)):
+            cmd = M.build_rw_cmd_header(add,True,for_sensor,False,True)
+            result = transactions.transact(cmd)
+            node[name] = result.answer.get_all_values_mask() if result.ok() else None
+        states[add] = node
+    return states
+
+def main():
+    parser = argparse.ArgumentParser(description="scan, poll or backup several RR-duino busses in parallel")
+    parser.add_argument("-p","--port",action="append",required=True,help="serial port of a bus (repeat for each bus)")
+    parser.add_argument("-b","--baudrate",type=int,default=38400)
+    parser.add_argument("operation",choices=("scan","poll","backup"))
+    parser.add_argument("file",nargs="?",help="output file (JSON), default is stdout")
+    args = parser.parse_args()
+
+    busses = RR_duino_busses(args.port,args.baudrate)
+    for port,e in busses.start().items():
+        print("cannot open",port,":",e,file=sys.stderr)
+    try:
+        nodes,errors = busses.run(scan)
+        if args.operation == "scan":
+            output = nodes
+        else:
+            #each bus works on the nodes found on it
+            func = poll_states if args.operation == "poll" else backup
+            futures = {port:busses.submit(port,func,sorted(found)) for port,found in nodes.items()}
+            output = {}
+            for port,future in futures.items():
+                try:
+                    output[port] = future.result()
+                except Exception as e:
+                    errors[port] = e
+    finally:
+        busses.stop()
+    for port,e in errors.items():
+        print(port,":",e,file=sys.stderr)
+    if args.file:
+        with open(args.file,"w") as f:
+            json.dump(output,f,indent=1)
+    else:
+        print(json.dumps(output,indent=1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+Capture of the raw traffic of serial busses and of the JMRI server sockets, and replay of the captures
+
+A capture file is append-only: a magic string then records, each one being
+  varint time delta (us since the previous record of the session), kind byte, varint channel,
+  varint data length, data
+Kinds: TX (bytes sent by us), RX (bytes received), OPEN (data is the label of a new channel, like
+"serial:/dev/ttyUSB0", "jmri:192.168.1.2" or "bus:192.168.1.3"), CLOSE and SESSION (a new capture
+began, data is the wall clock time, the record times go on from the previous session).
+Writes are buffered: a record flushes the file when FLUSH_PERIOD seconds have elapsed since the last
+flush, and the owner loop calls flush_due() at least every FLUSH_PERIOD/2 seconds so that the records
+of an idle traffic do not stay in the buffer (they reach the file within 1.5*FLUSH_PERIOD).
+
+The replay tool feeds a capture back:
+  dump: print the records
+  decode: run the bytes of the serial channels through the frame decoder
+  server: play the bus controllers and JMRI sides of a capture of jmri_to_rr_duino_busses.py against
+          a running server and compare what it sends back with what had been captured
+at the recorded speed (or faster/slower with -s) or as fast as possible (-f). The results are printed as
+JSON so that replays of real layout sessions can be used as regression benchmarks.
+
+usage: python3 RR_duino_capture.py [-f] [-s speed] dump|decode file
+       python3 RR_duino_capture.py [-f] [-s speed] server file host jmri_port busses_port
+"""
+import argparse,json,select,socket,sys,time
+import RR_duino_messages as RRduino
+
+MAGIC = b"RRDCAP1\n"
+
+TX = 0
+RX = 1
+OPEN = 2
+CLOSE = 3
+SESSION = 4
+KIND_NAMES = ("TX","RX","OPEN","CLOSE","SESSION")
+
+def put_varint(buf,n):
+    while n >= 0x80:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def get_varint(buf,pos):
+    #returns (value,next position), raises IndexError if buf ends before the varint
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n,pos
+        shift += 7
+
+class capture_writer:
+    BUFFER_SIZE = 65536
+    FLUSH_PERIOD = 1.0
+
+    def __init__(self,filename):
+        self.file = open(filename,"ab",buffering=capture_writer.BUFFER_SIZE)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.begin = time.monotonic()
+        self.last = 0               #time of the last record (us since begin)
+        self.last_flush = self.begin
+        self.dirty = False          #True when records are waiting in the buffer
+        self.channels = 0
+        self.record(SESSION,0,repr(time.time()).encode())
+
+    def open_channel(self,label):
+        #returns the number of a new channel
+        self.channels += 1
+        self.record(OPEN,self.channels,label.encode())
+        return self.channels
+
+    def close_channel(self,channel):
+        self.record(CLOSE,channel,b"")
+
+    def record(self,kind,channel,data):
+        now = time.monotonic()
+        t = int((now-self.begin)*1000000)
+        header = bytearray()
+        put_varint(header,t-self.last)
+        header.append(kind)
+        put_varint(header,channel)
+        put_varint(header,len(data))
+        self.last = t
+        self.file.write(header)
+        self.file.write(data)
+        self.dirty = True
+        if now-self.last_flush >= capture_writer.FLUSH_PERIOD:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.dirty = False
+        self.last_flush = time.monotonic()
+
+    def flush_due(self):
+        #flush the records waiting since the last flush once FLUSH_PERIOD has elapsed, even if no record comes
+        if self.dirty and time.monotonic()-self.last_flush >= capture_writer.FLUSH_PERIOD:
+            self.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+def read_capture(filename,chunk_size=1 << 20):
+    """
+    iterate over the records of a capture: (time (s),kind,channel,data)
+    the channels numbers are made unique over the sessions of the file
+    """
+    with open(filename,"rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(filename+" is not a capture file")
+        buf = b""
+        pos = 0
+        t = 0
+        base = 0       #channels numbers offset of the current session
+        top = 0        #highest channel number so far
+        while True:
+            chunk = f.read(chunk_size)
+            buf = buf[pos:]+chunk
+            pos = 0
+            while True:
+                try:
+                    delta,p = get_varint(buf,pos)
+                    kind = buf[p]
+                    channel,p = get_varint(buf,p+1)
+                    length,p = get_varint(buf,p)
+                except IndexError:
+                    break
+                if p+length > len(buf):
+                    break
+                data = buf[p:p+length]
+                pos = p+length
+                t += delta/1000000
+                if kind == SESSION:
+                    base = top
+                elif channel:
+                    channel += base
+                    top = max(top,channel)
+                yield (t,kind,channel,data)
+            if not chunk:
+                if pos < len(buf):
+                    print("truncated record at the end of",filename,file=sys.stderr)
+                return
+
+def paced(records,speed):
+    #yield the records at their recorded time divided by speed, speed None means as fast as possible
+    begin = None
+    for record in records:
+        if speed is not None:
+            if begin is None:
+                begin = time.monotonic()-record[0]/speed
+            delay = begin+record[0]/speed-time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield record
+
+def dump(filename,speed):
+    labels = {}
+    for t,kind,channel,data in paced(read_capture(filename),speed):
+        if kind == OPEN:
+            labels[channel] = data.decode()
+        if kind in (TX,RX):
+            text = data.hex(" ") if labels.get(channel,"").startswith("serial:") else repr(data.decode(errors="replace"))
+        else:
+            text = data.decode(errors="replace")
+        print("%.6f %-7s %-24s %s" % (t,KIND_NAMES[kind],labels.get(channel,channel),text))
+
+def decode(filename,speed):
+    #decode the commands sent and the answers received on the serial channels
+    decoders = {}
+    stats = {}
+    records = 0
+    begin = time.perf_counter()
+    for t,kind,channel,data in paced(read_capture(filename),speed):
+        records += 1
+        if kind == OPEN and data.startswith(b"serial:"):
+            stats[channel] = {"port":data.decode()[len("serial:"):],"tx_bytes":0,"rx_bytes":0,"commands":0,"answers":0}
+            decoders[channel] = (RRduino.RR_duino_frame_decoder(),RRduino.RR_duino_frame_decoder())
+        elif kind in (TX,RX) and channel in decoders:
+            stats[channel][("tx_bytes","rx_bytes")[kind]] += len(data)
+            stats[channel][("commands","answers")[kind]] += len(decoders[channel][kind].feed(data))
+    elapsed = time.perf_counter()-begin
+    for channel,(cmd_decoder,answer_decoder) in decoders.items():
+        stats[channel]["discarded"] = cmd_decoder.discarded+answer_decoder.discarded
+    frames = sum(s["commands"]+s["answers"] for s in stats.values())
+    return {"records":records,"elapsed":elapsed,"frames":frames,
+            "frames_per_s":frames/elapsed if elapsed > 0 else None,
+            "channels":list(stats.values())}
+
+def server(filename,speed,host,jmri_port,busses_port,settle=0.5):
+    """
+    play the peers of the server: what the server received from a peer is sent again to it on a new
+    connection, what it sends back is counted and compared to what it had sent during the capture
+    """
+    peers = {}  #channel -> {"label","sock","sent","expected","received"}
+    socks = {}  #socket -> peer
+    def read_answers(timeout):
+        if not socks:
+            time.sleep(timeout)
+            return
+        readable,_,_ = select.select(list(socks),[],[],timeout)
+        for sock in readable:
+            data = sock.recv(65536)
+            socks[sock]["received"] += len(data)
+            if not data:
+                del socks[sock]
+    begin = time.perf_counter()
+    for t,kind,channel,data in paced(read_capture(filename),speed):
+        if kind == OPEN and (data.startswith(b"jmri:") or data.startswith(b"bus:")):
+            port = jmri_port if data.startswith(b"jmri:") else busses_port
+            sock = socket.create_connection((host,port))
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            peers[channel] = {"label":data.decode(),"sent":0,"expected":0,"received":0}
+            socks[sock] = peers[channel]
+            peers[channel]["sock"] = sock
+        elif channel in peers:
+            peer = peers[channel]
+            if kind == RX:
+                peer["sock"].sendall(data)
+                peer["sent"] += len(data)
+            elif kind == TX:
+                peer["expected"] += len(data)
+            elif kind == CLOSE:
+                peer["sock"].shutdown(socket.SHUT_WR)
+        read_answers(0)
+    #let the server finish
+    deadline = time.monotonic()+settle
+    while time.monotonic() < deadline:
+        read_answers(deadline-time.monotonic())
+    elapsed = time.perf_counter()-begin
+    for peer in peers.values():
+        peer.pop("sock").close()
+    return {"elapsed":elapsed,"peers":list(peers.values()),
+            "mismatches":sum(1 for peer in peers.values() if peer["received"] != peer["expected"])}
+
+def main():
+    parser = argparse.ArgumentParser(description="replay RR-duino captures")
+    parser.add_argument("-f","--fast",action="store_true",help="as fast as possible instead of the recorded speed")
+    parser.add_argument("-s","--speed",type=float,default=1.0,help="speed factor (2 is twice as fast as recorded)")
+    parser.add_argument("mode",choices=("dump","decode","server"))
+    parser.add_argument("file")
+    parser.add_argument("server",nargs="*",help="host jmri_port busses_port (server mode)")
+    args = parser.parse_args()
+    speed = None if args.fast else args.speed
+
+    if args.mode == "dump":
+        dump(args.file,speed)
+        return
+    if args.mode == "decode":
+        result = decode(args.file,speed)
+    else:
+        if len(args.server) != 3:
+            parser.error("server mode needs host jmri_port busses_port")
+        result = server(args.file,speed,args.server[0],int(args.server[1]),int(args.server[2]))
+    print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,10 @@
 #from openlcb_protocol import *
 #from openlcb_debug import *
 #import openlcb_config,openlcb_nodes,collections
+try:
+    import numpy
+except ImportError:
+    numpy = None  #only needed by all_values_batch
 
 class RR_duino_message:
     START=0xFF
@@ -45,6 +49,26 @@ class RR_duino_message:
     INPUT_SENSOR_PULLUP = 1
     OUTPUT_SENSOR=2
 
+    #size of the command buffer of the device (start byte excluded)
+    MAX_CMD_LEN = 63
+    #max number of subaddresses in a r/w list command: command, address and end byte must fit too
+    MAX_LIST_LEN = MAX_CMD_LEN-3
+
+    #header flags, as found in the CMD_FLAGS and ADD_FLAGS tables (see after the class)
+    F_ANSWER = 1
+    F_LAST_ANSWER = 2
+    F_ASYNC_PENDING = 4
+    F_CONFIG = 8
+    F_SPECIAL_CONFIG = 16
+    F_READ = 32
+    F_WRITE = 64
+    F_ON_TURNOUT = 128
+    F_ALL_BIT = 256
+    F_LIST = 512
+    F_TABLE = 1024
+    F_ALL = F_LIST | F_ALL_BIT
+
+    __slots__ = ("raw_message",)
     
     def __init__(self,raw_message=None):  # raw_message must be a bytearray
         self.raw_message = raw_message
@@ -62,15 +86,50 @@ class RR_duino_message:
         return self.raw_message[1]
     
     def get_version(self):
-        return self.raw_message[2]
+        #version answer: start,command,address,version
+        return self.raw_message[3]
 
     def is_valid(self):
         #crude test about correctness: only check the start byte for now
         return self.raw_message[0]==RR_duino_message.START
     
+    @staticmethod
+    def command_flags(command):
+        #decode the command byte into F_xxx flags (used to build the CMD_FLAGS table)
+        flags = 0
+        if command & (1 << RR_duino_message.CMD_ANSW_BIT) == 0:
+            flags |= RR_duino_message.F_ANSWER
+        if command & (1 << RR_duino_message.CMD_LAST_ANSW_BIT) == 0:
+            flags |= RR_duino_message.F_LAST_ANSWER
+        if command & (1 << RR_duino_message.CMD_ASYNC_BIT) != 0:
+            flags |= RR_duino_message.F_ASYNC_PENDING
+        if command & (1 << RR_duino_message.CMD_CONFIG_BIT) != 0:
+            flags |= RR_duino_message.F_CONFIG
+            if command & (1 << RR_duino_message.CMD_SPECIAL_CONFIG_BIT) != 0:
+                flags |= RR_duino_message.F_SPECIAL_CONFIG
+        elif command & (1 << RR_duino_message.CMD_RW_BIT) != 0:
+            flags |= RR_duino_message.F_WRITE
+        else:
+            flags |= RR_duino_message.F_READ
+        if command & (1 << RR_duino_message.CMD_SENSOR_TURNOUT_BIT) != 0:
+            flags |= RR_duino_message.F_ON_TURNOUT
+        if command & (1 << RR_duino_message.CMD_ALL_BIT) != 0:
+            flags |= RR_duino_message.F_ALL_BIT
+        return flags
+
+    @staticmethod
+    def address_flags(address):
+        #decode the address byte into F_xxx flags (used to build the ADD_FLAGS table)
+        flags = 0
+        if address & (1 << RR_duino_message.ADD_LIST_BIT) != 0:
+            flags |= RR_duino_message.F_LIST
+        if address & (1 << RR_duino_message.ADD_TABLE_BIT) != 0:
+            flags |= RR_duino_message.F_TABLE
+        return flags
+
     def is_answer(self):
         #return True if this message is an answer from the device
-        return (self.raw_message[1] & (1 << RR_duino_message.CMD_ANSW_BIT))==0
+        return RR_duino_message.CMD_FLAGS[self.raw_message[1]] & RR_duino_message.F_ANSWER != 0
 
     def is_answer_to_cmd(self,cmd):
         #return True if this message is an answer to the command "cmd"
@@ -85,22 +144,26 @@ class RR_duino_message:
             return False
         return True
 
+    def is_answer_to_msg(self,msg):
+        #return True if this message is an answer to the command msg (a RR_duino_message): same command, same address
+        return self.is_answer_to_cmd(msg.get_command()) and self.get_address()==msg.get_address()
+
     def is_answer_to_version_cmd(self):
         return self.is_answer_to_cmd(0b10001001)  #version command value
     
     def is_last_answer(self):
         #return True if this message is the last answer (used mainly by show commands/async events reporting)
-        return (self.raw_message[1] & (1 << RR_duino_message.CMD_LAST_ANSW_BIT))==0
+        return RR_duino_message.CMD_FLAGS[self.raw_message[1]] & RR_duino_message.F_LAST_ANSWER != 0
 
     def is_read_cmd(self):
-        return not self.is_config_cmd() and (self.raw_message[1] & (1 << RR_duino_message.CMD_RW_BIT))==0
+        return RR_duino_message.CMD_FLAGS[self.raw_message[1]] & RR_duino_message.F_READ != 0
 
     def is_write_cmd(self):
-        return not self.is_config_cmd() and (self.raw_message[1] & (1 << RR_duino_message.CMD_RW_BIT))!=0
+        return RR_duino_message.CMD_FLAGS[self.raw_message[1]] & RR_duino_message.F_WRITE != 0
 
     def is_config_cmd(self):
         #returns True if this is a config command (might be a special config command)
-        return (self.raw_message[1] & (1 << RR_duino_message.CMD_CONFIG_BIT))!=0
+        return RR_duino_message.CMD_FLAGS[self.raw_message[1]] & RR_duino_message.F_CONFIG != 0
 
     def get_special_config(self):
         #returns the special config code (cf top of the class)
@@ -108,28 +171,29 @@ class RR_duino_message:
         return (self.raw_message[1] >> RR_duino_message.CMD_SPECIAL_CONFIG_CODE_POS ) & RR_duino_message.CMD_SPECIAL_CONFIG_CODE_MASK
 
     def is_show_table(self):
-        return self.raw_message[2] & (1 << RR_duino_message.ADD_TABLE_BIT)
+        return RR_duino_message.ADD_FLAGS[self.raw_message[2]] & RR_duino_message.F_TABLE != 0
     
     def is_special_config_cmd(self):
         #returns True if this is a special config command
-        return self.is_config_cmd() and (self.raw_message[1] & (1 << RR_duino_message.CMD_SPECIAL_CONFIG_BIT))!=0
+        return RR_duino_message.CMD_FLAGS[self.raw_message[1]] & RR_duino_message.F_SPECIAL_CONFIG != 0
 
     def on_turnout(self):
-        #returns True if this command is about sensors
-        return (self.raw_message[1] & (1 << RR_duino_message.CMD_SENSOR_TURNOUT_BIT))!=0
+        #returns True if this command is about turnouts
+        return RR_duino_message.CMD_FLAGS[self.raw_message[1]] & RR_duino_message.F_ON_TURNOUT != 0
     
     def async_events_pending(self):
         #return True if this message indicates that there are async events waiting to be sent
         #by the device
-        return (self.raw_message[1] & (1 << RR_duino_message.CMD_ASYNC_BIT))!=0
+        return RR_duino_message.CMD_FLAGS[self.raw_message[1]] & RR_duino_message.F_ASYNC_PENDING != 0
     
     def is_list(self):
         #return True if message is a list (of sensors/turnouts)...
-        return (self.raw_message[2] & (1 << RR_duino_message.ADD_LIST_BIT))!=0
+        return RR_duino_message.ADD_FLAGS[self.raw_message[2]] & RR_duino_message.F_LIST != 0
 
     def is_all(self):
         #return True if it is about ALL sensors/turnouts (only for read or write commands/answer)
-        return self.is_list() and (self.raw_message[1] & (1 << RR_duino_message.CMD_ALL_BIT))!=0
+        flags = RR_duino_message.CMD_FLAGS[self.raw_message[1]] | RR_duino_message.ADD_FLAGS[self.raw_message[2]]
+        return flags & RR_duino_message.F_ALL == RR_duino_message.F_ALL
 
     def get_error_code(self):
         if (self.raw_message[-1] & 0x80) == 0:
@@ -151,26 +215,60 @@ class RR_duino_message:
         #debug("list of values",l)
         return l
 
+    def get_list_results(self,cmd):
+        """
+        decode the answer to the r/w list command cmd (a RR_duino_message)
+        returns a pair (results,error)
+        results is a dict subaddress <-> value (value read or value written)
+        error is None or a pair (subaddress,error code) for the subaddress the device stopped on,
+        the subaddresses after this one have not been processed
+        """
+        cmd_list = cmd.raw_message[3:-1]
+        if self.raw_message[-1] & 0x80 != 0:
+            processed = self.raw_message[3:-1]
+        else:
+            processed = self.raw_message[3:]
+        err = self.get_error_code()
+        if not err and not processed and cmd.is_write_cmd():
+            #the device only sends a simple answer when all writes are ok
+            processed = cmd_list
+        results = {}
+        for c in processed:
+            results[c & 0x3F] = (c >> RR_duino_message.SUBADD_VALUE_BIT) & 0x01
+        error = None
+        if err:
+            if len(processed) < len(cmd_list):
+                error = (cmd_list[len(processed)] & 0x3F,err)
+            else:
+                error = (None,err)
+        return (results,error)
+
+    def get_bits_payload(self):
+        #return the payload of a bit packed answer ("read all" or show table), without the end byte
+        if self.raw_message[-1] & 0x80 != 0:
+            return self.raw_message[3:-1]
+        return self.raw_message[3:]
+
+    def get_all_values_mask(self,nb_values=None):
+        #return the values as an int: bit n is the value of the nth sensor/turnout (by ascending subaddress)
+        #only valid for a "read all" sensors or turnouts
+        mask = bits_to_mask(self.get_bits_payload())
+        if nb_values is not None:
+            mask &= (1 << nb_values)-1
+        return mask
+
     def get_all_values(self,nb_values):
         #return a list of values (0/1)
         #only valid for a "read all" sensors or turnouts
-        l = []
-        byte_index = 3
-        b = self.raw_message[byte_index]
-        bit_pos = 0
-        for i in range(nb_values):
-            if bit_pos == 8:
-                bit_pos = 0
-                byte_index+=1
-                b = self.raw_message[byte_index] 
-                 #sanity check
-                if self.raw_message[byte_index] & 0x80 != 0:
-                    #stop: this byte is the error code, not all values are present
-                    return l
-            l.append((b >> bit_pos) & 0x01) #shift left and keep LSB only
-            bit_pos+=1
-        #debug("list of all values",l)
-        return l
+        #values are packed 7 per byte, the list is shorter if the answer ends early (error code)
+        payload = self.get_bits_payload()
+        mask = bits_to_mask(payload)
+        return [(mask >> i) & 0x01 for i in range(min(nb_values,7*len(payload)))]
+
+    def get_table_mask(self):
+        #return the show table as an int: bit n set means that subaddress n+1 is used
+        #for sensors, bits 0-62 are the input sensors and bits 63-125 the output sensors
+        return bits_to_mask(self.get_bits_payload())
         
     def get_sensor_config(self,index):
         #return a tuple (subaddress,pin,type)
@@ -185,14 +283,18 @@ class RR_duino_message:
                 sensor_type = RR_duino_message.INPUT_SENSOR
         return (self.raw_message[index] & 0x3F, self.raw_message[index+1] & 0x7F, sensor_type)
     
+    def iter_sensors_config(self):
+        #generator of the tuples (subaddress,pin,type) of a config sensor list command or a show sensor command answer
+        index = 3 #beginning of list
+        while index<len(self.raw_message)-1:  #end of list
+            yield self.get_sensor_config(index)
+            index+=2  #next sensor config
+
     def get_list_of_sensors_config(self):
         #return a dict subaddress<-> tuples (pin,type)
         l = {}
-        index = 3 #beginning of list
-        while index<len(self.raw_message)-1:  #end of list
-            subadd,pin,type = self.get_sensor_config(index)
+        for subadd,pin,type in self.iter_sensors_config():
             l[subadd]=(pin,type)
-            index+=2  #next sensor config
         return l
         
     def get_turnout_config(self,index):
@@ -212,20 +314,32 @@ class RR_duino_message:
             return (subadd,self.raw_message[index+1],
                     self.raw_message[index+2],self.raw_message[index+3])
         
-    def get_list_of_turnouts_config(self):
-        #return a dict subadd <-> tuples (pin,type)
+    def iter_turnouts_config(self):
+        #generator of the turnouts config tuples (see get_turnout_config)
         #only valid for a config turnout list command or a show turnout command answer
-        l = {}
         index = 3 #beginning of list
         while index<len(self.raw_message)-1:  #end of list
             turnout_cfg = self.get_turnout_config(index)
-            l[turnout_cgf[0]]=turnout_cfg[1:]
+            yield turnout_cfg
             if len(turnout_cfg)==4:#next turnout config index depends on relay pins present or not
                 index+=4  
             else:
                 index+=6
+
+    def get_list_of_turnouts_config(self):
+        #return a dict subadd <-> tuples (pin,type)
+        #only valid for a config turnout list command or a show turnout command answer
+        l = {}
+        for turnout_cfg in self.iter_turnouts_config():
+            l[turnout_cfg[0]]=turnout_cfg[1:]
         return l
 
+    def iter_async_events(self):
+        #generator of (subaddress,value,on_turnout) for an answer to an async command
+        on_turnout = self.on_turnout()
+        for c in self.raw_message[3:-1]: #forget last byte (the list stop byte)
+            yield (c & 0x3F,(c >> RR_duino_message.SUBADD_VALUE_BIT) & 0x01,on_turnout)
+
     def to_wire_message(self):
         if self.raw_message == None:
             return ""
@@ -302,10 +416,10 @@ class RR_duino_message:
         if len(config)>4:
             relay_pins = [config[4]]
             if config[6]:
-                relay_pins[0] |= 1 << RR_duino_message.PIN_PULSE_PIN_BIT
-            relay_pin.append(config[5])
+                relay_pins[0] |= 1 << RR_duino_message.PIN_PULSE_BIT
+            relay_pins.append(config[5])
             if config[7]:
-                relay_pins[1] |= 1 << RR_duino_message.PIN_PULSE_PIN_BIT
+                relay_pins[1] |= 1 << RR_duino_message.PIN_PULSE_BIT
             res.extend((relay_pins))
         return res
 
@@ -339,6 +453,32 @@ class RR_duino_message:
         msg = RR_duino_message.build_rw_cmd_header(add,read,for_sensor,False)
         msg.raw_message.extend(RR_duino_message.encode_subadd_value((subadd,value)))
         return msg
+
+    @staticmethod
+    def build_list_rw_cmds(add,values,read=False,for_sensor=True):
+        """
+        build the r/w list commands for all the subaddresses of one node
+        values is a dict subaddress <-> value (for reads values are ignored, any iterable of
+        subaddresses is ok too)
+        returns a list of RR_duino_message, one list command unless there are more subaddresses
+        than the device can take in one command (MAX_LIST_LEN)
+        """
+        if isinstance(values,dict):
+            pairs = sorted(values.items())
+        else:
+            pairs = [(subadd,None) for subadd in sorted(values)]
+        msgs = []
+        for index in range(0,len(pairs),RR_duino_message.MAX_LIST_LEN):
+            msg = RR_duino_message.build_rw_cmd_header(add,read,for_sensor,True)
+            for subadd,value in pairs[index:index+RR_duino_message.MAX_LIST_LEN]:
+                if subadd <= 0 or subadd > 0x3F:
+                    raise ValueError("invalid subaddress "+str(subadd))
+                if read:
+                    value = None
+                msg.raw_message.extend(RR_duino_message.encode_subadd_value((subadd,value)))
+            msg.raw_message.append(1 << RR_duino_message.SUBADD_LAST_IN_LIST_BIT)
+            msgs.append(msg)
+        return msgs
     
     @staticmethod
     def is_complete_message(msg):
@@ -406,7 +546,7 @@ class RR_duino_message:
                 return len(msg)>=5 and (msg[-1] & 0x80 != 0)
         #it is a command of length >=4
         #sensors and turnouts config
-        if message.is_config_cmd() and special_config is None and message.raw_message[1] & (1 << CMD_CONFIG_DEL_BIT)==0:
+        if message.is_config_cmd() and special_config is None and message.raw_message[1] & (1 << RR_duino_message.CMD_CONFIG_DEL_BIT)==0:
             if message.on_turnout():
                 if message.is_list():
                     return turnouts_config_list_complete(message)
@@ -421,12 +561,268 @@ class RR_duino_message:
         if message.is_list():  #list commands must finish by 0x8x (all special cases have been dealt with before
             return message.raw_message[-1] & 0x80!=0
 
-        if special_config== CMD_TURNOUT_FINE_TUNE:
+        if special_config== RR_duino_message.CMD_TURNOUT_FINE_TUNE:
             return len(message.raw_message)==5
         #here only simple commands remain: r/w on one device, delete config of one device
         #so it must be complete (they are all 4 bytes commands)
         return True
 
+#header classification tables, indexed by the command byte (resp. the address byte)
+RR_duino_message.CMD_FLAGS = tuple(RR_duino_message.command_flags(c) for c in range(256))
+RR_duino_message.ADD_FLAGS = tuple(RR_duino_message.address_flags(a) for a in range(256))
+
+class RR_duino_frame(RR_duino_message):
+    """
+    Same API as RR_duino_message but the header flags are decoded once, when the frame is built
+    Meant for received messages: the header must only be changed through set_header
+    """
+    __slots__ = ("flags",)
+
+    def __init__(self,raw_message):  # raw_message must be a bytearray with at least start,command,address
+        self.raw_message = raw_message
+        self.flags = RR_duino_message.CMD_FLAGS[raw_message[1]] | RR_duino_message.ADD_FLAGS[raw_message[2]]
+
+    def set_header(self,command,address):
+        RR_duino_message.set_header(self,command,address)
+        self.flags = RR_duino_message.CMD_FLAGS[command] | RR_duino_message.ADD_FLAGS[address]
+
+    def is_answer(self):
+        return self.flags & RR_duino_message.F_ANSWER != 0
+
+    def is_last_answer(self):
+        return self.flags & RR_duino_message.F_LAST_ANSWER != 0
+
+    def is_read_cmd(self):
+        return self.flags & RR_duino_message.F_READ != 0
+
+    def is_write_cmd(self):
+        return self.flags & RR_duino_message.F_WRITE != 0
+
+    def is_config_cmd(self):
+        return self.flags & RR_duino_message.F_CONFIG != 0
+
+    def is_show_table(self):
+        return self.flags & RR_duino_message.F_TABLE != 0
+
+    def is_special_config_cmd(self):
+        return self.flags & RR_duino_message.F_SPECIAL_CONFIG != 0
+
+    def on_turnout(self):
+        return self.flags & RR_duino_message.F_ON_TURNOUT != 0
+
+    def async_events_pending(self):
+        return self.flags & RR_duino_message.F_ASYNC_PENDING != 0
+
+    def is_list(self):
+        return self.flags & RR_duino_message.F_LIST != 0
+
+    def is_all(self):
+        return self.flags & RR_duino_message.F_ALL == RR_duino_message.F_ALL
+
+class RR_duino_frame_decoder:
+    """
+    Incremental decoder of the bytes stream coming from the bus
+    Feed it with chunks of any size, it returns the complete messages found so far
+    Each byte is looked at only once: the way to know when a frame is complete is deduced
+    from the command and address bytes as soon as they have been received
+    """
+    #frame kinds (tell how the end of the frame is detected)
+    FIXED = 0         #frame has a fixed length
+    TERMINATED = 1    #frame ends on the first byte with MSB set (end of list or error code)
+    SENSORS_CFG = 2   #list of 2 bytes sensors configs ended by a byte with MSB set
+    TURNOUTS_CFG = 3  #list of 4/6 bytes turnouts configs ended by a byte with MSB set
+    TURNOUT_CFG = 4   #one turnout config, 4 or 6 bytes depending on the relay pins bit
+    VERSION = 5       #version answer: terminated, but the end byte of a version above 127 is left over
+
+    #start byte + size of the command buffer of the device
+    MAX_FRAME_LEN = RR_duino_message.MAX_CMD_LEN+1
+
+    def __init__(self):
+        self.discarded = 0  #number of garbage bytes skipped so far
+        self.reset()
+        self.version_end = False  #True when a 0x80 left over by a version answer can come next
+
+    def reset(self):
+        #forget the frame being decoded
+        self.frame = None   #bytearray of the current frame, None when waiting for a start byte
+        self.kind = None
+        self.expected = 0   #fixed length, minimal length or position of the next config
+
+    @staticmethod
+    def frame_kind(command,address):
+        """
+        return a pair (kind,length) describing how the frame beginning by command,address ends
+        length is the full length for FIXED frames, the minimal length for TERMINATED frames
+        and the position of the first config for configs lists
+        Only the list and table bits of the address matter (see the FRAME_KINDS table)
+        """
+        M = RR_duino_message
+        if command & (1 << M.CMD_ANSW_BIT) == 0:
+            #answers
+            if command & (1 << M.CMD_CONFIG_BIT) == 0:
+                #read/write answer: lists (async events, read all) or one subaddress
+                if address & (1 << M.ADD_LIST_BIT):
+                    return (RR_duino_frame_decoder.TERMINATED,4)
+                return (RR_duino_frame_decoder.FIXED,4)
+            if command & (1 << M.CMD_SPECIAL_CONFIG_BIT):
+                special = (command >> M.CMD_SPECIAL_CONFIG_CODE_POS) & M.CMD_SPECIAL_CONFIG_CODE_MASK
+                if special == M.CMD_VERSION:
+                    #an error answer is only 4 bytes long: like answer_from_bus_step in the bus controller, the
+                    #first byte with its MSB set ends the frame, so a version above 127 gives a 4 bytes frame and
+                    #the 0x80 that follows it is skipped (see feed)
+                    return (RR_duino_frame_decoder.VERSION,4)
+                if special in (M.CMD_SHOW_SENSORS,M.CMD_SHOW_TURNOUTS) and address & (1 << M.ADD_TABLE_BIT) == 0:
+                    #pins and positions can have their MSB set, walk the configs
+                    if special == M.CMD_SHOW_SENSORS:
+                        return (RR_duino_frame_decoder.SENSORS_CFG,3)
+                    return (RR_duino_frame_decoder.TURNOUTS_CFG,3)
+            return (RR_duino_frame_decoder.TERMINATED,4)
+        #commands
+        if command & (1 << M.CMD_ASYNC_BIT):
+            return (RR_duino_frame_decoder.FIXED,3)
+        is_list = address & (1 << M.ADD_LIST_BIT) != 0
+        if command & (1 << M.CMD_CONFIG_BIT):
+            if command & (1 << M.CMD_SPECIAL_CONFIG_BIT):
+                special = (command >> M.CMD_SPECIAL_CONFIG_CODE_POS) & M.CMD_SPECIAL_CONFIG_CODE_MASK
+                if special == M.CMD_TURNOUT_FINE_TUNE:
+                    return (RR_duino_frame_decoder.FIXED,5)
+                return (RR_duino_frame_decoder.FIXED,3)
+            if command & (1 << M.CMD_CONFIG_DEL_BIT):
+                if is_list:
+                    return (RR_duino_frame_decoder.TERMINATED,4)
+                return (RR_duino_frame_decoder.FIXED,4)
+            if command & (1 << M.CMD_SENSOR_TURNOUT_BIT):
+                if is_list:
+                    return (RR_duino_frame_decoder.TURNOUTS_CFG,3)
+                return (RR_duino_frame_decoder.TURNOUT_CFG,7)
+            if is_list:
+                return (RR_duino_frame_decoder.SENSORS_CFG,3)
+            return (RR_duino_frame_decoder.FIXED,5)
+        #read/write commands
+        if command & (1 << M.CMD_ALL_BIT):
+            if command & (1 << M.CMD_RW_BIT) == 0:
+                #read all
+                return (RR_duino_frame_decoder.FIXED,3)
+            return (RR_duino_frame_decoder.TERMINATED,4)
+        if is_list:
+            return (RR_duino_frame_decoder.TERMINATED,4)
+        return (RR_duino_frame_decoder.FIXED,4)
+
+    def feed(self,data):
+        #data is a bytes like object, returns the list of completed messages (as RR_duino_frame)
+        msgs = []
+        frame = self.frame
+        for b in data:
+            if self.version_end:
+                self.version_end = False
+                if b == 0x80 and frame is None:
+                    #end of a version answer that was complete with its version byte
+                    continue
+            if b == RR_duino_message.START:
+                #the device restarts on each start byte, do the same
+                if frame is not None:
+                    self.discarded += len(frame)
+                frame = bytearray((b,))
+                continue
+            if frame is None:
+                #garbage, wait for the next start byte
+                self.discarded += 1
+                continue
+            frame.append(b)
+            length = len(frame)
+            if length < 3:
+                continue
+            if length == 3:
+                self.kind,self.expected = RR_duino_frame_decoder.FRAME_KINDS[(frame[1] << 2) | (b >> 6)]
+                complete = self.kind == RR_duino_frame_decoder.FIXED and self.expected == 3
+            elif self.kind == RR_duino_frame_decoder.FIXED:
+                complete = length == self.expected
+            elif self.kind == RR_duino_frame_decoder.TERMINATED:
+                complete = length >= self.expected and b & 0x80 != 0
+            elif self.kind == RR_duino_frame_decoder.VERSION:
+                complete = b & 0x80 != 0
+                self.version_end = complete and length == 4
+            elif self.kind == RR_duino_frame_decoder.TURNOUT_CFG:
+                #first byte of the config tells if relay pins are present
+                self.kind = RR_duino_frame_decoder.FIXED
+                if b & (1 << RR_duino_message.SUBADD_TURNOUT_RELAY_PINS_BIT):
+                    self.expected = 9
+                complete = False
+            else:
+                #configs list: only check at the beginning of a config
+                complete = False
+                if length-1 == self.expected:
+                    if b & 0x80 != 0:
+                        complete = True
+                    elif self.kind == RR_duino_frame_decoder.SENSORS_CFG:
+                        self.expected += 2
+                    elif b & (1 << RR_duino_message.SUBADD_TURNOUT_RELAY_PINS_BIT):
+                        self.expected += 6
+                    else:
+                        self.expected += 4
+            if complete:
+                msgs.append(RR_duino_frame(frame))
+                frame = None
+            elif length >= RR_duino_frame_decoder.MAX_FRAME_LEN:
+                #too long for the device buffer, resync on next start byte
+                self.discarded += length
+                frame = None
+        self.frame = frame
+        return msgs
+
+#frame kinds table, indexed by (command << 2) | (address >> 6)
+RR_duino_frame_decoder.FRAME_KINDS = tuple(RR_duino_frame_decoder.frame_kind(i >> 2,(i & 3) << 6) for i in range(1024))
+
+class RR_duino_answers:
+    """
+    Iterate over the content of a multi-part answer (show and async commands)
+    The command is sent again for each part, the iteration stops after the last part or on an error
+    Only one part is kept in memory so the first items can be processed while the device still has others to send
+    query(msg) must send msg to the device and return the answer (RR_duino_message) or None on timeout
+    After the iteration, error is None if all went fine, the error code of the device or TIMEOUT
+    """
+    TIMEOUT = -1
+
+    def __init__(self,query,build_cmd,decode,more):
+        self.query = query
+        self.build_cmd = build_cmd  #returns the command to send for the next part
+        self.decode = decode        #generator of the items of one part
+        self.more = more            #returns True if another part must be asked for
+        self.error = None
+
+    def __iter__(self):
+        self.error = None
+        while True:
+            answer = self.query(self.build_cmd())
+            if answer is None:
+                self.error = RR_duino_answers.TIMEOUT
+                return
+            err = answer.get_error_code()
+            if err:
+                self.error = err
+                return
+            yield from self.decode(answer)
+            if not self.more(answer):
+                return
+
+def show_sensors_answers(query,add):
+    #iterates over (subaddress,pin,type) for all sensors of the node
+    return RR_duino_answers(query,lambda: RR_duino_message.build_show_cmd(add),
+                            RR_duino_message.iter_sensors_config,
+                            lambda answer: not answer.is_last_answer())
+
+def show_turnouts_answers(query,add):
+    #iterates over the turnouts config tuples (see get_turnout_config) for all turnouts of the node
+    return RR_duino_answers(query,lambda: RR_duino_message.build_show_cmd(add,True),
+                            RR_duino_message.iter_turnouts_config,
+                            lambda answer: not answer.is_last_answer())
+
+def async_events_answers(query,add):
+    #iterates over (subaddress,value,on_turnout) until all async events of the node have been drained
+    return RR_duino_answers(query,lambda: RR_duino_message.build_async_cmd(add),
+                            RR_duino_message.iter_async_events,
+                            lambda answer: not answer.is_last_answer() or answer.async_events_pending())
+
 class RR_duino_node_desc:
     #default dict to add new nodes to the DB when they have no description
     DEFAULT_JSON = { "fullID":None }
@@ -443,6 +839,64 @@ class RR_duino_node_desc:
         return self.desc_dict
 
 
+def bits_to_mask(bits):
+    """
+    transform a bits array (7 bits per byte, MSB not used) into an int
+    bit n of the result is bit n%7 of byte n//7
+    this is the format of the "read all" answers, the show tables and the NEW-NODE messages
+    """
+    mask = 0
+    shift = 0
+    for b in bits:
+        mask |= (b & 0x7F) << shift
+        shift += 7
+    return mask
+
+def mask_positions(mask):
+    #return the list of the positions of the bits set in mask
+    positions = []
+    while mask:
+        low = mask & -mask
+        positions.append(low.bit_length()-1)
+        mask ^= low
+    return positions
+
+def changed_values(old_mask,new_mask,subaddresses=None):
+    """
+    generator of (subaddress,new value) for each bit that differs between two masks
+    bit n corresponds to subaddresses[n] (the subaddresses in the order of the bits, as
+    for "read all" answers) or to subaddress n+1 if subaddresses is None (tables layout)
+    """
+    diff = old_mask ^ new_mask
+    while diff:
+        low = diff & -diff
+        diff ^= low
+        pos = low.bit_length()-1
+        if subaddresses is None:
+            subadd = pos+1
+        elif pos < len(subaddresses):
+            subadd = subaddresses[pos]
+        else:
+            return
+        yield (subadd,1 if new_mask & low else 0)
+
+def all_values_batch(msgs,nb_values):
+    """
+    decode several "read all" answers (one per node for example) at once, needs numpy
+    returns a numpy array of 0/1 values with one row per message and nb_values columns
+    values missing from an answer (shorter or ended by an error code) are 0
+    """
+    if numpy is None:
+        raise ImportError("numpy is needed to decode a batch of answers")
+    nb_bytes = (nb_values+6)//7
+    buf = numpy.zeros((len(msgs),nb_bytes),dtype=numpy.uint8)
+    for row,msg in enumerate(msgs):
+        payload = msg.get_bits_payload()[:nb_bytes]
+        buf[row,:len(payload)] = numpy.frombuffer(bytes(payload),dtype=numpy.uint8)
+    #unpack LSB first and drop the MSB of each byte
+    bits = numpy.unpackbits(buf,axis=1,bitorder="little").reshape(len(msgs),nb_bytes,8)[:,:,:7]
+    return bits.reshape(len(msgs),nb_bytes*7)[:,:nb_values]
+
 def hex_int(i):   #same as hex but withouth the leading "0x"
     return hex(i)[2:]
 
@@ -0,0 +1,206 @@
+"""
+Micro benchmarks of the RR_duino_messages codec, no hardware needed
+
+The frames are built the same way the RR-duino firmware builds them (same lengths, same
+splitting of the show answers) so the numbers are representative of a real bus.
+Each benchmark prints one JSON object per line:
+{"name":..., "frames":..., "ops_per_s":..., "frames_per_s":..., "blocks_per_frame":..., "peak_bytes_per_frame":...}
+blocks_per_frame is the number of memory blocks allocated while decoding one frame, temporary ones
+included: the count of allocated blocks is sampled at each line of python executed and its increases
+are summed (a block allocated and freed inside a single line of C code is not seen, so this is a lower
+bound). peak_bytes_per_frame is the peak of memory used while decoding one frame
+For encode_turnout_config the "frames" are the configs encoded
+
+usage: python3 RR_duino_messages_bench.py [-t min_time] [-o output_file] [filter]
+"""
+import argparse,json,sys,time,tracemalloc
+import RR_duino_messages as RRduino
+
+M = RRduino.RR_duino_message
+ADDRESS = 5
+
+def split_show_answer(command,entries,margin):
+    #split configs entries as the firmware does (show_sensors_cmd/show_turnouts_cmd)
+    #margin is the room needed to add the next config (3 for sensors, 7 for turnouts)
+    frames = []
+    payload = bytearray()
+    for i,entry in enumerate(entries):
+        payload.extend(entry)
+        if 2+len(payload)+margin > M.MAX_CMD_LEN or i == len(entries)-1:
+            frames.append(bytearray((M.START,command,ADDRESS | (1 << M.ADD_LIST_BIT))) + payload + b"\x80")
+            payload = bytearray()
+    #every answer but the last one tells that another one is pending
+    for frame in frames[:-1]:
+        frame[1] |= 1 << M.CMD_LAST_ANSW_BIT
+    return frames
+
+def sensors_show_answers():
+    #63 sensors: inputs with and without pullup and outputs
+    entries = []
+    for subadd in range(1,64):
+        sensor_type = (M.INPUT_SENSOR,M.INPUT_SENSOR_PULLUP,M.OUTPUT_SENSOR)[subadd % 3]
+        entries.append(M.encode_sensor_config((subadd,subadd+2,sensor_type)))
+    return split_show_answer(0b11001000,entries,3)
+
+def turnouts_configs():
+    #turnouts with relay pins, one out of two with pulsed relays
+    return [(subadd,subadd+2,60,120,subadd+30,subadd+31,subadd % 2==0,subadd % 2==0) for subadd in range(1,64)]
+
+def turnouts_show_answers():
+    entries = [M.encode_turnout_config(cfg) for cfg in turnouts_configs()]
+    return split_show_answer(0b11011000,entries,7)
+
+def read_all_answers():
+    #read all sensors answers for 63 sensors, different bit patterns
+    frames = []
+    for pattern in (0,0x55,0x2A,0x7F):
+        frame = bytearray((M.START,0b01000000,ADDRESS | (1 << M.ADD_LIST_BIT)))
+        frame.extend([pattern]*9)
+        frame.append(0x80)
+        frames.append(frame)
+    return frames
+
+def values_list_answers():
+    #async events / read list answers: each frame is full
+    frames = []
+    for first in (1,31):
+        frame = bytearray((M.START,0b00000000,ADDRESS | (1 << M.ADD_LIST_BIT)))
+        for subadd in range(first,first+30):
+            frame.extend(M.encode_subadd_value((subadd,subadd % 2)))
+        frame.append(0x80)
+        frames.append(frame)
+    return frames
+
+def all_frames():
+    return sensors_show_answers()+turnouts_show_answers()+read_all_answers()+values_list_answers()
+
+def bench_is_complete_message(frames):
+    #what a caller adding one byte at a time has to do
+    def run():
+        for frame in frames:
+            for i in range(1,len(frame)+1):
+                M.is_complete_message(frame[:i])
+    return run
+
+def bench_frame_decoder(frames):
+    stream = b"".join(frames)
+    def run():
+        decoder = RRduino.RR_duino_frame_decoder()
+        for i in range(len(stream)):
+            decoder.feed(stream[i:i+1])
+    return run
+
+def bench_method(frames,method,*args):
+    msgs = [M(frame) for frame in frames]
+    def run():
+        return [method(msg,*args) for msg in msgs]
+    return run
+
+def bench_encode_turnout_config(configs):
+    def run():
+        return [M.encode_turnout_config(cfg) for cfg in configs]
+    return run
+
+def bench_to_wire_message(frames):
+    msgs = [M(frame) for frame in frames]
+    def run():
+        return [msg.to_wire_message() for msg in msgs]
+    return run
+
+def bench_wire_to_raw_message(frames):
+    wires = [M(frame).to_wire_message() for frame in frames]
+    def run():
+        return [M.wire_to_raw_message(wire) for wire in wires]
+    return run
+
+def benchmarks():
+    #list of (name,function to run,number of frames (configs for the encoder) processed by one run)
+    show_sensors = sensors_show_answers()
+    show_turnouts = turnouts_show_answers()
+    read_all = read_all_answers()
+    values = values_list_answers()
+    frames = all_frames()
+    configs = turnouts_configs()
+    return [
+        ("is_complete_message",bench_is_complete_message(frames),len(frames)),
+        ("frame_decoder_feed",bench_frame_decoder(frames),len(frames)),
+        ("get_list_of_values",bench_method(values,M.get_list_of_values),len(values)),
+        ("get_all_values",bench_method(read_all,M.get_all_values,63),len(read_all)),
+        ("get_all_values_mask",bench_method(read_all,M.get_all_values_mask,63),len(read_all)),
+        ("get_list_of_sensors_config",bench_method(show_sensors,M.get_list_of_sensors_config),len(show_sensors)),
+        ("get_list_of_turnouts_config",bench_method(show_turnouts,M.get_list_of_turnouts_config),len(show_turnouts)),
+        ("encode_turnout_config",bench_encode_turnout_config(configs),len(configs)),
+        ("to_wire_message",bench_to_wire_message(frames),len(frames)),
+        ("wire_to_raw_message",bench_wire_to_raw_message(frames),len(frames)),
+    ]
+
+def allocated_blocks(run):
+    """
+    number of blocks allocated by run(): sys.getallocatedblocks() is sampled on each trace event
+    (every line, call and return of python code) and its increases are added up
+    """
+    total = 0
+    last = sys.getallocatedblocks()
+    def trace(frame,event,arg):
+        nonlocal total,last
+        now = sys.getallocatedblocks()
+        if now > last:
+            total += now-last
+        last = now
+        return trace
+    sys.settrace(trace)
+    try:
+        run()
+    finally:
+        sys.settrace(None)
+    return total
+
+def empty_run():
+    pass
+
+def measure(name,run,nb_frames,min_time):
+    #time: repeat until min_time has elapsed
+    run()  #warm up
+    loops = 0
+    beg = time.perf_counter()
+    while True:
+        run()
+        loops += 1
+        elapsed = time.perf_counter()-beg
+        if elapsed >= min_time:
+            break
+    #allocations: one run with the allocated blocks sampled at each line, minus the cost of the sampling
+    blocks = max(allocated_blocks(run)-allocated_blocks(empty_run),0)
+    #memory: peak of one run under tracemalloc
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    result = run()
+    peak = tracemalloc.get_traced_memory()[1]-base
+    tracemalloc.stop()
+    del result
+    return {"name":name,
+            "frames":nb_frames,
+            "ops_per_s":round(loops/elapsed,1),
+            "frames_per_s":round(loops*nb_frames/elapsed,1),
+            "blocks_per_frame":round(blocks/nb_frames,2),
+            "peak_bytes_per_frame":round(peak/nb_frames,1)}
+
+def main():
+    parser = argparse.ArgumentParser(description="RR_duino_messages codec benchmarks")
+    parser.add_argument("filter",nargs="?",default="",help="only run benchmarks whose name contains this")
+    parser.add_argument("-t","--min-time",type=float,default=0.5,help="minimal duration of each benchmark (s)")
+    parser.add_argument("-o","--output",help="file to append the results to (JSON lines)")
+    args = parser.parse_args()
+
+    out = open(args.output,"a") if args.output else sys.stdout
+    try:
+        for name,run,nb_frames in benchmarks():
+            if args.filter in name:
+                out.write(json.dumps(measure(name,run,nb_frames,args.min_time))+"\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,679 @@
+"""
+Virtual RR-duino nodes on a pseudo terminal, no hardware needed
+
+RR_duino_sim_node emulates the command handling of the RR-duino firmware (RR-duino.ino,
+sensors.cpp, turnouts.cpp and answers.cpp): sensors and turnouts configs, EEPROM store/load/clear,
+show and show table answers, read/write of one, several or all devices and async events
+(debounced input sensors changes and turnouts reaching their position).
+RR_duino_sim_bus puts several nodes on one virtual bus behind a pty: open its port with serial_bus,
+pico-rr-duino-setup.py or any bus master as if it was a real RS485 bus. Each byte takes the time it
+would take on the wire at the chosen baudrate and the bus is half duplex, like RS485.
+
+usage: python3 RR_duino_node_sim.py [-b baudrate] [-n nodes] [-a first_address] [-s sensors] [-t turnouts]
+                                    [-e events_per_s] [-l link] [--seed seed]
+"""
+import argparse,collections,os,random,select,threading,time,tty
+import RR_duino_messages as RRduino
+
+M = RRduino.RR_duino_message
+
+#errors codes of the firmware (RRduino.h)
+EEPROM_FULL = 1
+MEMORY_FULL = 2
+UNKNOWN_DEV = 3
+UNVALID_DEV = 4
+
+#firmware constants
+SENSOR_DEBOUNCE = 0.02      #time a new input level must be stable to be validated (s)
+NB_SERVOS = 5               #servos[0] is reserved for fine tuning
+SERVO_STEP_TIME = 0.01      #servos move one degree every 10ms
+REPOS_TURNOUT_TIME = 0.12   #time to put a turnout in place the first time it moves (s)
+NO_RELAY_PIN = 0xFE
+EEPROM_SIZE = 1024
+CFG_SENSOR_SIZE = 2
+CFG_TURNOUT_SIZE = 6
+
+class RR_duino_sim_sensor:
+    def __init__(self,subadd,pin,io_type,value=0):
+        self.subadd = subadd
+        self.pin = pin
+        self.io_type = io_type      #RR_duino_message.INPUT_SENSOR, INPUT_SENSOR_PULLUP or OUTPUT_SENSOR
+        self.value = value          #last validated state
+        self.changed = False        #validated change not reported yet (input sensors only)
+        self.level = value          #level on the pin, validated after SENSOR_DEBOUNCE
+        self.level_time = None      #time the level changed, None once validated
+
+    def is_input(self):
+        return self.io_type != M.OUTPUT_SENSOR
+
+    def show(self):
+        #config as sent in the show answers (show_one_sensor)
+        return M.encode_sensor_config((self.subadd,self.pin,self.io_type))
+
+    def eeprom_entry(self):
+        return (self.pin,self.io_type,self.value)
+
+class RR_duino_sim_turnout:
+    def __init__(self,subadd,pin,straight_pos,thrown_pos,relay_pin_1=NO_RELAY_PIN,relay_pin_2=NO_RELAY_PIN,pos=0):
+        self.subadd = subadd
+        self.pin = pin
+        self.straight_pos = straight_pos
+        self.thrown_pos = thrown_pos
+        self.relay_pin_1 = relay_pin_1  #raw values: MSB set for pulsed relays
+        self.relay_pin_2 = relay_pin_2
+        self.pos = pos                  #0: straight, 1: thrown (or moving to)
+        self.moving = False
+        self.move_end = None            #time the servo reaches its position, None while waiting for a servo
+        self.positioned = False         #False until it has moved once (UNVALID_POS in the firmware)
+        self.fine_tuning = False
+
+    def show(self):
+        #config as sent in the show answers (show_one_turnout)
+        if self.relay_pin_1 != NO_RELAY_PIN or self.relay_pin_2 != NO_RELAY_PIN:
+            return bytes((self.subadd | (1 << M.SUBADD_TURNOUT_RELAY_PINS_BIT),self.pin,self.straight_pos,
+                          self.thrown_pos,self.relay_pin_1,self.relay_pin_2))
+        return bytes((self.subadd,self.pin,self.straight_pos,self.thrown_pos))
+
+    def move_time(self):
+        if not self.positioned:
+            return REPOS_TURNOUT_TIME
+        return abs(self.thrown_pos-self.straight_pos)*SERVO_STEP_TIME
+
+    def eeprom_entry(self):
+        return (self.pin,self.straight_pos,self.thrown_pos,self.relay_pin_1,self.relay_pin_2,self.pos)
+
+class RR_duino_sim_node:
+    """
+    one RR-duino node: process() takes a complete command frame and returns the answer frames
+    tick() must be called regularly (the firmware loop runs every 10ms) to debounce the sensors,
+    move the turnouts and generate the random input changes
+    """
+    def __init__(self,address,version=1,events_rate=0,seed=None):
+        self.address = address
+        self.version = version
+        self.address_mode = False     #True when the "set address" pin is held low
+        self.sensors = {}             #subaddress -> RR_duino_sim_sensor
+        self.turnouts = {}            #subaddress -> RR_duino_sim_turnout
+        #EEPROM content: address and configs by subaddress
+        self.eeprom = {"address":address,"sensors":{},"turnouts":{}}
+        self.save_cfg_to_eeprom = False
+        self.answers = collections.deque()        #pending answers of the last show command
+        self.async_frames = collections.deque()   #pending turnouts async events (answers.cpp async_head)
+        #random input changes: events_rate changes per second on average over all the inputs
+        self.events_rate = events_rate
+        self.rng = random.Random(seed)
+        self.next_event = None
+
+    #devices
+
+    def sorted_sensors(self):
+        return [self.sensors[subadd] for subadd in sorted(self.sensors)]
+
+    def sorted_turnouts(self):
+        return [self.turnouts[subadd] for subadd in sorted(self.turnouts)]
+
+    def add_sensor(self,subadd,pin,io_type,value=0):
+        self.sensors[subadd] = RR_duino_sim_sensor(subadd,pin,io_type,value)
+
+    def add_turnout(self,subadd,pin,straight_pos,thrown_pos,relay_pin_1=NO_RELAY_PIN,relay_pin_2=NO_RELAY_PIN):
+        self.turnouts[subadd] = RR_duino_sim_turnout(subadd,pin,straight_pos,thrown_pos,relay_pin_1,relay_pin_2)
+
+    def async_pending(self):
+        return bool(self.async_frames) or any(s.changed for s in self.sensors.values())
+
+    def set_input(self,subadd,level,now):
+        #change the level on the pin of an input sensor, validated after the debounce time
+        sensor = self.sensors[subadd]
+        if level != sensor.level:
+            sensor.level = level
+            sensor.level_time = now
+
+    def tick(self,now):
+        if self.events_rate > 0:
+            if self.next_event is None:
+                self.next_event = now+self.rng.expovariate(self.events_rate)
+            inputs = [s for s in self.sensors.values() if s.is_input()]
+            while inputs and self.next_event <= now:
+                sensor = self.rng.choice(inputs)
+                self.set_input(sensor.subadd,1-sensor.level,self.next_event)
+                self.next_event += self.rng.expovariate(self.events_rate)
+        #sensors debounce (check_all_sensors)
+        for sensor in self.sensors.values():
+            if sensor.level_time is not None and now-sensor.level_time > SENSOR_DEBOUNCE:
+                sensor.level_time = None
+                if sensor.level != sensor.value:
+                    sensor.value = sensor.level
+                    sensor.changed = True
+        #turnouts (process_turnouts): one servo per moving turnout, a turnout waits if none is free
+        moving = [t for t in self.sorted_turnouts() if t.moving]
+        servos = sum(1 for t in moving if t.move_end is not None)
+        for turnout in moving:
+            if turnout.move_end is None:
+                if servos < NB_SERVOS-1:
+                    servos += 1
+                    turnout.move_end = now+turnout.move_time()
+                    turnout.positioned = True
+            elif now >= turnout.move_end:
+                servos -= 1
+                turnout.moving = False
+                turnout.move_end = None
+                self.queue_async_turnout(turnout)
+
+    #EEPROM
+
+    def eeprom_room(self,sensors=0,turnouts=0):
+        #True if that many more configs fit in the EEPROM (turnouts from the start, sensors from the end)
+        nb_sensors = len(self.eeprom["sensors"])+sensors
+        nb_turnouts = len(self.eeprom["turnouts"])+turnouts
+        return 2+CFG_TURNOUT_SIZE*(nb_turnouts+1)+CFG_SENSOR_SIZE*(nb_sensors+1) <= EEPROM_SIZE
+
+    def save_sensor(self,sensor):
+        if sensor.subadd not in self.eeprom["sensors"] and not self.eeprom_room(sensors=1):
+            return EEPROM_FULL
+        self.eeprom["sensors"][sensor.subadd] = sensor.eeprom_entry()
+        return 0
+
+    def save_turnout(self,turnout):
+        if turnout.subadd not in self.eeprom["turnouts"] and not self.eeprom_room(turnouts=1):
+            return EEPROM_FULL
+        self.eeprom["turnouts"][turnout.subadd] = turnout.eeprom_entry()
+        return 0
+
+    def store_eeprom(self):
+        #save_config: address and all configs
+        self.eeprom["address"] = self.address
+        err = 0
+        for turnout in self.sorted_turnouts():
+            err = self.save_turnout(turnout) or err
+        for sensor in self.sorted_sensors():
+            err = self.save_sensor(sensor) or err
+        return err
+
+    def load_eeprom(self):
+        #load_cfg_from_eeprom: EEPROM configs replace the ones with the same subaddress
+        for subadd,(pin,straight_pos,thrown_pos,relay_pin_1,relay_pin_2,pos) in self.eeprom["turnouts"].items():
+            self.add_turnout(subadd,pin,straight_pos,thrown_pos,relay_pin_1,relay_pin_2)
+            self.turnouts[subadd].pos = pos
+        if self.address == 0:
+            #load_sensors fails without an address
+            return EEPROM_FULL
+        for subadd,(pin,io_type,value) in self.eeprom["sensors"].items():
+            self.add_sensor(subadd,pin,io_type,value)
+        return 0
+
+    def clear_eeprom(self):
+        self.eeprom["sensors"].clear()
+        self.eeprom["turnouts"].clear()
+
+    #answers, buf is the frame without the start byte like command_buf in the firmware
+
+    def answer(self,data):
+        #send_one_msg: tell if async events are pending
+        if self.async_pending():
+            data[0] |= 1 << M.CMD_ASYNC_BIT
+        return [bytes((M.START,))+bytes(data)]
+
+    def simple_answer(self,buf,err):
+        return self.answer(bytearray((buf[0] & ~(1 << M.CMD_ANSW_BIT),buf[1],0x80 | err)))
+
+    def error_answer(self,buf,pos,err):
+        #answer to a list command stopped on the subaddress at pos
+        data = bytearray(buf[:pos+1])
+        data[0] &= ~(1 << M.CMD_ANSW_BIT)
+        data[pos] = 0x80 | err
+        return self.answer(data)
+
+    def process(self,frame):
+        """
+        process one command (RR_duino_frame as returned by the frame decoder)
+        returns the list of answer frames (bytes, with the start byte), empty if it was not for us
+        """
+        buf = bytearray(frame.raw_message[1:])
+        if not buf[0] & (1 << M.CMD_ANSW_BIT):
+            #an answer from another node
+            return []
+        if not self.address_mode and buf[1] & 0x3F != self.address:
+            return []
+        if buf[0] & (1 << M.CMD_ASYNC_BIT):
+            return self.send_async_events()
+        if buf[0] & (1 << M.CMD_CONFIG_BIT):
+            if buf[0] & (1 << M.CMD_SPECIAL_CONFIG_BIT):
+                return self.special_config(buf)
+            if buf[0] & (1 << M.CMD_CONFIG_DEL_BIT):
+                return self.delete_cmd(buf)
+            return self.config_cmd(buf)
+        return self.rw_cmd(buf)
+
+    def special_config(self,buf):
+        special = (buf[0] >> M.CMD_SPECIAL_CONFIG_CODE_POS) & M.CMD_SPECIAL_CONFIG_CODE_MASK
+        if special == M.CMD_VERSION:
+            return self.answer(bytearray(((1 << M.CMD_CONFIG_BIT) | (1 << M.CMD_SPECIAL_CONFIG_BIT),self.address,self.version,0x80)))
+        if special == M.CMD_SET_ADDRESS:
+            if not self.address_mode:
+                #not meant for us
+                return []
+            self.address = buf[1]
+            return self.simple_answer(buf,0)
+        if special == M.CMD_STORE_EEPROM:
+            self.save_cfg_to_eeprom = True
+            return self.simple_answer(buf,self.store_eeprom())
+        if special == M.CMD_LOAD_EEPROM:
+            return self.simple_answer(buf,self.load_eeprom())
+        if special == M.CMD_SHOW_SENSORS:
+            if buf[1] & (1 << M.ADD_TABLE_BIT):
+                return self.show_sensors_table(buf)
+            return self.show_cmd(buf,[s.show() for s in self.sorted_sensors()],3)
+        if special == M.CMD_SHOW_TURNOUTS:
+            if buf[1] & (1 << M.ADD_TABLE_BIT):
+                return self.show_turnouts_table(buf)
+            return self.show_cmd(buf,[t.show() for t in self.sorted_turnouts()],7)
+        if special == M.CMD_TURNOUT_FINE_TUNE:
+            return self.fine_tune(buf)
+        self.clear_eeprom()
+        return self.simple_answer(buf,0)
+
+    def show_cmd(self,buf,configs,margin):
+        #show_sensors_cmd/show_turnouts_cmd: the first show command builds all the answers, each
+        #show command sends the next one
+        #margin is the room needed to add the next config (3 for sensors, 7 for turnouts)
+        if not self.answers:
+            header = bytearray((buf[0] & ~(1 << M.CMD_ANSW_BIT),buf[1] | (1 << M.ADD_LIST_BIT)))
+            data = bytearray(header)
+            for i,config in enumerate(configs):
+                data.extend(config)
+                if len(data)+margin > M.MAX_CMD_LEN or i == len(configs)-1:
+                    data.append(0x80)
+                    self.queue_answer(data)
+                    data = bytearray(header)
+            if not configs:
+                data.append(0x80)
+                self.queue_answer(data)
+        return self.answer(self.answers.popleft())
+
+    def queue_answer(self,data):
+        if self.answers:
+            #the previous answer now tells another one is pending
+            self.answers[-1][0] |= 1 << M.CMD_LAST_ANSW_BIT
+        self.answers.append(data)
+
+    def show_sensors_table(self,buf):
+        data = bytearray(buf[:2])
+        data[0] &= ~(1 << M.CMD_ANSW_BIT)
+        data.extend(bytes(18))
+        for sensor in self.sensors.values():
+            byte_pos,bit_pos = divmod(sensor.subadd-1,7)
+            if not sensor.is_input():
+                #outputs are in the second table
+                byte_pos += 9
+            data[2+byte_pos] |= 1 << bit_pos
+        data.append(0x80)
+        return self.answer(data)
+
+    def show_turnouts_table(self,buf):
+        data = bytearray(buf[:2])
+        data[0] &= ~(1 << M.CMD_ANSW_BIT)
+        data.extend(bytes(9))
+        for turnout in self.turnouts.values():
+            byte_pos,bit_pos = divmod(turnout.subadd-1,7)
+            data[2+byte_pos] |= 1 << bit_pos
+        data.append(0x80)
+        return self.answer(data)
+
+    def fine_tune(self,buf):
+        turnout = self.turnouts.get(buf[2] & 0x3F)
+        if turnout is None:
+            return self.simple_answer(buf,UNKNOWN_DEV)
+        if 10 <= buf[3] <= 170:
+            for other in self.turnouts.values():
+                other.fine_tuning = False
+            turnout.fine_tuning = True
+        elif buf[3] == 0:
+            turnout.fine_tuning = False
+        return self.simple_answer(buf,0)
+
+    #configs
+
+    def config_one_sensor(self,buf,pos):
+        subadd = buf[pos] & 0x3F
+        if buf[pos] & (1 << M.SUBADD_SENSOR_IO_BIT):
+            io_type = M.OUTPUT_SENSOR
+        elif buf[pos+1] & (1 << M.PIN_PULLUP_BIT):
+            io_type = M.INPUT_SENSOR_PULLUP
+        else:
+            io_type = M.INPUT_SENSOR
+        sensor = self.sensors.get(subadd)
+        if sensor is None:
+            sensor = RR_duino_sim_sensor(subadd,buf[pos+1] & 0x7F,io_type)
+            self.sensors[subadd] = sensor
+        else:
+            sensor.pin = buf[pos+1] & 0x7F
+            sensor.io_type = io_type
+        if self.save_cfg_to_eeprom:
+            err = self.save_sensor(sensor)
+            if err:
+                return -err
+        return 2
+
+    def config_one_turnout(self,buf,pos):
+        subadd = buf[pos] & 0x3F
+        if buf[pos] & (1 << M.SUBADD_TURNOUT_RELAY_PINS_BIT):
+            relay_pins = (buf[pos+4],buf[pos+5])
+            size = 6
+        else:
+            relay_pins = (NO_RELAY_PIN,NO_RELAY_PIN)
+            size = 4
+        turnout = self.turnouts.get(subadd)
+        if turnout is None:
+            if self.save_cfg_to_eeprom and not self.eeprom_room(turnouts=1):
+                return -EEPROM_FULL
+            turnout = RR_duino_sim_turnout(subadd,buf[pos+1],buf[pos+2],buf[pos+3],*relay_pins)
+            self.turnouts[subadd] = turnout
+        else:
+            turnout.pin,turnout.straight_pos,turnout.thrown_pos = buf[pos+1:pos+4]
+            turnout.relay_pin_1,turnout.relay_pin_2 = relay_pins
+        if self.save_cfg_to_eeprom:
+            self.save_turnout(turnout)
+        return size
+
+    def config_cmd(self,buf):
+        config_one = self.config_one_turnout if buf[0] & (1 << M.CMD_SENSOR_TURNOUT_BIT) else self.config_one_sensor
+        if not buf[1] & (1 << M.ADD_LIST_BIT):
+            err = config_one(buf,2)
+            return self.simple_answer(buf,-err if err < 0 else 0)
+        pos = 2
+        while pos < len(buf)-1:
+            size = config_one(buf,pos)
+            if size < 0:
+                return self.simple_answer(buf,-size)
+            pos += size
+        return self.simple_answer(buf,0)
+
+    def delete_one(self,buf,subadd):
+        if buf[0] & (1 << M.CMD_SENSOR_TURNOUT_BIT):
+            devices,eeprom = self.turnouts,self.eeprom["turnouts"]
+        else:
+            devices,eeprom = self.sensors,self.eeprom["sensors"]
+        if devices.pop(subadd,None) is None:
+            return UNKNOWN_DEV
+        if self.save_cfg_to_eeprom:
+            eeprom.pop(subadd,None)
+        return 0
+
+    def delete_cmd(self,buf):
+        if not buf[1] & (1 << M.ADD_LIST_BIT):
+            return self.simple_answer(buf,self.delete_one(buf,buf[2] & 0x3F))
+        for pos in range(2,len(buf)-1):
+            err = self.delete_one(buf,buf[pos] & 0x3F)
+            if err:
+                return self.error_answer(buf,pos,err)
+        return self.simple_answer(buf,0)
+
+    #reads and writes
+
+    def read_one(self,on_turnout,subadd):
+        #returns the value or minus the error code
+        if on_turnout:
+            turnout = self.turnouts.get(subadd)
+            return -UNKNOWN_DEV if turnout is None else turnout.pos
+        sensor = self.sensors.get(subadd)
+        if sensor is None:
+            return -UNKNOWN_DEV
+        sensor.changed = False
+        return sensor.value
+
+    def write_one(self,on_turnout,subadd_value):
+        #returns 0 or the error code
+        subadd = subadd_value & 0x3F
+        value = (subadd_value >> M.SUBADD_VALUE_BIT) & 1
+        if on_turnout:
+            turnout = self.turnouts.get(subadd)
+            if turnout is None:
+                return UNKNOWN_DEV
+            if value == turnout.pos:
+                #already in position, just send the feedback
+                self.queue_async_turnout(turnout)
+                return 0
+            turnout.pos = value
+            turnout.moving = True
+            turnout.fine_tuning = False
+            return self.save_turnout(turnout) if self.save_cfg_to_eeprom else 0
+        sensor = self.sensors.get(subadd)
+        if sensor is None:
+            return UNKNOWN_DEV
+        if sensor.is_input():
+            return UNVALID_DEV
+        sensor.value = value
+        return self.save_sensor(sensor) if self.save_cfg_to_eeprom else 0
+
+    def read_all(self,buf,on_turnout):
+        devices = self.sorted_turnouts() if on_turnout else self.sorted_sensors()
+        data = bytearray((buf[0] & ~(1 << M.CMD_ANSW_BIT),buf[1] | (1 << M.ADD_LIST_BIT)))
+        data.extend(bytes(max(1,(len(devices)+6)//7)))
+        for i,device in enumerate(devices):
+            if (device.pos if on_turnout else device.value):
+                data[2+i//7] |= 1 << (i % 7)
+        data.append(0x80)
+        return self.answer(data)
+
+    def write_all(self,buf,on_turnout):
+        #one bit per turnout or per output sensor, in subaddress order
+        if on_turnout:
+            devices = self.sorted_turnouts()
+        else:
+            devices = [s for s in self.sorted_sensors() if not s.is_input()]
+        for i,device in enumerate(devices):
+            pos = 2+i//7
+            if buf[pos] & 0x80:
+                break
+            value = (buf[pos] >> (i % 7)) & 1
+            if not on_turnout:
+                device.value = value
+            elif value != device.pos:
+                device.pos = value
+                device.moving = True
+        return self.simple_answer(buf,0)
+
+    def rw_cmd(self,buf):
+        on_turnout = buf[0] & (1 << M.CMD_SENSOR_TURNOUT_BIT) != 0
+        write = buf[0] & (1 << M.CMD_RW_BIT) != 0
+        if buf[0] & (1 << M.CMD_ALL_BIT):
+            return self.write_all(buf,on_turnout) if write else self.read_all(buf,on_turnout)
+        if buf[1] & (1 << M.ADD_LIST_BIT):
+            if write:
+                for pos in range(2,len(buf)-1):
+                    err = self.write_one(on_turnout,buf[pos])
+                    if err:
+                        return self.error_answer(buf,pos,err)
+                return self.simple_answer(buf,0)
+            buf[0] &= ~(1 << M.CMD_ANSW_BIT)
+            for pos in range(2,len(buf)-1):
+                val = self.read_one(on_turnout,buf[pos] & 0x3F)
+                if val < 0:
+                    return self.error_answer(buf,pos,-val)
+                buf[pos] = (buf[pos] & 0x3F) | (val << M.SUBADD_VALUE_BIT)
+            return self.answer(buf)
+        if write:
+            return self.simple_answer(buf,self.write_one(on_turnout,buf[2]))
+        val = self.read_one(on_turnout,buf[2] & 0x3F)
+        if val < 0:
+            return self.simple_answer(buf,-val)
+        buf[0] &= ~(1 << M.CMD_ANSW_BIT)
+        buf[2] |= val << M.SUBADD_VALUE_BIT
+        return self.answer(buf)
+
+    #async events (answers.cpp)
+
+    def queue_async_turnout(self,turnout):
+        last = self.async_frames[-1] if self.async_frames else None
+        if last is None or len(last) > M.MAX_CMD_LEN-2:
+            new = bytearray((1 << M.CMD_SENSOR_TURNOUT_BIT,self.address | (1 << M.ADD_LIST_BIT)))
+            if last is not None:
+                last.append(0x80)
+                last[0] |= 1 << M.CMD_LAST_ANSW_BIT
+            self.async_frames.append(new)
+            last = new
+        last.append(turnout.subadd | (turnout.pos << M.SUBADD_VALUE_BIT))
+
+    def send_async_events(self):
+        #turnouts events first, then the sensors changes
+        if self.async_frames:
+            data = self.async_frames.popleft()
+            if not self.async_frames:
+                if any(s.changed for s in self.sensors.values()):
+                    data[0] |= 1 << M.CMD_ASYNC_BIT
+                data.append(0x80)
+            return [bytes((M.START,))+bytes(data)]
+        changed = [s for s in self.sorted_sensors() if s.is_input() and s.changed]
+        data = bytearray((0,self.address | (1 << M.ADD_LIST_BIT)))
+        for sensor in changed:
+            if len(data) > M.MAX_CMD_LEN-2:
+                #full, more to come
+                data[0] |= 1 << M.CMD_LAST_ANSW_BIT
+                break
+            sensor.changed = False
+            data.append(sensor.subadd | (sensor.value << M.SUBADD_VALUE_BIT))
+        if self.async_frames:
+            data[0] |= 1 << M.CMD_ASYNC_BIT
+        data.append(0x80)
+        return [bytes((M.START,))+bytes(data)]
+
+class RR_duino_sim_bus:
+    """
+    virtual RS485 bus: the nodes answer the commands written to the pty (see port)
+    bytes are delayed by the time they take on the wire (10 bits per byte) and the line is half
+    duplex, the nodes answer node_delay (s) after the end of the command
+    run() drives the bus in the calling thread, start() in a thread (use lock to access the nodes
+    while it runs)
+    """
+    TICK = 0.01  #period of the nodes loops (move turnouts and check sensors every 10ms)
+    NODE_DELAY = 0.0002
+
+    def __init__(self,nodes,baudrate=38400,node_delay=NODE_DELAY):
+        self.nodes = nodes
+        self.byte_time = 10/baudrate
+        self.node_delay = node_delay
+        self.master,self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master,False)
+        self.port = os.ttyname(self.slave)  #device to open as the serial port
+        self.decoder = RRduino.RR_duino_frame_decoder()
+        self.line_free = 0                  #time the line is free again
+        self.pending = collections.deque()  #(time the answer is fully on the wire,answer)
+        self.tx = bytearray()               #answers waiting for the pty
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.commands = self.answers = 0
+
+    def received(self,data,now):
+        #the bytes arrive at the pace of the line, then addressed nodes answer one after the other
+        self.line_free = max(now,self.line_free)+len(data)*self.byte_time
+        for frame in self.decoder.feed(data):
+            self.commands += 1
+            for node in self.nodes:
+                for answer in node.process(frame):
+                    self.answers += 1
+                    #the first byte comes alone so that the host sees when the answer begins
+                    self.line_free += self.node_delay+self.byte_time
+                    self.pending.append((self.line_free,answer[:1]))
+                    self.line_free += (len(answer)-1)*self.byte_time
+                    self.pending.append((self.line_free,answer[1:]))
+
+    def run(self,duration=None):
+        end = None if duration is None else time.monotonic()+duration
+        next_tick = time.monotonic()
+        self.running = True
+        while self.running:
+            now = time.monotonic()
+            if end is not None and now >= end:
+                break
+            with self.lock:
+                if now >= next_tick:
+                    for node in self.nodes:
+                        node.tick(now)
+                    next_tick = now+RR_duino_sim_bus.TICK
+                while self.pending and self.pending[0][0] <= now:
+                    self.tx.extend(self.pending.popleft()[1])
+            wake = next_tick
+            if self.pending:
+                wake = min(wake,self.pending[0][0])
+            if end is not None:
+                wake = min(wake,end)
+            readable,writable,_ = select.select([self.master],[self.master] if self.tx else [],[],max(0,wake-now))
+            if writable:
+                del self.tx[:os.write(self.master,self.tx)]
+            if readable:
+                try:
+                    data = os.read(self.master,4096)
+                except (BlockingIOError,InterruptedError):
+                    continue
+                with self.lock:
+                    self.received(data,time.monotonic())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+def populate_node(node,nb_sensors,nb_turnouts):
+    #inputs with and without pullup and one output out of four, turnouts with relays one out of two
+    for subadd in range(1,nb_sensors+1):
+        io_type = (M.INPUT_SENSOR_PULLUP,M.INPUT_SENSOR,M.INPUT_SENSOR_PULLUP,M.OUTPUT_SENSOR)[subadd % 4]
+        node.add_sensor(subadd,(subadd+1) % 70,io_type)
+    for subadd in range(1,nb_turnouts+1):
+        if subadd % 2:
+            node.add_turnout(subadd,(subadd+21) % 70,60,120)
+        else:
+            node.add_turnout(subadd,(subadd+21) % 70,60,120,(subadd+40) % 70,(subadd+41) % 70)
+    node.store_eeprom()
+
+def main():
+    parser = argparse.ArgumentParser(description="virtual RR-duino bus on a pseudo terminal")
+    parser.add_argument("-b","--baudrate",type=int,default=38400)
+    parser.add_argument("-n","--nodes",type=int,default=1,help="number of nodes on the bus")
+    parser.add_argument("-a","--address",type=int,default=1,help="address of the first node")
+    parser.add_argument("-s","--sensors",type=int,default=16,help="sensors per node")
+    parser.add_argument("-t","--turnouts",type=int,default=8,help="turnouts per node")
+    parser.add_argument("-e","--events",type=float,default=0,help="random input changes per second and per node")
+    parser.add_argument("-l","--link",help="symbolic link to create to the pty")
+    parser.add_argument("--seed",type=int,help="seed of the random input changes")
+    args = parser.parse_args()
+    if args.address+args.nodes-1 > 62 or args.sensors > 63 or args.turnouts > 63:
+        parser.error("addresses and subaddresses must be in 1-62 and 1-63")
+
+    nodes = []
+    for i in range(args.nodes):
+        seed = None if args.seed is None else args.seed+i
+        node = RR_duino_sim_node(args.address+i,events_rate=args.events,seed=seed)
+        populate_node(node,args.sensors,args.turnouts)
+        nodes.append(node)
+    bus = RR_duino_sim_bus(nodes,args.baudrate)
+    port = bus.port
+    if args.link:
+        if os.path.islink(args.link):
+            os.remove(args.link)
+        os.symlink(bus.port,args.link)
+        port = args.link
+    print("%d node(s) at %d bauds on %s" % (args.nodes,args.baudrate,port),flush=True)
+    try:
+        bus.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("%d commands, %d answers" % (bus.commands,bus.answers))
+        bus.close()
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Latency and bus utilisation statistics of a serial_bus
+
+bus_stats is fed by RR_duino_transactions with the timestamps of each transaction:
+  request: the command is queued
+  sent: its last byte has been written to the port
+  first byte: the first byte of the answer has been read
+  last byte: the answer is complete
+sent-request is the host side, first byte-sent is mostly the node processing time and last
+byte-first byte the time on the wire. Histograms are kept per node address and per command class.
+The bytes counters of the bus give the bytes on the wire per second, compared to what the
+baudrate allows (the bus is half duplex so both directions share it).
+snapshot() is cheap enough to be polled, to_json() dumps it.
+"""
+import bisect,collections,json,time
+import RR_duino_messages as RRduino
+
+M = RRduino.RR_duino_message
+
+class latency_histogram:
+    #upper bounds (s) of the buckets, the last bucket holds everything above
+    BOUNDS = (0.0005,0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1.0,2.0,5.0)
+
+    def __init__(self):
+        self.counts = [0]*(len(latency_histogram.BOUNDS)+1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self,value):
+        self.counts[bisect.bisect_left(latency_histogram.BOUNDS,value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self,other):
+        for i,count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max,other.max)
+
+    def percentile(self,p):
+        #upper bound of the bucket holding the p-th percentile (max for the last bucket)
+        if self.count == 0:
+            return None
+        rank = p*self.count/100
+        seen = 0
+        for i,count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return latency_histogram.BOUNDS[i] if i < len(latency_histogram.BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self):
+        if self.count == 0:
+            return {"count":0}
+        return {"count":self.count,
+                "mean":self.total/self.count,
+                "max":self.max,
+                "p50":self.percentile(50),
+                "p90":self.percentile(90),
+                "p99":self.percentile(99),
+                "buckets":self.counts}
+
+class rolling_histogram:
+    """
+    histogram of the last window to 2*window seconds: values go to the current generation,
+    which becomes the previous one every window seconds
+    """
+    def __init__(self,window):
+        self.window = window
+        self.current = latency_histogram()
+        self.previous = latency_histogram()
+        self.rotate_time = time.monotonic()+window
+
+    def rotate(self,now):
+        if now >= self.rotate_time:
+            if now >= self.rotate_time+self.window:
+                #nothing in the last window
+                self.previous = latency_histogram()
+            else:
+                self.previous = self.current
+            self.current = latency_histogram()
+            self.rotate_time = now+self.window
+
+    def add(self,value,now):
+        self.rotate(now)
+        self.current.add(value)
+
+    def histogram(self,now):
+        self.rotate(now)
+        hist = latency_histogram()
+        hist.merge(self.previous)
+        hist.merge(self.current)
+        return hist
+
+def command_class(cmd):
+    #class of a command (RR_duino_message) in the statistics
+    if cmd.async_events_pending():
+        return "async"
+    if cmd.is_special_config_cmd():
+        special = cmd.get_special_config()
+        if special == M.CMD_VERSION:
+            return "version"
+        if special in (M.CMD_SHOW_SENSORS,M.CMD_SHOW_TURNOUTS):
+            return "show"
+        return "config"
+    if cmd.is_config_cmd():
+        return "config"
+    return "rw"
+
+class transaction_stats:
+    #rolling histograms of the latencies of one node or one command class
+    def __init__(self,window):
+        self.host = rolling_histogram(window)         #sent-request
+        self.first_byte = rolling_histogram(window)   #first byte-sent
+        self.answer = rolling_histogram(window)       #last byte-sent
+        self.transactions = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.errors = 0
+
+    def to_dict(self,now):
+        return {"transactions":self.transactions,
+                "timeouts":self.timeouts,
+                "retries":self.retries,
+                "errors":self.errors,
+                "host":self.host.histogram(now).to_dict(),
+                "first_byte":self.first_byte.histogram(now).to_dict(),
+                "answer":self.answer.histogram(now).to_dict()}
+
+class bus_stats:
+    WINDOW = 60  #seconds covered by the rolling histograms (up to twice that) and by the bytes rate
+
+    def __init__(self,bus,window=WINDOW):
+        self.bus = bus
+        self.window = window
+        self.by_address = collections.defaultdict(lambda: transaction_stats(self.window))
+        self.by_class = collections.defaultdict(lambda: transaction_stats(self.window))
+        self.begin = time.monotonic()
+        #(time,bytes sent,bytes received) samples of the bus counters, one per second at most
+        self.samples = collections.deque([(self.begin,bus.tx_bytes,bus.rx_bytes)])
+
+    def sample(self,now):
+        if now-self.samples[-1][0] >= 1:
+            self.samples.append((now,self.bus.tx_bytes,self.bus.rx_bytes))
+            while len(self.samples) > 2 and now-self.samples[1][0] >= self.window:
+                self.samples.popleft()
+
+    def record(self,transaction):
+        #account one finished transaction (RR_duino_transaction)
+        now = time.monotonic()
+        cmd = transaction.cmd
+        for stats in (self.by_address[cmd.get_address() & 0x3F],self.by_class[command_class(cmd)]):
+            stats.transactions += 1
+            stats.retries += transaction.tries-1
+            if transaction.answer is None:
+                stats.timeouts += 1
+                continue
+            if transaction.error:
+                stats.errors += 1
+            stats.host.add(transaction.sent-transaction.request,now)
+            stats.first_byte.add(transaction.first_byte-transaction.sent,now)
+            stats.answer.add(transaction.last_byte-transaction.sent,now)
+        self.sample(now)
+
+    def wire(self,now):
+        #bytes on the wire over the last window and utilisation of the line
+        self.sample(now)
+        t0,tx0,rx0 = self.samples[0]
+        elapsed = now-t0
+        tx = self.bus.tx_bytes-tx0
+        rx = self.bus.rx_bytes-rx0
+        capacity = 1/self.bus.byte_time()
+        rate = (tx+rx)/elapsed if elapsed > 0 else 0
+        return {"seconds":elapsed,
+                "tx_bytes_per_s":tx/elapsed if elapsed > 0 else 0,
+                "rx_bytes_per_s":rx/elapsed if elapsed > 0 else 0,
+                "capacity_bytes_per_s":capacity,
+                "utilisation":rate/capacity,
+                "tx_bytes":self.bus.tx_bytes,
+                "rx_bytes":self.bus.rx_bytes}
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {"uptime":now-self.begin,
+                "wire":self.wire(now),
+                "addresses":{str(add):stats.to_dict(now) for add,stats in sorted(self.by_address.items())},
+                "classes":{name:stats.to_dict(now) for name,stats in sorted(self.by_class.items())}}
+
+    def to_json(self,**kwargs):
+        return json.dumps(self.snapshot(),**kwargs)
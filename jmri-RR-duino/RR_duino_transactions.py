@@ -0,0 +1,168 @@
+"""
+Request/answer transactions with RR-duino nodes on top of serial_bus
+
+A transaction sends one command and waits for the matching answer (answer bit unset, same
+command, same address: the same checks as answer_from_bus_step in the bus controller).
+The timeout is computed from the baudrate and the lengths of the command and of the longest
+possible answer, plus the time the node needs to process the command.
+Timeouts are retried according to the retry policy, except for the commands asking for the next
+part of a multi-part answer (show and async): a lost part cannot be asked for again.
+The timestamps of each transaction are accounted in stats (see RR_duino_stats).
+"""
+import time
+import RR_duino_messages as RRduino
+import RR_duino_stats
+
+M = RRduino.RR_duino_message
+
+class RR_duino_retry_policy:
+    def __init__(self,retries=2,retry_errors=(),backoff=0,retry_continuations=False):
+        self.retries = retries            #number of tries after the first one
+        self.retry_errors = retry_errors  #device error codes worth retrying (timeouts are retried, see below)
+        self.backoff = backoff            #time (s) to wait before retrying
+        #the node moves on to the next part of a multi-part answer (show, async) on each command, so
+        #resending one after a timeout skips the lost part: by default the TIMEOUT goes to the caller
+        self.retry_continuations = retry_continuations
+
+class RR_duino_transaction:
+    #result of one transaction
+    TIMEOUT = -1
+
+    def __init__(self,cmd):
+        self.cmd = cmd          #the command (RR_duino_message)
+        self.answer = None      #the answer (RR_duino_frame) if any
+        self.error = None       #None, error code of the device or TIMEOUT
+        self.tries = 0
+        self.timeout = 0        #timeout used for each try
+        self.duration = 0       #time from the first send to the answer (or last timeout)
+        #time.monotonic() timestamps of the last try: command queued, command written,
+        #first and last bytes of the answer read (None if no answer)
+        self.request = self.sent = None
+        self.first_byte = self.last_byte = None
+
+    def ok(self):
+        return self.error is None
+
+class RR_duino_transactions:
+    #time (s) the node needs to process a command: most are immediate but config commands
+    #might write a config to the EEPROM, load and clear read it or write a few bytes
+    NODE_LATENCY = 0.01
+    CONFIG_LATENCY = 0.05
+    EEPROM_LATENCY = 1.0
+    #a store writes all the configs (EEPROM.update): at worst every byte of a 1KB EEPROM, ~3.3ms each
+    EEPROM_WRITE_TIME = 0.0033
+    EEPROM_SIZE = 1024
+    STORE_LATENCY = EEPROM_WRITE_TIME*EEPROM_SIZE*1.25
+    #minimal timeout to take the host scheduling into account
+    MIN_TIMEOUT = 0.02
+
+    def __init__(self,bus,policy=None):
+        self.bus = bus                    #a serial_bus, already started
+        self.policy = policy if policy is not None else RR_duino_retry_policy()
+        self.decoder = RRduino.RR_duino_frame_decoder()
+        self.unmatched = 0                #number of frames received that were not the expected answer
+        self.stats = RR_duino_stats.bus_stats(bus)
+
+    @staticmethod
+    def max_answer_len(cmd):
+        #length of the longest answer the node can send to cmd
+        if cmd.async_events_pending():
+            #async command: answers are lists
+            return RRduino.RR_duino_frame_decoder.MAX_FRAME_LEN
+        if cmd.is_special_config_cmd():
+            special = cmd.get_special_config()
+            if special == M.CMD_VERSION:
+                return 5
+            if special in (M.CMD_SHOW_SENSORS,M.CMD_SHOW_TURNOUTS):
+                return RRduino.RR_duino_frame_decoder.MAX_FRAME_LEN
+            return 4
+        if cmd.is_config_cmd():
+            #simple answer or list of subaddresses (error while deleting a list)
+            return max(4,len(cmd.raw_message))
+        if cmd.is_all():
+            #bits tables: 63 values, 7 per byte
+            return 3+9+1
+        if cmd.is_list():
+            #subaddresses are sent back
+            return len(cmd.raw_message)
+        return 4
+
+    @staticmethod
+    def is_continuation(cmd):
+        #True if cmd asks for the next part of a multi-part answer (show configs or async events)
+        if cmd.async_events_pending():
+            return True
+        return (cmd.is_special_config_cmd() and not cmd.is_show_table() and
+                cmd.get_special_config() in (M.CMD_SHOW_SENSORS,M.CMD_SHOW_TURNOUTS))
+
+    @staticmethod
+    def node_latency(cmd):
+        if cmd.is_special_config_cmd():
+            if cmd.get_special_config() == M.CMD_STORE_EEPROM:
+                return RR_duino_transactions.STORE_LATENCY
+            if cmd.get_special_config() in (M.CMD_LOAD_EEPROM,M.CMD_CLEAR_EEPROM):
+                return RR_duino_transactions.EEPROM_LATENCY
+            return RR_duino_transactions.NODE_LATENCY
+        if cmd.is_config_cmd():
+            return RR_duino_transactions.CONFIG_LATENCY
+        return RR_duino_transactions.NODE_LATENCY
+
+    def timeout(self,cmd):
+        #timeout (s) of one try of the command
+        wire_time = (len(cmd.raw_message)+RR_duino_transactions.max_answer_len(cmd))*self.bus.byte_time()
+        return max(RR_duino_transactions.MIN_TIMEOUT,wire_time+RR_duino_transactions.node_latency(cmd))
+
+    def wait_answer(self,result,deadline):
+        #wait for the answer to result.cmd until deadline, returns it or None
+        cmd = result.cmd
+        while time.monotonic()<deadline:
+            self.bus.process_IO(deadline)
+            views = self.bus.read_views()
+            if views and result.first_byte is None and not self.bus.sending():
+                result.first_byte = self.bus.last_read_time
+            for view in views:
+                for frame in self.decoder.feed(view):
+                    if frame.is_answer_to_msg(cmd):
+                        result.sent = self.bus.last_write_time
+                        result.last_byte = self.bus.last_read_time
+                        return frame
+                    self.unmatched += 1
+        return None
+
+    def transact(self,cmd,timeout=None,policy=None):
+        """
+        send cmd (RR_duino_message or bytes) and wait for its answer, retrying according to the policy
+        timeout overrides the computed timeout of each try
+        returns a RR_duino_transaction
+        """
+        if not isinstance(cmd,M):
+            cmd = M(bytearray(cmd))
+        if policy is None:
+            policy = self.policy
+        result = RR_duino_transaction(cmd)
+        result.timeout = timeout if timeout is not None else self.timeout(cmd)
+        beg = time.monotonic()
+        while True:
+            if result.tries > 0 and policy.backoff:
+                time.sleep(policy.backoff)
+            result.tries += 1
+            #forget any frame left from a previous transaction
+            self.bus.read_views()
+            self.decoder.reset()
+            result.request = time.monotonic()
+            result.first_byte = None
+            self.bus.send(cmd.raw_message)
+            result.answer = self.wait_answer(result,result.request+result.timeout)
+            if result.answer is None:
+                result.error = RR_duino_transaction.TIMEOUT
+            else:
+                result.error = result.answer.get_error_code() or None
+            if result.error == RR_duino_transaction.TIMEOUT:
+                retry = policy.retry_continuations or not RR_duino_transactions.is_continuation(cmd)
+            else:
+                retry = result.error in policy.retry_errors
+            if not retry or result.tries > policy.retries:
+                break
+        result.duration = time.monotonic()-beg
+        self.stats.record(result)
+        return result
@@ -1,5 +1,7 @@
-import socket,select,time
-import json,sys
+import socket,selectors,time,os,signal
+import json,sys,atexit,re,collections,itertools
+import RR_duino_messages as RRduino
+import RR_duino_capture,RR_duino_stats
 
 #config file format
 #a dictionnary bus number (as string)<-> boolean, that is {"1":True,...}
@@ -7,8 +9,291 @@ import json,sys
 #a dictionnary bus number (as string) <-> list of addresses, that is {"1":[1,25,78,3],...}
 #where the addresses are the one that should be discovered first (and only them if autodiscover is not allowed
 #this is to speed up the process of discovery
-#constants
-timeout=0.01
+#"capture_file": optional file where all the traffic with JMRI and the bus controllers is captured
+#(see RR_duino_capture.py to replay it)
+#"receive_buffer_size": size of the buffer the sockets are read into (default 65536)
+#"max_line_length": longest line accepted from a client or bus controller, a longer one closes the
+#connection (default 4096)
+#"metrics_port": optional port of the metrics listener (HTTP GET /metrics for Prometheus, /json for JSON)
+#"metrics_ip": address of the metrics listener (default 127.0.0.1)
+#"workers": number of worker processes for the bus controllers connections (default 0: everything is done
+#in this process). With workers, this process keeps the jmri side and hands each new bus controller
+#connection over to a worker, which parses its messages and sends the updates back (POSIX only, the
+#capture then only has the jmri side)
+
+def capture_channel(label):
+    #new capture channel for a connection, None when not capturing
+    if capture is None:
+        return None
+    return capture.open_channel(label)
+
+def capture_bytes(kind,channel,data):
+    #connections without a channel (metrics requests, worker links) are not captured
+    if capture is not None and channel is not None:
+        capture.record(kind,channel,data)
+
+def capture_close(channel):
+    if capture is not None and channel is not None:
+        capture.close_channel(channel)
+
+class traffic_counters:
+    #traffic of a bus number or of all the jmri clients
+    def __init__(self):
+        self.lines_in = 0
+        self.lines_out = 0
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.connections = 0
+        self.last_message = None
+
+    def merge(self,other):
+        self.lines_in += other.lines_in
+        self.lines_out += other.lines_out
+        self.rx_bytes += other.rx_bytes
+        self.tx_bytes += other.tx_bytes
+        if other.last_message is not None:
+            self.last_message = max(self.last_message or 0,other.last_message)
+
+class server_metrics:
+    """
+    counters of the server, read by the metrics listener. The main loop only increments counters and
+    times its passes, the rates (lines per second over the last WINDOW seconds) are computed from
+    samples of the counters taken at most once per second
+    """
+    WINDOW = 10
+
+    def __init__(self):
+        self.begin = time.monotonic()
+        self.jmri = traffic_counters()
+        self.busses = collections.defaultdict(traffic_counters)  #bus number -> counters
+        self.passes = 0
+        self.busy = 0.0  #total time spent in the passes (s)
+        self.loop = RR_duino_stats.rolling_histogram(60)
+        #(time,{name:(lines in,lines out)})
+        self.samples = collections.deque([(self.begin,{})])
+
+    def loop_pass(self,begin,end):
+        self.passes += 1
+        self.busy += end-begin
+        self.loop.add(end-begin,end)
+        if end-self.samples[-1][0] >= 1:
+            self.sample(end)
+
+    def sample(self,now):
+        counts = {str(nb):(c.lines_in,c.lines_out) for nb,c in self.busses.items()}
+        counts["jmri"] = (self.jmri.lines_in,self.jmri.lines_out)
+        self.samples.append((now,counts))
+        while len(self.samples) > 2 and now-self.samples[1][0] >= server_metrics.WINDOW:
+            self.samples.popleft()
+
+    def rates(self,name,counters,now):
+        t0,counts = self.samples[0]
+        lines_in,lines_out = counts.get(name,(0,0))
+        elapsed = now-t0
+        if elapsed <= 0:
+            return 0,0
+        return (counters.lines_in-lines_in)/elapsed,(counters.lines_out-lines_out)/elapsed
+
+    def counters_dict(self,name,counters,now):
+        rate_in,rate_out = self.rates(name,counters,now)
+        return {"lines_in":counters.lines_in,
+                "lines_out":counters.lines_out,
+                "lines_in_per_s":rate_in,
+                "lines_out_per_s":rate_out,
+                "rx_bytes":counters.rx_bytes,
+                "tx_bytes":counters.tx_bytes,
+                "connections":counters.connections,
+                "seconds_since_last_message":None if counters.last_message is None else now-counters.last_message}
+
+    def snapshot(self):
+        now = time.monotonic()
+        result = {"uptime":now-self.begin,
+                  "loop":{"passes":self.passes,"busy_seconds":self.busy,"seconds":self.loop.histogram(now).to_dict()},
+                  "layout":{"nodes":len(jmri.layout.nodes),"states":len(jmri.layout.states)},
+                  "jmri":self.counters_dict("jmri",self.jmri,now),
+                  "busses":{}}
+        result["jmri"]["clients"] = len(jmri.clients)
+        result["jmri"]["output_buffered_bytes"] = sum(len(c.output.buffer) for c in jmri.clients.values())
+        for nb,counters in sorted(self.busses.items()):
+            bus = busses_by_number.get(nb)
+            bus_result = self.counters_dict(str(nb),counters,now)
+            bus_result["connected"] = bus is not None or nb in bus_workers
+            bus_result["output_buffered_bytes"] = len(bus.output.buffer) if bus is not None else 0
+            result["busses"][str(nb)] = bus_result
+        return result
+
+def prometheus_text(snapshot):
+    #the snapshot in the Prometheus text format: the samples of each metric are grouped under its HELP and TYPE lines
+    families = {}  #metric name -> (type,help,samples), in the order of the first sample
+    def metric(name,kind,help_text,value,labels="",suffix=""):
+        if value is not None:
+            samples = families.setdefault(name,(kind,help_text,[]))[2]
+            samples.append("rrduino_%s%s%s %s" % (name,suffix,labels,repr(float(value))))
+    metric("uptime_seconds","gauge","Time since the server started",snapshot["uptime"])
+    loop = snapshot["loop"]
+    metric("loop_passes_total","counter","Passes of the main loop",loop["passes"])
+    #quantiles over the last minute, sum and count since the start
+    loop_help = "Duration of the main loop passes"
+    for key in ("p50","p90","p99"):
+        metric("loop_pass_seconds","summary",loop_help,loop["seconds"].get(key),'{quantile="0.%s"}' % key[1:])
+    metric("loop_pass_seconds","summary",loop_help,loop["busy_seconds"],suffix="_sum")
+    metric("loop_pass_seconds","summary",loop_help,loop["passes"],suffix="_count")
+    metric("loop_pass_seconds_max","gauge","Longest main loop pass of the last minute",loop["seconds"].get("max"))
+    metric("layout_nodes","gauge","Nodes declared by the bus controllers",snapshot["layout"]["nodes"])
+    metric("layout_states","gauge","Sensors and turnouts states known",snapshot["layout"]["states"])
+    groups = [("jmri","","the JMRI clients",snapshot["jmri"])]
+    groups += [("bus",'bus="%s",' % nb,"the bus controller",counters) for nb,counters in snapshot["busses"].items()]
+    for prefix,label,who,counters in groups:
+        for direction in ("in","out"):
+            labels = '{%sdirection="%s"}' % (label,direction)
+            metric(prefix+"_lines_total","counter","Lines received from (in) and sent to (out) "+who,
+                   counters["lines_"+direction],labels)
+            metric(prefix+"_lines_per_second","gauge","Lines per second from and to %s over the last %ds" % (who,server_metrics.WINDOW),
+                   counters["lines_%s_per_s" % direction],labels)
+        bytes_help = "Bytes received from (in) and sent to (out) "+who
+        metric(prefix+"_bytes_total","counter",bytes_help,counters["rx_bytes"],'{%sdirection="in"}' % label)
+        metric(prefix+"_bytes_total","counter",bytes_help,counters["tx_bytes"],'{%sdirection="out"}' % label)
+        labels = "{"+label.rstrip(",")+"}" if label else ""
+        metric(prefix+"_connections_total","counter","Connections of "+who,counters["connections"],labels)
+        metric(prefix+"_seconds_since_last_message","gauge","Time since the last line from "+who,
+               counters["seconds_since_last_message"],labels)
+        metric(prefix+"_output_buffered_bytes","gauge","Bytes waiting to be sent to "+who,counters["output_buffered_bytes"],labels)
+        if "connected" in counters:
+            metric(prefix+"_connected","gauge","1 if the bus controller is connected",counters["connected"],labels)
+    metric("jmri_clients","gauge","Connected JMRI clients",snapshot["jmri"]["clients"])
+    lines = []
+    for name,(kind,help_text,samples) in families.items():
+        lines.append("# HELP rrduino_%s %s" % (name,help_text))
+        lines.append("# TYPE rrduino_%s %s" % (name,kind))
+        lines.extend(samples)
+    return "\n".join(lines)+"\n"
+
+class net_output:
+    """
+    output buffer of a non-blocking socket: write() only queues the data, everything queued during
+    a pass of the main loop goes out in one send (flush_outputs), what the socket does not take is
+    sent when it becomes writable. A peer that lets more than MAX_BUFFERED bytes pile up is too slow:
+    write() refuses the data and returns False, the owner of the connection closes it
+    Data that is not lag (the snapshot a new client gets) is let in with allow()
+    """
+    MAX_BUFFERED = 1 << 20
+
+    def __init__(self,sock,channel,counters):
+        self.sock = sock
+        self.channel = channel
+        self.counters = counters
+        self.buffer = bytearray()
+        self.wait_writable = False
+        self.max_buffered = net_output.MAX_BUFFERED
+        #bytes at the head of the buffer allowed on top of max_buffered (see allow)
+        self.allowance = 0
+        #called when everything has been sent
+        self.on_drained = None
+        outputs[sock] = self
+
+    def write(self,data):
+        if self.sock is None:
+            #closed, the data is dropped
+            return True
+        if len(self.buffer)+len(data) > self.max_buffered+self.allowance:
+            debug("Output buffer full, peer too slow")
+            return False
+        if not self.buffer:
+            dirty_outputs.add(self)
+        self.buffer += data
+        return True
+
+    def flush(self):
+        dirty_outputs.discard(self)
+        if self.buffer:
+            try:
+                sent = self.sock.send(self.buffer)
+            except BlockingIOError:
+                sent = 0
+            except socket.error:
+                #the read side will see the deconnection
+                sent = len(self.buffer)
+            else:
+                capture_bytes(RR_duino_capture.TX,self.channel,self.buffer[:sent])
+                self.counters.tx_bytes += sent
+            del self.buffer[:sent]
+            self.allowance = max(self.allowance-sent,0)
+        if not self.buffer and self.on_drained is not None:
+            self.on_drained()
+            return
+        #wait for the socket to be writable only while there is something left
+        if bool(self.buffer) != self.wait_writable:
+            self.wait_writable = bool(self.buffer)
+            events = selectors.EVENT_READ
+            if self.wait_writable:
+                events |= selectors.EVENT_WRITE
+            selector.modify(self.sock,events,selector.get_key(self.sock).data)
+
+    def allow(self,data):
+        #queue data that does not count as lag: the peer may still lag max_buffered bytes behind it
+        self.allowance = len(self.buffer)+len(data)
+        return self.write(data)
+
+    def close(self):
+        dirty_outputs.discard(self)
+        del outputs[self.sock]
+        self.sock = None
+
+class line_framer:
+    """
+    input side of a socket: reads into the receive buffer shared by all sockets, keeps the bytes
+    of the line being received and returns the complete lines (CRLF terminated) decoded and stripped.
+    Each byte is searched for CRLF only once
+    """
+    def __init__(self,sock,channel,counters,max_length=None):
+        self.sock = sock
+        self.channel = channel
+        self.counters = counters
+        self.max_length = max_length
+        self.pending = bytearray()
+        #where to search for the next CRLF in pending
+        self.scan = 0
+
+    def read(self):
+        #returns the list of new lines, None on deconnection or a line longer than max_line_length
+        try:
+            nb = self.sock.recv_into(recv_buffer)
+        except BlockingIOError:
+            return []
+        except socket.error:
+            debug("recv error")
+            return None
+        if nb == 0:
+            return None
+        data = recv_view[:nb]
+        capture_bytes(RR_duino_capture.RX,self.channel,data)
+        self.counters.rx_bytes += nb
+        pending = self.pending
+        pending += data
+        lines = []
+        begin = 0
+        end = pending.find(b"\r\n",self.scan)
+        while end != -1:
+            line = pending[begin:end].decode('utf-8',errors='replace').strip()
+            if line:
+                lines.append(line)
+            begin = end+2
+            end = pending.find(b"\r\n",begin)
+        if begin:
+            del pending[:begin]
+        #the last byte may be the CR of the next CRLF
+        self.scan = max(len(pending)-1,0)
+        if len(pending) > (self.max_length or max_line_length):
+            debug("Line too long")
+            return None
+        if lines:
+            self.counters.lines_in += len(lines)
+            self.counters.last_message = time.monotonic()
+        return lines
+
+def flush_outputs():
+    for output in list(dirty_outputs):
+        output.flush()
 
 def pos_bits_set(bits):
     """
@@ -16,109 +301,137 @@ def pos_bits_set(bits):
     Only the 7 LSB are taken into account, MSB is always 0 and not counted in
     """
 
-    positions = []
-    bit_pos=0
-    for b in bits:
-        for pos in range(7):
-            if (b & (1 << pos))!=0:
-                positions.append(bit_pos)
-            bit_pos+=1
-    return positions
+    return RRduino.mask_positions(RRduino.bits_to_mask(bits))
 
-class JMRI_connection:
-    def __init__(self):
-        self.sock = None
-        #lists of messages to be sent to jmri (jmri may connect later)
-        self.important_msgs = []
-        self.states_msgs = []
-        #last received messages ready to be cut and decoded
-        self.last_message=""
+class JMRI_client:
+    #one connection from a jmri (or other) client
+    def __init__(self,sock,channel):
+        self.sock = sock
+        self.channel = channel
+        self.output = net_output(sock,channel,metrics.jmri)
+        self.framer = line_framer(sock,channel,metrics.jmri)
         #list of msgs from jmri
         self.msgs_list = []
 
     def read_net(self):
-        m=""
-        try:
-            m = self.sock.recv(200).decode('utf-8') #FIXME: only one jmri client is allowed for now
-        except socket.error:
-            debug("recv error")
-            #debug(len(m)," => ",m)
-        if not m:
-            #ready to read and empty msg means deconnection
+        lines = self.framer.read()
+        if lines is None:
+            #deconnection (or garbage)
             print("JMRI Client has deconnected")
-            to_read_jmri.remove(self.sock)
+            jmri.close_client(self)
         else:
-            self.last_message+=m
-            debug("received from jmri:",m)
-            
-    def flush_msgs(self):
-         #socket is ready so send everything waiting, beginning by important msgs
-
-        for m in self.important_msgs:
-            self.sock.send(m.encode('utf-8'))
-            debug("flush_msgs",m)
-        self.important_msgs = []
-        for m in self.states_msgs:
-            self.sock.send(m.encode('utf-8'))
-            debug("flush_msgs",m)
-        self.states_msgs = []
-        
-    def send_important_msg(self,msg):
-        self.important_msgs.append(msg)
-        if self.sock is not None:
-            self.flush_msgs()
-            
-    def send_states_msg(self,msg):
-        self.states_msgs.append(msg)
-        if self.sock is not None:
-            self.flush_msgs()
+            self.msgs_list.extend(lines)
+
+    def close(self):
+        self.output.close()
+        selector.unregister(self.sock)
+        self.sock.close()
+        capture_close(self.channel)
+
+    def write(self,data):
+        #returns False if the client is too slow (and has been closed)
+        if not self.output.write(data):
+            print("JMRI Client is too slow, closing its connection")
+            jmri.close_client(self)
+            return False
+        return True
 
     def process(self):
         """
         send messages from jmri to the correct RRduino bus
         """
-        if self.sock is None:
-            return
-        else:
-            self.flush_msgs()
-        if self.last_message!="":
-            sep = "\r\n"
-            while sep!="":
-                first,sep,end = self.last_message.partition(sep)
-                #debug(first,"/",sep,"/",end)
-                if sep!="":
-                    self.msgs_list.append(first.rstrip())
-                    self.last_message = end.lstrip()
-
         for msg in self.msgs_list:
             debug("processing message from jmri:",msg)
-            bus_n = get_bus_number(msg)
+            bus_n,bus_msg = parse_route(msg)
             if bus_n != -1:
-                bus = get_bus_by_number(bus_n)
+                bus = busses_by_number.get(bus_n)
                 if bus is not None:
-                    bus.send(msg)
+                    bus.send(bus_msg)
+                elif bus_n in bus_workers:
+                    bus_workers[bus_n].send_command(bus_n,bus_msg)
         self.msgs_list=[]
-    
+
+class layout_state:
+    """
+    the layout as known from the busses: the declarations of each node (NEW-NODE) and the latest
+    state of each sensor and turnout (ISRS lines). Its size is bounded by the number of objects
+    on the layout and a new jmri client gets all of it in one write
+    """
+    def __init__(self):
+        #(bus number,node address) -> NEW-TURNOUTS/NEW-SENSORS messages of the node
+        self.nodes = {}
+        #"ISRS<bus>:<node>:<subaddress>" -> latest message
+        self.states = {}
+
+    def declare_node(self,bus_nb,address,declarations):
+        #a node announcing itself again replaces its previous declarations
+        self.nodes[(bus_nb,address)] = declarations
+
+    def set_state(self,msg):
+        self.states[msg.partition(",")[0]] = msg
+
+    def snapshot(self):
+        #all declarations first (turnouts of a node before its sensors), then the states
+        return "".join(m for declarations in self.nodes.values() for m in declarations)+"".join(self.states.values())
+
+class JMRI_connection:
+    """
+    all the jmri clients: messages from the busses update the layout state, then are encoded once
+    and sent to all of them. A new client gets the snapshot of the layout state
+    """
+    def __init__(self):
+        #socket -> JMRI_client
+        self.clients = {}
+        self.layout = layout_state()
+
+    def add_client(self,client):
+        self.clients[client.sock] = client
+        snapshot = self.layout.snapshot()
+        if snapshot:
+            #the snapshot can be much bigger than the lag allowed to the client
+            client.output.allow(snapshot.encode('utf-8'))
+
+    def close_client(self,client):
+        if self.clients.pop(client.sock,None) is not None:
+            client.close()
+
+    def broadcast(self,msg):
+        metrics.jmri.lines_out += msg.count("\n")
+        data = msg.encode('utf-8')
+        for client in list(self.clients.values()):
+            client.write(data)
+
+    def declare_node(self,bus_nb,address,declarations):
+        self.layout.declare_node(bus_nb,address,declarations)
+        if self.clients:
+            self.broadcast("".join(declarations))
+
+    def send_states_msg(self,msg):
+        self.layout.set_state(msg)
+        if self.clients:
+            self.broadcast(msg)
+
+    def bus_registered(self,bus_nb):
+        #the busses are routed locally (see front_link for the workers)
+        pass
+
+    def bus_closed(self,bus_nb):
+        pass
+
 class RRduino_bus:
     def __init__(self,number,sock):
         self.number = number
         self.sock = sock
-        self.last_message = ""
+        self.channel = None
+        self.output = None
+        self.framer = None
+        #counters of this connection until it has a bus number, then the ones of its number
+        self.counters = traffic_counters()
         self.msgs_list = []
         self.auto_discover = True
         self.discover_adds=None
         self.config_loaded = False
 
-    def decode_last_message(self):
-        new = False
-        while True:
-            begin,sep,end = self.last_message.partition("\r\n")
-            if sep == "":
-                return new
-            self.msgs_list.append(begin.rstrip())
-            self.last_message = end.lstrip()
-            new = True
-
     def declare_jmri_objects(self,address,subaddresses,offset,is_turnout):
         if is_turnout:
             msg="NEW-TURNOUTS:"
@@ -127,8 +440,7 @@ class RRduino_bus:
         for s in subaddresses:
             msg+=str(self.number)+":"+str(address)+":"+str(s+offset)+" "
         msg+="\r\n"
-        
-        jmri.send_important_msg(msg)
+        return msg
 
     def get_subaddresses(self,hex_list):
         pos_bytes = [int(s,16) for s in hex_list.lstrip().split(" ")]
@@ -167,9 +479,9 @@ class RRduino_bus:
                 except:
                     debug("Error in msg",msg)
                 if bus_n>=0:
-                    self.number = bus_n
+                    register_bus(self,bus_n)
                     #send the config to the bus controller
-                    self.sock.send(self.get_config().encode('utf-8'))
+                    self.write(self.get_config())
                     debug("sending",self.get_config(),"to bus",bus_n)
             elif msg.startswith("NEW-NODE"):
                 debug("New node from",self.number,msg)
@@ -197,58 +509,36 @@ class RRduino_bus:
                 #as some sensors are actually only feedback for them, the jython script will try to associate
                 #them to the corresponding turnouts when the sensor is created.
                 #declare output sensors to JMRI script as turnouts in JMRI (subaddress+100 as number)
-                self.declare_jmri_objects(address,output_sensors_sub,100,True)
-                #declare turnouts to JMRI script as turnouts in JMRI
-                self.declare_jmri_objects(address,turnouts_sub,0,True)
-                self.declare_jmri_objects(address,input_sensors_sub,0,False)
-                #declare output sensors feedback to JMRI script as sensors in JMRI (subaddress+200 as number)
-                self.declare_jmri_objects(address,output_sensors_sub,200,False)
-                #declare turnout sensors feedback to JMRI script as sensors in JMRI (subaddress+100 as number)
-                self.declare_jmri_objects(address,turnouts_sub,100,False)
+                declarations = [self.declare_jmri_objects(address,output_sensors_sub,100,True),
+                                #declare turnouts to JMRI script as turnouts in JMRI
+                                self.declare_jmri_objects(address,turnouts_sub,0,True),
+                                self.declare_jmri_objects(address,input_sensors_sub,0,False),
+                                #declare output sensors feedback to JMRI script as sensors in JMRI (subaddress+200 as number)
+                                self.declare_jmri_objects(address,output_sensors_sub,200,False),
+                                #declare turnout sensors feedback to JMRI script as sensors in JMRI (subaddress+100 as number)
+                                self.declare_jmri_objects(address,turnouts_sub,100,False)]
+                jmri.declare_node(self.number,address,declarations)
                 
                 #merge input and output sensors subaddresses in one list
                 all_sensors_sub = input_sensors_sub[:]
                 all_sensors_sub.extend(output_sensors_sub)
                 all_sensors_sub.sort()
-                index = 0
                 #generate a message for each sensor to signal its initial state
                 debug("----------------------------Initial states----------------------")
-                for state in sensors_states:
-                    for bit_pos in range(7):
-                        if index>=(len(input_sensors_sub)+len(output_sensors_sub)):
-                            #we have checked state for all sensors
-                            break
-                        #get bit value
-                        value = (state & (1<<bit_pos))
-                        if value!=0:
-                            #normalize value
-                            value=1
-                        subaddress = all_sensors_sub[index]
-                        if subaddress in output_sensors_sub:
-                            #it is an output sensor for RRduino, translate to a turnout for jmri (number=subaddress+200)
-                            subaddress+=200
-                        self.msgs_list.append("ISRS"+str(address)+":"+str(subaddress)+","+str(value))
-                        debug("ISRS"+str(address)+":"+str(subaddress)+","+str(value))
-                        index+=1
-                    if index>=(len(input_sensors_sub)+len(output_sensors_sub)):
-                        #we have checked state for all sensors
-                        break
+                sensors_mask = RRduino.bits_to_mask(sensors_states)
+                for index,subaddress in enumerate(all_sensors_sub):
+                    value = (sensors_mask >> index) & 0x01
+                    if subaddress in output_sensors_sub:
+                        #it is an output sensor for RRduino, translate to a turnout for jmri (number=subaddress+200)
+                        subaddress+=200
+                    self.msgs_list.append("ISRS"+str(address)+":"+str(subaddress)+","+str(value))
+                    debug("ISRS"+str(address)+":"+str(subaddress)+","+str(value))
                 #same for turnouts
-                index=0
-                for state in turnouts_states:
-                    for bit_pos in range(7):
-                        if index>=len(turnouts_sub):
-                            #we have checked state for all turnouts
-                            break
-                        #get bit value
-                        value = (state & (1<<bit_pos))
-                        if value!=0:
-                            #normalize value
-                            value=1
-                        subaddress = turnouts_sub[index]
-                        self.msgs_list.append("ISRS"+str(address)+":"+str(subaddress+100)+","+str(value))
-                        debug("ISRS"+str(address)+":"+str(subaddress+100)+","+str(value))
-                        index+=1
+                turnouts_mask = RRduino.bits_to_mask(turnouts_states)
+                for index,subaddress in enumerate(turnouts_sub):
+                    value = (turnouts_mask >> index) & 0x01
+                    self.msgs_list.append("ISRS"+str(address)+":"+str(subaddress+100)+","+str(value))
+                    debug("ISRS"+str(address)+":"+str(subaddress+100)+","+str(value))
 
                 debug("------------------------End of initial states--------------------")
                 debug(input_sensors_sub)
@@ -263,30 +553,57 @@ class RRduino_bus:
                 debug("Sending",to_send,"to jmri")
         self.msgs_list = []
 
+    def write(self,msg):
+        if not self.output.write(msg.encode('utf-8')):
+            print("BUS Client",self.number,"is too slow, closing its connection")
+            close_bus(self.sock)
+
     def send(self,msg):
-        #strip the bus number out of the msg
-        msg = msg[:4] + msg[msg.find(":")+1:]
-        self.sock.send((msg+"\r\n").encode('utf-8'))
+        #msg is already stripped of the bus number (see parse_route)
+        self.counters.lines_out += 1
+        self.write(msg+"\r\n")
         debug("Sending",msg,"to bus number",self.number)
         
 
-def get_bus_by_number(bus_nb):
-    for sock in busses:
-        if busses[sock].number == bus_nb:
-            return busses[sock]
-    return None
-
-def get_bus_number(msg):
-    index = msg.find(":")
-    if index==-1:
-        debug("No bus number in msg from jmri!",msg)
-        return -1
-    try:
-        bus_int = int(msg[4:index])
-    except:
-        debug("Bad bus number in msg from jmri!",msg)
-        return -1
-    return bus_int
+def register_bus(bus,bus_nb):
+    """
+    index bus under its number, when another connection already has this number the new one
+    takes over (a bus controller that rebooted can reconnect before its old connection times out)
+    and the old one is closed
+    """
+    if bus.number is not None and busses_by_number.get(bus.number) is bus:
+        del busses_by_number[bus.number]
+    old = busses_by_number.get(bus_nb)
+    if old is not None and old is not bus:
+        debug("Bus number",bus_nb,"registered again, closing its previous connection")
+        close_bus(old.sock)
+    worker = bus_workers.pop(bus_nb,None)
+    if worker is not None:
+        #served here when no worker could take the connection, the one a worker has is closed
+        debug("Bus number",bus_nb,"registered again, closing its previous connection")
+        worker.output.write(b"X%d\r\n" % bus_nb)
+    counters = metrics.busses[bus_nb]
+    if bus.number is None:
+        counters.merge(bus.counters)
+    counters.connections += 1
+    bus.counters = bus.output.counters = bus.framer.counters = counters
+    bus.number = bus_nb
+    busses_by_number[bus_nb] = bus
+    jmri.bus_registered(bus_nb)
+
+#messages from jmri: 4 chars command, bus number, ":", then the message for the bus
+route_re = re.compile(r"(.{4})\s*(\d+)\s*:")
+
+def parse_route(msg):
+    """
+    returns (bus number,message for the bus) where the message is msg without the bus number
+    or (-1,None) if there is no valid bus number in msg
+    """
+    m = route_re.match(msg)
+    if m is None:
+        debug("No or bad bus number in msg from jmri!",msg)
+        return -1,None
+    return int(m.group(2)),m.group(1)+msg[m.end():]
 
 def debug(*args):
     print(*args)
@@ -333,11 +650,32 @@ else:
 if config is None:
     quit()
 
+capture = None
+if config.get("capture_file"):
+    capture = RR_duino_capture.capture_writer(config["capture_file"])
+    atexit.register(capture.close)
+
+def terminate(signum,frame):
+    #stopped by SIGTERM (kill, service stop): exit normally so that the capture file is closed
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM,terminate)
+
+metrics = server_metrics()
+
+#receive buffer shared by all sockets (see line_framer)
+recv_buffer = bytearray(config.get("receive_buffer_size",65536))
+recv_view = memoryview(recv_buffer)
+max_line_length = config.get("max_line_length",4096)
+
 #server connection
 jmri_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+#allow an immediate restart of the server (the closed connections stay in TIME_WAIT)
+jmri_server_sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
 server_add = config["listening_ip"]
 jmri_server_sock.bind((server_add, config["jmri_port"]))
 busses_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+busses_server_sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
 busses_server_sock.bind((server_add, config["rrduino_busses_port"]))
 debug("RR_duino_monitor listening on ",server_add," at ports ",config["jmri_port"],"and",config["rrduino_busses_port"])
 jmri_server_sock.listen(5)
@@ -345,53 +683,389 @@ busses_server_sock.listen(5)
 
 #list of existing busses
 busses = {}
-
-#sockets to read
-to_read_jmri=[jmri_server_sock]
-to_read_busses=[busses_server_sock]
+#busses by number (once they have sent their RRDUINO-BUS line)
+busses_by_number = {}
+#socket -> net_output, and the outputs with data queued during the current pass
+outputs = {}
+dirty_outputs = set()
 
 jmri = JMRI_connection()
 
-while True:
-    #first check network connections JMRI first
-    ready_to_read,ready_to_write,in_error = select.select(to_read_jmri,[],[],timeout)
-    if jmri_server_sock in ready_to_read:
-        jmri.sock,addr = jmri_server_sock.accept()
-        jmri_add  = (str(addr).split("'"))[1]
-        debug("Got a JMRI connection from", jmri_add)
-        ready_to_read.remove(jmri_server_sock)
-        to_read_jmri.append(jmri.sock)
-    #check if we got something from jmri (through net)
-    if jmri.sock in ready_to_read:
-        jmri.read_net()
-
-    jmri.process()
-
-    #next connections from the RRduino busses
-    ready_to_read,ready_to_write,in_error = select.select(to_read_busses,[],[],timeout)
-    if busses_server_sock in ready_to_read:
-        bus_sock,addr = busses_server_sock.accept()
-        add  = (str(addr).split("'"))[1]
-        debug("Got a BUS connection from", add)
-        ready_to_read.remove(busses_server_sock)
-        to_read_busses.append(bus_sock)
-        #add bus the busses dictionnary, to be filled correctly later on
-        busses[bus_sock]=RRduino_bus(None,bus_sock)
-        
-    #check if we got something from busses
-    for sock in ready_to_read:
-        m=""
+def accept_jmri(server_sock):
+    sock,addr = server_sock.accept()
+    sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    sock.setblocking(False)
+    jmri_add  = (str(addr).split("'"))[1]
+    debug("Got a JMRI connection from", jmri_add)
+    selector.register(sock,selectors.EVENT_READ,read_jmri)
+    metrics.jmri.connections += 1
+    #gets the current layout state
+    jmri.add_client(JMRI_client(sock,capture_channel("jmri:"+jmri_add)))
+
+def read_jmri(sock):
+    client = jmri.clients.get(sock)
+    if client is None:
+        #closed earlier in this pass
+        return
+    client.read_net()
+    if sock in jmri.clients:
+        client.process()
+
+def accept_bus(server_sock):
+    bus_sock,addr = server_sock.accept()
+    add  = (str(addr).split("'"))[1]
+    debug("Got a BUS connection from", add)
+    if workers:
+        #the worker that gets it is chosen in turn, the routing follows the bus number once registered
+        turn = next(worker_turn)
+        for worker in [workers[(turn+i) % len(workers)] for i in range(len(workers))]:
+            if worker.hand_over(bus_sock,add):
+                bus_sock.close()
+                return
+        print("No worker could take the BUS connection from",add,"serving it here")
+    new_bus(bus_sock,add)
+
+def new_bus(bus_sock,add):
+    bus_sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    bus_sock.setblocking(False)
+    #add bus the busses dictionnary, to be filled correctly later on
+    busses[bus_sock]=RRduino_bus(None,bus_sock)
+    busses[bus_sock].channel = capture_channel("bus:"+add)
+    busses[bus_sock].output = net_output(bus_sock,busses[bus_sock].channel,busses[bus_sock].counters)
+    busses[bus_sock].framer = line_framer(bus_sock,busses[bus_sock].channel,busses[bus_sock].counters)
+    selector.register(bus_sock,selectors.EVENT_READ,read_bus)
+
+def read_bus(sock):
+    if sock not in busses:
+        #closed earlier in this pass
+        return
+    bus = busses[sock]
+    lines = bus.framer.read()
+    if lines is None:
+        #deconnection (or garbage)
+        print("BUS Client",bus.number,"has deconnected")
+        close_bus(sock)
+    elif lines:
+        bus.msgs_list.extend(lines)
+        bus.process()
+
+def close_bus(sock):
+    bus = busses.pop(sock)
+    bus.output.close()
+    if busses_by_number.get(bus.number) is bus:
+        del busses_by_number[bus.number]
+        jmri.bus_closed(bus.number)
+    capture_close(bus.channel)
+    selector.unregister(sock)
+    sock.close()
+
+#metrics listener: one HTTP request per connection, answered from the main loop
+metrics_requests = {}  #socket -> bytes of the request received so far
+
+def accept_metrics(server_sock):
+    sock,addr = server_sock.accept()
+    sock.setblocking(False)
+    metrics_requests[sock] = bytearray()
+    selector.register(sock,selectors.EVENT_READ,read_metrics)
+
+def read_metrics(sock):
+    if sock not in metrics_requests:
+        #answer being sent, what the client sends now is ignored
         try:
-            m = sock.recv(200).decode('utf-8') #FIXME
+            data = sock.recv(4096)
         except socket.error:
-            debug("recv error")
-            #debug(len(m)," => ",m)
-        if not m:
-            #ready to read and empty msg means deconnection
-            print("BUS Client",busses[sock].number,"has deconnected")
-            del busses[sock]
-            to_read_busses.remove(sock)
-        else:
-            busses[sock].last_message+=m
-            if busses[sock].decode_last_message():
-                busses[sock].process()
+            data = b""
+        if not data:
+            close_metrics(sock)
+        return
+    request = metrics_requests[sock]
+    try:
+        data = sock.recv(4096)
+    except socket.error:
+        data = b""
+    if not data or len(request)+len(data) > 16384:
+        close_metrics(sock)
+        return
+    request += data
+    if b"\r\n\r\n" not in request and b"\n\n" not in request:
+        return
+    parts = bytes(request).split(None,2)
+    path = parts[1].decode(errors="replace") if len(parts) > 1 else ""
+    if path == "/metrics":
+        status,content_type,body = "200 OK","text/plain; version=0.0.4",prometheus_text(metrics.snapshot())
+    elif path == "/json":
+        status,content_type,body = "200 OK","application/json",json.dumps(metrics.snapshot())
+    else:
+        status,content_type,body = "404 Not Found","text/plain","try /metrics or /json\n"
+    body = body.encode('utf-8')
+    header = "HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status,content_type,len(body))
+    #stop reading, the connection is closed once the answer is sent
+    del metrics_requests[sock]
+    output = net_output(sock,None,traffic_counters())
+    output.on_drained = lambda: close_metrics(sock)
+    output.write(header.encode('utf-8')+body)
+
+def close_metrics(sock):
+    metrics_requests.pop(sock,None)
+    if sock in outputs:
+        outputs[sock].close()
+    selector.unregister(sock)
+    sock.close()
+
+#worker processes
+#the records between the front process and a worker are lines (CRLF):
+#to the worker: R<bus number> <message for the bus>, X<bus number> (close the connection of this bus)
+#to the front: S<state message>, D<json [bus number,address,declarations]>, B<bus number> (registered),
+#C<bus number> (closed), M<json {bus number:[lines in,lines out,rx bytes,tx bytes,connections
+#counted since the previous M record,seconds since last message]}>
+#the bus controllers connections are passed with their address on a second (SOCK_SEQPACKET) socket
+LINK_MAX_BUFFERED = 1 << 26
+#send buffer of the connections link: a few tens of connections can wait for a worker that is not reading
+FD_LINK_SNDBUF = 1 << 13
+
+class bus_worker:
+    #in the front process: a worker process and the links to it
+    def __init__(self,pid,link,fd_link):
+        self.pid = pid
+        self.link = link
+        self.fd_link = fd_link
+        self.counters = traffic_counters()
+
+    def start(self):
+        self.link.setblocking(False)
+        #a worker that does not take its connections must not block the front process
+        self.fd_link.setblocking(False)
+        self.fd_link.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,FD_LINK_SNDBUF)
+        selector.register(self.link,selectors.EVENT_READ,read_worker)
+        self.output = net_output(self.link,None,self.counters)
+        self.output.max_buffered = LINK_MAX_BUFFERED
+        self.framer = line_framer(self.link,None,self.counters,LINK_MAX_BUFFERED)
+
+    def hand_over(self,sock,add):
+        #False when the worker cannot take the connection: it is gone (and dropped) or not reading
+        try:
+            socket.send_fds(self.fd_link,[add.encode()],[sock.fileno()])
+        except BlockingIOError:
+            print("Worker",self.pid,"is not taking its connections")
+            return False
+        except OSError as e:
+            print("Worker",self.pid,"has stopped:",e)
+            drop_worker(self)
+            return False
+        return True
+
+    def send_command(self,bus_nb,msg):
+        self.output.write(("R%d %s\r\n" % (bus_nb,msg)).encode('utf-8'))
+
+    def process(self,record):
+        kind,data = record[0],record[1:]
+        if kind == "S":
+            jmri.send_states_msg(data+"\r\n")
+        elif kind == "D":
+            bus_nb,address,declarations = json.loads(data)
+            jmri.declare_node(bus_nb,address,declarations)
+        elif kind == "B":
+            bus_nb = int(data)
+            old = bus_workers.get(bus_nb)
+            if old is not None and old is not self:
+                debug("Bus number",bus_nb,"registered again, closing its previous connection")
+                old.output.write(b"X%d\r\n" % bus_nb)
+            local = busses_by_number.get(bus_nb)
+            if local is not None:
+                debug("Bus number",bus_nb,"registered again, closing its previous connection")
+                close_bus(local.sock)
+            bus_workers[bus_nb] = self
+            #the counters come with the next M record
+            metrics.busses[bus_nb]
+        elif kind == "C":
+            if bus_workers.get(int(data)) is self:
+                del bus_workers[int(data)]
+        elif kind == "M":
+            now = time.monotonic()
+            for nb,values in json.loads(data).items():
+                #counts since the previous report: they add up whatever worker has (or had) the bus
+                delta = traffic_counters()
+                delta.lines_in,delta.lines_out,delta.rx_bytes,delta.tx_bytes,delta.connections,age = values
+                delta.last_message = None if age is None else now-age
+                counters = metrics.busses[int(nb)]
+                counters.merge(delta)
+                counters.connections += delta.connections
+
+def read_worker(sock):
+    worker = worker_links[sock]
+    records = worker.framer.read()
+    if records is None:
+        print("Worker",worker.pid,"has stopped")
+        drop_worker(worker)
+        return
+    for record in records:
+        worker.process(record)
+
+def drop_worker(worker):
+    """
+    remove a stopped worker from the pool, its bus controllers lost their connections with it:
+    they reconnect and are handed over to the remaining workers (or served by the front process)
+    """
+    if worker not in workers:
+        return
+    for bus_nb in [nb for nb,w in bus_workers.items() if w is worker]:
+        del bus_workers[bus_nb]
+    workers.remove(worker)
+    del worker_links[worker.link]
+    worker.output.close()
+    selector.unregister(worker.link)
+    worker.link.close()
+    worker.fd_link.close()
+
+class front_link:
+    """
+    in a worker process: stands for the jmri side, the updates from the busses are sent to the
+    front process, which keeps the layout state and the jmri clients
+    """
+    REPORT_PERIOD = 1.0
+
+    def __init__(self,link):
+        self.link = link
+        link.setblocking(False)
+        self.counters = traffic_counters()
+        self.output = net_output(link,None,self.counters)
+        self.output.max_buffered = LINK_MAX_BUFFERED
+        self.framer = line_framer(link,None,self.counters,LINK_MAX_BUFFERED)
+        self.last_report = 0
+        #bus number -> counts sent in the previous reports
+        self.reported = {}
+
+    def record(self,text):
+        if not self.output.write((text+"\r\n").encode('utf-8')):
+            print("Front process is not reading, stopping the worker")
+            os._exit(1)
+
+    def declare_node(self,bus_nb,address,declarations):
+        self.record("D"+json.dumps([bus_nb,address,declarations]))
+
+    def send_states_msg(self,msg):
+        self.record("S"+msg.rstrip("\r\n"))
+
+    def bus_registered(self,bus_nb):
+        self.record("B%d" % bus_nb)
+
+    def bus_closed(self,bus_nb):
+        self.record("C%d" % bus_nb)
+
+    def report(self):
+        #what the counters of the busses of this worker gained since the last report, at most once per REPORT_PERIOD
+        now = time.monotonic()
+        if now-self.last_report < front_link.REPORT_PERIOD:
+            return
+        self.last_report = now
+        changes = {}
+        for nb,c in metrics.busses.items():
+            counts = (c.lines_in,c.lines_out,c.rx_bytes,c.tx_bytes,c.connections)
+            previous = self.reported.get(nb,(0,0,0,0,0))
+            if counts != previous:
+                changes[str(nb)] = [count-before for count,before in zip(counts,previous)]+[None if c.last_message is None else now-c.last_message]
+                self.reported[nb] = counts
+        if changes:
+            self.record("M"+json.dumps(changes))
+
+def read_front(sock):
+    records = jmri.framer.read()
+    if records is None:
+        #the front process is gone
+        os._exit(0)
+    for record in records:
+        if record[0] == "R":
+            bus_nb,_,msg = record[1:].partition(" ")
+            bus = busses_by_number.get(int(bus_nb))
+            if bus is not None:
+                bus.send(msg)
+        elif record[0] == "X":
+            bus = busses_by_number.get(int(record[1:]))
+            if bus is not None:
+                close_bus(bus.sock)
+
+def receive_bus(fd_link):
+    add,fds,flags,addr = socket.recv_fds(fd_link,1024,1)
+    if not fds:
+        #the front process is gone
+        os._exit(0)
+    new_bus(socket.socket(fileno=fds[0]),add.decode())
+
+def start_worker():
+    global selector,jmri,capture,metrics,outputs,dirty_outputs
+    link,worker_link = socket.socketpair()
+    fd_link,worker_fd_link = socket.socketpair(socket.AF_UNIX,socket.SOCK_SEQPACKET)
+    pid = os.fork()
+    if pid != 0:
+        worker_link.close()
+        worker_fd_link.close()
+        return bus_worker(pid,link,fd_link)
+    #worker process: keep only its links
+    link.close()
+    fd_link.close()
+    jmri_server_sock.close()
+    busses_server_sock.close()
+    for worker in workers:
+        worker.link.close()
+        worker.fd_link.close()
+    #the capture file belongs to the front process, a worker must not flush its copy of the buffer on exit
+    capture = None
+    signal.signal(signal.SIGTERM,signal.SIG_DFL)
+    metrics = server_metrics()
+    outputs = {}
+    dirty_outputs = set()
+    selector = selectors.DefaultSelector()
+    selector.register(worker_link,selectors.EVENT_READ,read_front)
+    selector.register(worker_fd_link,selectors.EVENT_READ,receive_bus)
+    jmri = front_link(worker_link)
+    try:
+        run_loop(front_link.REPORT_PERIOD,jmri.report)
+    except KeyboardInterrupt:
+        pass
+    os._exit(0)
+
+def run_loop(timeout=None,after_pass=None):
+    #one loop for all sockets: it sleeps until one of them is ready and calls its handler
+    registered = selector.get_map()
+    while True:
+        ready = selector.select(timeout)
+        begin = time.monotonic()
+        for key,events in ready:
+            if events & selectors.EVENT_WRITE and key.fileobj in outputs:
+                outputs[key.fileobj].flush()
+            if events & selectors.EVENT_READ:
+                #the socket may have been closed earlier in this pass (by the flush above for instance)
+                current = registered.get(key.fd)
+                if current is not None and current.fileobj is key.fileobj:
+                    current.data(key.fileobj)
+        if after_pass is not None:
+            after_pass()
+        #everything queued during this pass goes out now, one send per socket
+        flush_outputs()
+        metrics.loop_pass(begin,time.monotonic())
+
+#bus number -> bus_worker, and the link sockets of the workers
+bus_workers = {}
+workers = []
+for i in range(config.get("workers",0)):
+    workers.append(start_worker())
+worker_links = {worker.link:worker for worker in workers}
+worker_turn = itertools.count()
+
+selector = selectors.DefaultSelector()
+for worker in workers:
+    worker.start()
+selector.register(jmri_server_sock,selectors.EVENT_READ,accept_jmri)
+selector.register(busses_server_sock,selectors.EVENT_READ,accept_bus)
+if config.get("metrics_port"):
+    metrics_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    metrics_server_sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    metrics_server_sock.bind((config.get("metrics_ip","127.0.0.1"),config["metrics_port"]))
+    metrics_server_sock.listen(5)
+    selector.register(metrics_server_sock,selectors.EVENT_READ,accept_metrics)
+
+if capture is not None:
+    #wake up regularly so that the capture of an idle traffic reaches the file
+    run_loop(RR_duino_capture.capture_writer.FLUSH_PERIOD/2,capture.flush_due)
+else:
+    run_loop()
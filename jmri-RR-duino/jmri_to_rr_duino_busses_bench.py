@@ -0,0 +1,271 @@
+"""
+End to end benchmark of jmri_to_rr_duino_busses.py, no hardware needed
+
+Starts the server on localhost (or uses a running one with -a), connects an emulated JMRI client
+then K emulated bus controllers speaking the bus controllers line protocol (RRDUINO-BUS, NEW-NODE,
+ISRS), each one with N nodes of M objects (half input sensors, half turnouts,
+each kind numbered from subaddress 1 so up to 63 + 63).
+Once JMRI has received all the declarations and initial states (setup time), the bus controllers
+send sensor changes at the given rate per bus (in bursts of -B events) while JMRI sends turnout
+commands at the given rate. Each change and each command is timed until the other side receives it.
+The result is one JSON object:
+{"busses":K, "nodes":N, "objects":M, "setup_s":..., "events":{...}, "commands":{...}, "server":{...}}
+where events and commands have the numbers sent and received, the throughput and the latency
+percentiles (p50, p99, p999, max in s), server has the metrics of the server when it has a metrics
+port (see jmri_to_rr_duino_busses.py, always the case when the bench starts it).
+
+usage: python3 jmri_to_rr_duino_busses_bench.py [-k busses] [-n nodes] [-m objects] [-r rate] [-B burst]
+                                                 [-c commands_rate] [-d duration] [-x key=value ...]
+                                                 [-a host:jmri_port:busses_port[:metrics_port]] [-o output_file]
+"""
+import argparse,collections,json,os,random,selectors,socket,subprocess,sys,tempfile,time,urllib.request
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),"jmri_to_rr_duino_busses.py")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1",0))
+        return s.getsockname()[1]
+
+def connect(host,port,timeout=5):
+    #connect, retrying while the server starts
+    deadline = time.monotonic()+timeout
+    while True:
+        try:
+            sock = socket.create_connection((host,port))
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    return sock
+
+def hex_bits(subaddresses):
+    #NEW-NODE field: bit subaddress-1 set for each subaddress, 7 bits per byte, in hex
+    mask = 0
+    for subadd in subaddresses:
+        mask |= 1 << (subadd-1)
+    nb_bytes = max((mask.bit_length()+6)//7,1)
+    return " ".join("%02X" % ((mask >> (7*i)) & 0x7F) for i in range(nb_bytes))
+
+def percentiles(values):
+    if not values:
+        return {"count":0}
+    values = sorted(values)
+    pick = lambda p: values[min(int(p*len(values)),len(values)-1)]
+    return {"count":len(values),"p50":pick(0.5),"p99":pick(0.99),"p999":pick(0.999),"max":values[-1]}
+
+class line_reader:
+    #complete lines received on a socket
+    def __init__(self,sock):
+        self.sock = sock
+        self.pending = b""
+
+    def read(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        lines = (self.pending+data).split(b"\r\n")
+        self.pending = lines.pop()
+        return lines
+
+class emulated_bus:
+    def __init__(self,number,nodes,objects,host,port):
+        self.number = number
+        self.sensors = list(range(1,(objects+1)//2+1))  #sensors and turnouts have their own subaddresses
+        self.turnouts = list(range(1,objects-len(self.sensors)+1))
+        self.nodes = list(range(1,nodes+1))
+        self.values = {}  #(node,sensor) -> value
+        self.sock = connect(host,port)
+        self.reader = line_reader(self.sock)
+        self.sock.sendall(b"RRDUINO-BUS %d\r\n" % number)
+
+    def announce(self):
+        lines = []
+        for node in self.nodes:
+            lines.append("NEW-NODE:%d,%s,00,%s,00,00\r\n" % (node,hex_bits(self.sensors),hex_bits(self.turnouts)))
+            for sensor in self.sensors:
+                self.values[(node,sensor)] = 0
+        self.sock.sendall("".join(lines).encode())
+
+    def changes(self,nb):
+        #nb random sensor changes: list of (key as seen by jmri,line to send)
+        result = []
+        for i in range(nb):
+            node = random.choice(self.nodes)
+            sensor = random.choice(self.sensors)
+            value = self.values[(node,sensor)] ^ 1
+            self.values[(node,sensor)] = value
+            result.append(("ISRS%d:%d:%d" % (self.number,node,sensor),"ISRS%d:%d,%d\r\n" % (node,sensor,value)))
+        return result
+
+class bench:
+    def __init__(self,args,host,jmri_port,busses_port):
+        self.args = args
+        self.selector = selectors.DefaultSelector()
+        self.jmri = connect(host,jmri_port)
+        self.jmri_reader = line_reader(self.jmri)
+        self.selector.register(self.jmri,selectors.EVENT_READ,None)
+        self.busses = [emulated_bus(nb,args.nodes,args.objects,host,busses_port) for nb in range(1,args.busses+1)]
+        for bus in self.busses:
+            self.selector.register(bus.sock,selectors.EVENT_READ,bus)
+        #send times of the changes and commands not received yet, by object
+        self.events = collections.defaultdict(collections.deque)
+        self.commands = collections.defaultdict(collections.deque)
+        self.events_latency = []
+        self.commands_latency = []
+        self.events_sent = 0
+        self.commands_sent = 0
+        self.states_received = 0
+
+    def read_jmri(self):
+        now = time.perf_counter()
+        for line in self.jmri_reader.read():
+            if line.startswith(b"ISRS"):
+                self.states_received += 1
+                key = line.partition(b",")[0].decode()
+                pending = self.events.get(key)
+                if pending:
+                    self.events_latency.append(now-pending.popleft())
+
+    def read_bus(self,bus):
+        now = time.perf_counter()
+        for line in bus.reader.read():
+            if line.startswith(b"ITRT"):
+                pending = self.commands.get((bus.number,line.partition(b",")[0].decode()))
+                if pending:
+                    self.commands_latency.append(now-pending.popleft())
+
+    def poll(self,timeout):
+        for key,events in self.selector.select(max(timeout,0)):
+            if key.data is None:
+                self.read_jmri()
+            else:
+                self.read_bus(key.data)
+
+    def setup(self):
+        #announce all nodes, wait for jmri to get all initial states (one per sensor and per turnout)
+        expected = sum(len(bus.nodes)*(len(bus.sensors)+len(bus.turnouts)) for bus in self.busses)
+        begin = time.perf_counter()
+        for bus in self.busses:
+            bus.announce()
+        deadline = begin+60
+        while self.states_received < expected and time.perf_counter() < deadline:
+            self.poll(0.1)
+        if self.states_received < expected:
+            raise TimeoutError("jmri got %d initial states out of %d" % (self.states_received,expected))
+        self.states_received = 0
+        return time.perf_counter()-begin
+
+    def run(self):
+        args = self.args
+        begin = time.perf_counter()
+        end = begin+args.duration
+        #time of the next burst of each bus (spread over the first period) and of the next command
+        period = args.burst/args.rate if args.rate > 0 else None
+        next_burst = [begin+period*random.random() if period else None for bus in self.busses]
+        next_command = begin if args.commands_rate > 0 else None
+        targets = [(bus,node,turnout) for bus in self.busses for node in bus.nodes for turnout in bus.turnouts]
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            for i,bus in enumerate(self.busses):
+                if next_burst[i] is not None and now >= next_burst[i]:
+                    changes = bus.changes(args.burst)
+                    sent = time.perf_counter()
+                    bus.sock.sendall("".join(line for key,line in changes).encode())
+                    for key,line in changes:
+                        self.events[key].append(sent)
+                    self.events_sent += len(changes)
+                    next_burst[i] += period
+            while next_command is not None and now >= next_command and targets:
+                bus,node,turnout = random.choice(targets)
+                self.commands[(bus.number,"ITRT%d:%d" % (node,turnout))].append(time.perf_counter())
+                self.jmri.sendall(b"ITRT%d:%d:%d,%d\r\n" % (bus.number,node,turnout,random.randint(0,1)))
+                self.commands_sent += 1
+                next_command += 1/args.commands_rate
+            deadlines = [t for t in next_burst+[next_command,end] if t is not None]
+            self.poll(min(deadlines)-time.perf_counter())
+        elapsed = time.perf_counter()-begin
+        #let the last messages arrive
+        drain = time.perf_counter()+1
+        while time.perf_counter() < drain and (len(self.events_latency) < self.events_sent or len(self.commands_latency) < self.commands_sent):
+            self.poll(drain-time.perf_counter())
+        return elapsed
+
+    def close(self):
+        self.jmri.close()
+        for bus in self.busses:
+            bus.sock.close()
+
+def result_dict(sent,latencies,elapsed):
+    return {"sent":sent,"received":len(latencies),"per_s":len(latencies)/elapsed,"latency":percentiles(latencies)}
+
+def main():
+    parser = argparse.ArgumentParser(description="end to end benchmark of jmri_to_rr_duino_busses.py")
+    parser.add_argument("-k","--busses",type=int,default=10,help="number of bus controllers")
+    parser.add_argument("-n","--nodes",type=int,default=10,help="nodes per bus")
+    parser.add_argument("-m","--objects",type=int,default=16,help="objects per node (half sensors, half turnouts, 126 max)")
+    parser.add_argument("-r","--rate",type=float,default=100,help="sensor changes per second per bus")
+    parser.add_argument("-B","--burst",type=int,default=1,help="sensor changes sent together")
+    parser.add_argument("-c","--commands-rate",type=float,default=100,help="turnout commands per second from jmri")
+    parser.add_argument("-d","--duration",type=float,default=10,help="duration of the measure (s)")
+    parser.add_argument("-x","--config",action="append",default=[],help="key=value (JSON value) added to the server config")
+    parser.add_argument("-a","--attach",help="host:jmri_port:busses_port[:metrics_port] of a running server")
+    parser.add_argument("-o","--output",help="file to append the result to (JSON lines)")
+    args = parser.parse_args()
+    if not 2 <= args.objects <= 126:
+        parser.error("objects must be between 2 and 126")
+
+    server = None
+    cfg_file = None
+    metrics_port = None
+    if args.attach:
+        parts = args.attach.split(":")
+        host,jmri_port,busses_port = parts[0],int(parts[1]),int(parts[2])
+        if len(parts) > 3:
+            metrics_port = int(parts[3])
+    else:
+        host = "127.0.0.1"
+        jmri_port,busses_port,metrics_port = free_port(),free_port(),free_port()
+        config = {"listening_ip":host,"jmri_port":jmri_port,"rrduino_busses_port":busses_port,"metrics_port":metrics_port}
+        for item in args.config:
+            key,_,value = item.partition("=")
+            config[key] = json.loads(value)
+        with tempfile.NamedTemporaryFile("w",suffix=".cfg",delete=False) as f:
+            json.dump(config,f)
+            cfg_file = f.name
+        #the server prints every message, that is part of its cost but not of the output
+        server = subprocess.Popen([sys.executable,SERVER,cfg_file],stdout=subprocess.DEVNULL)
+    try:
+        b = bench(args,host,jmri_port,busses_port)
+        try:
+            setup = b.setup()
+            elapsed = b.run()
+        finally:
+            b.close()
+        result = {"busses":args.busses,"nodes":args.nodes,"objects":args.objects,
+                  "rate":args.rate,"burst":args.burst,"commands_rate":args.commands_rate,
+                  "setup_s":setup,
+                  "events":result_dict(b.events_sent,b.events_latency,elapsed),
+                  "commands":result_dict(b.commands_sent,b.commands_latency,elapsed)}
+        if metrics_port:
+            with urllib.request.urlopen("http://%s:%d/json" % (host,metrics_port)) as answer:
+                metrics = json.load(answer)
+            result["server"] = {"loop":metrics["loop"],"jmri":metrics["jmri"]}
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if cfg_file is not None:
+            os.remove(cfg_file)
+
+    out = open(args.output,"a") if args.output else sys.stdout
+    out.write(json.dumps(result)+"\n")
+    if out is not sys.stdout:
+        out.close()
+
+if __name__ == "__main__":
+    main()
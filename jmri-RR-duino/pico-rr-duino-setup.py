@@ -4,8 +4,8 @@ from picotui.screen import Screen
 from picotui.widgets import *
 from picotui.defs import *
 import RR_duino_messages as RRduino
+import RR_duino_transactions
 
-ANSWER_TIMEOUT = 5
 TURNOUT_TUNE_TIMEOUT = 5
 
 def set_status(status):    
@@ -31,24 +31,14 @@ def eeprom_status_str():
 def set_eeprom_status(eeprom_status):
     eeprom_status.t=eeprom_status_str()
     
-def wait_for_answer(length):
-    m=b""
-    beg = time.time()
-    #print("wait for answser...",end="")
-    while (len(m)<length) and time.time()<beg+ANSWER_TIMEOUT:
-        s.process_IO()
-        if s.available():
-            m+=s.read()
-            #print(RRduino.hex_int(m[-1]),end=" ")
-            beg = time.time()
-    if len(m)==0:
+def wait_for_answer(cmd):
+    #send cmd (bytes or RR_duino_message) and wait for the answer, returns (payload,status)
+    result = transactions.transact(cmd)
+    if result.error==RR_duino_transactions.RR_duino_transaction.TIMEOUT:
         return (None,"Device not responding")
-
-    elif (m[-1]&0x80!=0) and (m[-1]&0x0F!=0):
-        return (None,"Error "+str(m[-1]&0x0F))
- 
-    else:
-        return (m[3:],"OK")
+    if result.error:
+        return (None,"Error "+str(result.error))
+    return (result.answer.raw_message[3:],"OK")
     
 def decode(m):
     res=""
@@ -56,38 +46,17 @@ def decode(m):
         res += " "+str(b)
     return res
 
-def wait_for_show_answer(turnouts=False):
-    m=b""
-    beg = time.time()
-    next_subadd_pos = 3
-    while time.time()<beg+ANSWER_TIMEOUT:
-        s.process_IO()
-        if s.available():
-            m+=s.read()
-            beg = time.time()
-            if len(m)==next_subadd_pos+1 and (m[next_subadd_pos] & 0x80!=0):
-                #end of the message
-                break
-            else:
-                while len(m)>next_subadd_pos:
-                    #compute next subbaddress pos
-                    if not turnouts:
-                        next_subadd_pos+=2
-                    else:
-                        #check if relay pins are needed for this turnout
-                        if (m[next_subadd_pos] & (1<<6))!=0:
-                            next_subadd_pos+=6
-                        else:
-                            next_subadd_pos+=4
-
-    if len(m)==0:
-        return (None,"Device not responding")
-  
-    elif m[-1]&0x0F!=0:
-        return (None,"Error "+str(m[-1]&0x0F))
- 
-    else:
-        return (m,"OK")
+def query(msg):
+    #send msg and return the answer or None (used by the multi-part answers of RR_duino_messages)
+    return transactions.transact(msg).answer
+
+def answers_status(answers):
+    #status string after iterating over a RR_duino_answers
+    if answers.error is None:
+        return "OK"
+    if answers.error==RRduino.RR_duino_answers.TIMEOUT:
+        return "Device not responding"
+    return "Error "+str(answers.error)
 
 def get_address():
     global address
@@ -105,8 +74,7 @@ def get_address():
         
 def load_eeprom_clicked(b):
     if check_connection():
-        s.send(bytes((0xFF,0b10111001,address)))
-        answer,status = wait_for_answer(4)
+        answer,status = wait_for_answer(bytes((0xFF,0b10111001,address)))
         time.sleep(1)
         set_status(status)
         main_data.eeprom_state[0] = answer is not None
@@ -116,13 +84,11 @@ def load_eeprom_clicked(b):
         
 def clear_eeprom_clicked(b):
     if check_connection():
-        s.send(bytes((0xFF,0b11111001,address)))
-        set_status(wait_for_answer(4)[1])
+        set_status(wait_for_answer(bytes((0xFF,0b11111001,address)))[1])
         
 def store_eeprom_clicked(b):
     if check_connection():
-        s.send(bytes((0xFF,0b10101001,address)))
-        answer,status = wait_for_answer(4)
+        answer,status = wait_for_answer(bytes((0xFF,0b10101001,address)))
         main_data.eeprom_state[1] = answer is not None
         set_status(status)
         set_eeprom_status(main_data.eeprom_status)
@@ -130,12 +96,10 @@ def store_eeprom_clicked(b):
 
 def set_add():
     #Set address
-    s.send(bytes((0xFF,0b10011001,address)))
-    return wait_for_answer(4)[1]
+    return wait_for_answer(bytes((0xFF,0b10011001,address)))[1]
 
 def get_version():
-    s.send(bytes((0xFF,0b10001001,address)))
-    answer,msg = wait_for_answer(5)
+    answer,msg = wait_for_answer(bytes((0xFF,0b10001001,address)))
     if answer is not None:
         main_data.device_version_label.t=str(answer[0])
         main_data.device_version = main_data.device_version_label.t
@@ -417,8 +381,7 @@ def restore_node_clicked(b):
                 io_type = 1 #input with pull up
         else:
             io_type = 2
-        config_sensor(subadd,pin,io_type)
-        m,code = wait_for_answer(4)
+        m,code = config_sensor(subadd,pin,io_type)
         if m is None:
             restore_data.device_status.t = code
             restore_data.device_status.redraw()
@@ -444,8 +407,7 @@ def restore_node_clicked(b):
 
         pulse_pins=(line[39:]=='P')
             
-        config_turnout(subadd,pin,pos1,pos2,pulse_pins,relay_pins)
-        m,code = wait_for_answer(4)
+        m,code = config_turnout(subadd,pin,pos1,pos2,pulse_pins,relay_pins)
         if m is None:
             restore_data.device_status.t = code
             restore_data.device_status.redraw()
@@ -576,43 +538,21 @@ def pad_int(int,nb):
         s=" "*(nb-len(s))+s
     return s
 
-def get_sensors_cfg(msg):
-    sensors_list = []
-    pos = 0
-    while pos+1<len(msg):
-        output = (msg[pos] & (1<<6))!=0
-        subadd = msg[pos] & 0x3F
-        pos+=1
-        if not output:
-            pullup = (msg[pos] & (1<<7))!=0
-        pin = msg[pos]&0x7F
-        pos+=1
-        s = "subadd:"+pad_int(subadd,2)+"|pin:"+pad_int(pin,3)+"|"
-        if output:
-            s+="O"
-        else:
-            s+="I"
-            if pullup:
-                s+=" P"
-        sensors_list.append(s)
-    return sensors_list
+def sensor_cfg_str(cfg):
+    subadd,pin,sensor_type = cfg
+    res = "subadd:"+pad_int(subadd,2)+"|pin:"+pad_int(pin,3)+"|"
+    if sensor_type==RRduino.RR_duino_message.OUTPUT_SENSOR:
+        res+="O"
+    else:
+        res+="I"
+        if sensor_type==RRduino.RR_duino_message.INPUT_SENSOR_PULLUP:
+            res+=" P"
+    return res
 
 def load_sensors():
-    sensors_list = []
-    done = False
-    while not done:
-        #send command
-        c= 0b11001001
-        s.send(bytes((0xFF,c,address)))
-        msg,code = wait_for_show_answer()
-
-        if msg is None:
-            done=True
-        else:
-            #check if there is another answer pending
-            done = (msg[1]& (1<<1))==0
-            sensors_list.extend(get_sensors_cfg(msg[3:]))
-    return (code,sensors_list)
+    answers = RRduino.show_sensors_answers(query,address)
+    sensors_list = [sensor_cfg_str(cfg) for cfg in answers]
+    return (answers_status(answers),sensors_list)
 
 class SensorDialogData:
     def __init__(self):
@@ -627,7 +567,7 @@ def config_sensor(subadd,pin,io_type):
         subadd |= (1<<6)
     elif io_type==1:
         pin |= (1<<7)
-    s.send(bytes((0xFF,0b10000001,address,subadd,pin)))
+    return wait_for_answer(bytes((0xFF,0b10000001,address,subadd,pin)))
     
 def sensor_commit_clicked(b):
     global sensor_data
@@ -647,8 +587,7 @@ def sensor_commit_clicked(b):
     if pin<=0 or pin>=128 or error:
         return
     io_type= sensor_data.io.get() #0=input, 1=input w/ pullup, 2=output
-    config_sensor(subadd,pin,io_type)
-    m,code = wait_for_answer(4)
+    m,code = config_sensor(subadd,pin,io_type)
     if m is None:
         sensor_data.device_status.t = code
         #error
@@ -666,8 +605,7 @@ def sensor_delete_clicked(b):
     sensor=sensor_data.list_wg.items[sensor_data.list_wg.choice]
     subadd = int(sensor[7:9])
 
-    s.send(bytes((0xFF,0b10100001,address,subadd)))
-    m,code = wait_for_answer(4)
+    m,code = wait_for_answer(bytes((0xFF,0b10100001,address,subadd)))
     if m is None:
         #error
         sensor_data.device_status.t = code
@@ -755,8 +693,7 @@ def test_read_clicked(b):
     io_type= values[1]
     
     msg = RRduino.RR_duino_message.build_simple_rw_cmd(address,subadd,True,io_type==0)
-    s.send(msg.raw_message)
-    m,code = wait_for_answer(4)
+    m,code = wait_for_answer(msg.raw_message)
     test_data.device_status.t = code
     test_data.device_status.redraw()
     if m is not None:  #m[0] is the subaddress with the value encoded
@@ -776,8 +713,7 @@ def test_write_clicked(b):
     subadd = values[0]
     value = values[2]
     msg = RRduino.RR_duino_message.build_simple_rw_cmd(address,subadd,False,values[1]==0,value)
-    s.send(msg.raw_message)
-    m,code = wait_for_answer(4)
+    m,code = wait_for_answer(msg.raw_message)
 
     test_data.device_status.t = code
     test_data.device_status.redraw()
@@ -841,9 +777,9 @@ def config_turnout(subadd,servo_pin,straight_pos,thrown_pos,pulse_pins,relay_pin
         if pulse_pins:
             for i in range(2):
                 relay_pins[i]|=0x80
-        s.send(bytes((0xFF,0b10010001,address,subadd,servo_pin,straight_pos,thrown_pos,relay_pins[0],relay_pins[1])))
+        return wait_for_answer(bytes((0xFF,0b10010001,address,subadd,servo_pin,straight_pos,thrown_pos,relay_pins[0],relay_pins[1])))
     else:
-        s.send(bytes((0xFF,0b10010001,address,subadd,servo_pin,straight_pos,thrown_pos)))
+        return wait_for_answer(bytes((0xFF,0b10010001,address,subadd,servo_pin,straight_pos,thrown_pos)))
 
 def turnout_commit_clicked(b):
     global turnout_data
@@ -896,8 +832,7 @@ def turnout_commit_clicked(b):
             if relay_pins[i]<=0 or relay_pins[i]>126:
                 return
                 
-    config_turnout(subadd,servo_pin,straight_pos,thrown_pos,pulse_pins,relay_pins)
-    m,code = wait_for_answer(4)
+    m,code = config_turnout(subadd,servo_pin,straight_pos,thrown_pos,pulse_pins,relay_pins)
     if m is None:
         turnout_data.device_status.t = code
         #error
@@ -916,52 +851,22 @@ def relay_pin_str(pin):
     else:
         return pad_int(pin,3)
     
-def get_turnouts_cfg(msg):
-    turnouts_list = []
-    pos = 0
-    while pos+1<len(msg):
-        relay_pins = (msg[pos] & (1<<6))!=0
-        subadd = msg[pos] & 0x3F
-        pos+=1
-        pin = msg[pos]
-        pos+=1
-        straight = msg[pos]
-        pos+=1
-        thrown = msg[pos]
-        pos+=1
-        s = "sub:"+pad_int(subadd,2)+"|P:"+pad_int(pin,3)+"|S:"
-        s+= pad_int(straight,3)+"|T:"+pad_int(thrown,3)
-        if relay_pins:
-            pin1=msg[pos] & 0x7F
-            pulse = (msg[pos]&0x80)!=0
-            pos+=1
-            pin2=msg[pos] & 0x7F
-            pulse = pulse or ((msg[pos]&0x80)!=0)
-            s+="|r1:"+relay_pin_str(pin1)+"|r2:"+relay_pin_str(pin2)+"|"
-            if pulse:
-                s+="P"
-            pos+=1
-        else:
-            s+="|"+" "*6+"|"+" "*6+"|"
-        turnouts_list.append(s)
-    return turnouts_list
-    
+def turnout_cfg_str(cfg):
+    res = "sub:"+pad_int(cfg[0],2)+"|P:"+pad_int(cfg[1],3)+"|S:"
+    res+= pad_int(cfg[2],3)+"|T:"+pad_int(cfg[3],3)
+    if len(cfg)>4:
+        #relay pins
+        res+="|r1:"+relay_pin_str(cfg[4])+"|r2:"+relay_pin_str(cfg[5])+"|"
+        if cfg[6] or cfg[7]:
+            res+="P"
+    else:
+        res+="|"+" "*6+"|"+" "*6+"|"
+    return res
 
 def load_turnouts():
-    turnouts_list = []
-    done = False
-    while not done:
-        #send command
-        c= 0b11011001
-        s.send(bytes((0xFF,c,address)))
-        msg,code = wait_for_show_answer(True)
-        if msg is None:
-            done=True
-        else:
-            #check if there is another answer pending
-            done = (msg[1]& (1<<1))==0
-            turnouts_list.extend(get_turnouts_cfg(msg[3:]))
-    return (code,turnouts_list)
+    answers = RRduino.show_turnouts_answers(query,address)
+    turnouts_list = [turnout_cfg_str(cfg) for cfg in answers]
+    return (answers_status(answers),turnouts_list)
 
 def sanitize_pos():
     if turnout_data.fine_tune_pos < 0:
@@ -992,8 +897,7 @@ def fine_tune_turnout(pos):
     turnout_data.fine_tune_time = time.time()
     turnout_str = turnout_data.list_wg.items[turnout_data.list_wg.choice]
     subadd=int(turnout_str[4:6])
-    s.send(bytes((0xFF,0b11101001,address,subadd,pos)))
-    m,code=wait_for_answer(4)
+    m,code=wait_for_answer(bytes((0xFF,0b11101001,address,subadd,pos)))
     turnout_data.device_status.t=code
     if m is not None:
         turnout_data.fine_tune_label.t = pad_int(pos,3)
@@ -1014,8 +918,7 @@ def turnout_delete_clicked(b):
     turnout=turnout_data.list_wg.items[turnout_data.list_wg.choice]
     subadd = int(turnout[4:6])
     
-    s.send(bytes((0xFF,0b10110001,address,subadd)))
-    m,code = wait_for_answer(4)
+    m,code = wait_for_answer(bytes((0xFF,0b10110001,address,subadd)))
     if m is None:
         #error
         turnout_data.device_status.t = code
@@ -1141,6 +1044,7 @@ messages=[]
 serial_port = "/dev/ttyACM0"
 serial_speed = 38400
 s = serial_bus.serial_bus(serial_port,serial_speed)
+transactions = RR_duino_transactions.RR_duino_transactions(s,RR_duino_transactions.RR_duino_retry_policy(retries=1))
 address=0
 subaddress = 0
 turnout = False
@@ -1,65 +1,423 @@
-import serial,sys
+import serial,sys,time,selectors,asyncio,collections,socket,select,errno,urllib.parse
+import RR_duino_messages as RRduino
+import RR_duino_capture
+
+#selector with no state in the kernel: a socket port can come back with a reused file descriptor
+PortSelector = getattr(selectors,"PollSelector",selectors.SelectSelector)
+
+class socket_port:
+    """
+    serial port look-alike over TCP for serial to TCP bridges (ser2net, rs485-leonardo-trans...)
+    port is "socket://host:port", baudrate is the one of the bus behind the bridge (for the timings)
+    Nagle is disabled so that each write goes out right away. The connection is persistent: when
+    it drops it is reopened in the background, bytes written meanwhile wait in the bus send buffer
+    """
+    CONNECT_TIMEOUT = 5.0   #timeout of the first connection (s)
+    RECONNECT_PERIOD = 1.0  #time between reconnection attempts (s)
+
+    def __init__(self):
+        self.port = None
+        self.baudrate = 38400
+        self.bytesize = serial.EIGHTBITS
+        self.stopbits = serial.STOPBITS_ONE
+        self.parity = serial.PARITY_NONE
+        self.timeout = 0
+        self.write_timeout = 0
+        self.is_open = False
+        self.sock = None
+        self.connected = False
+        self.next_connect = 0
+        self.rcv = bytearray()  #received bytes not read yet
+
+    def address(self):
+        url = urllib.parse.urlsplit(self.port)
+        if url.hostname is None or url.port is None:
+            raise ValueError("expected socket://host:port, got "+str(self.port))
+        return (url.hostname,url.port)
+
+    def setup_socket(self):
+        self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self.sock.setblocking(False)
+
+    def open(self):
+        #the first connection is blocking so that errors are reported like for a serial port
+        self.sock = socket.create_connection(self.address(),timeout=socket_port.CONNECT_TIMEOUT)
+        self.setup_socket()
+        self.connected = True
+        self.is_open = True
+
+    def drop(self):
+        #forget the connection, the next one will be attempted after RECONNECT_PERIOD
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+        self.rcv.clear()
+        self.next_connect = time.monotonic()+socket_port.RECONNECT_PERIOD
+
+    def close(self):
+        self.drop()
+        self.is_open = False
+
+    def reconnect(self):
+        #start or go on with a non blocking connection, returns True once connected
+        if self.sock is None:
+            if time.monotonic() < self.next_connect:
+                return False
+            try:
+                family,socktype,proto,_,address = socket.getaddrinfo(*self.address(),type=socket.SOCK_STREAM)[0]
+                self.sock = socket.socket(family,socktype,proto)
+                self.setup_socket()
+                err = self.sock.connect_ex(address)
+            except OSError:
+                self.drop()
+                return False
+            if err not in (0,errno.EINPROGRESS,errno.EWOULDBLOCK):
+                self.drop()
+                return False
+        _,writable,_ = select.select([],[self.sock],[],0)
+        if not writable:
+            return False
+        if self.sock.getsockopt(socket.SOL_SOCKET,socket.SO_ERROR):
+            self.drop()
+            return False
+        self.connected = True
+        return True
+
+    def fileno(self):
+        #None while disconnected
+        return self.sock.fileno() if self.connected else None
+
+    @property
+    def in_waiting(self):
+        if not self.connected and not self.reconnect():
+            return 0
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            data = None
+        except OSError:
+            self.drop()
+            return 0
+        if data == b"":
+            #closed by the bridge
+            self.drop()
+        elif data:
+            self.rcv.extend(data)
+        return len(self.rcv)
+
+    def readinto(self,buf):
+        nb = min(len(buf),len(self.rcv))
+        buf[:nb] = self.rcv[:nb]
+        del self.rcv[:nb]
+        return nb
+
+    def write(self,data):
+        #returns the number of bytes written, 0 while disconnected
+        if not self.connected and not self.reconnect():
+            return 0
+        try:
+            return self.sock.send(data)
+        except BlockingIOError:
+            return 0
+        except OSError:
+            self.drop()
+            return 0
+
+def new_port(port,baudrate):
+    """
+    transport for port: socket://host:port goes through socket_port, other URLs through the pyserial
+    URL handlers (rfc2217://, loop://...) and devices (serial ports, ptys) through serial.Serial
+    """
+    if port is not None and port.startswith("socket://"):
+        ser_port = socket_port()
+        ser_port.port = port
+    elif port is not None and "://" in port:
+        ser_port = serial.serial_for_url(port,do_not_open=True)
+    else:
+        ser_port = serial.Serial()
+        ser_port.port = port
+    ser_port.baudrate = baudrate
+    ser_port.timeout=0
+    ser_port.write_timeout = 0
+    return ser_port
 
 class serial_bus:
+    #polling period used when the port cannot be waited on (no file descriptor, on windows for example)
+    POLL_PERIOD = 0.001
+    #size of the receive ring buffer
+    RCV_BUFFER_SIZE = 4096
+
     def __init__(self,port,baudrate):
-        self.ser_port = serial.Serial()
-        self.ser_port.port = port
-        self.ser_port.baudrate = baudrate
-        self.ser_port.timeout=0
-        self.ser_port.write_timeout = 0
-        self.to_send=b""
-        self.to_send_pos=0
-        self.rcv_buffer = b""
+        self.ser_port = new_port(port,baudrate)
+        #messages waiting to be sent, in order, and position of the first byte not sent yet
+        self.send_buffer = bytearray()
+        self.send_pos = 0
+        #receive ring buffer: rcv_len bytes beginning at rcv_start (wrapping at the end of the buffer)
+        self.rcv_buffer = bytearray(serial_bus.RCV_BUFFER_SIZE)
+        self.rcv_view = memoryview(self.rcv_buffer)
+        self.rcv_start = 0
+        self.rcv_len = 0
+        self.selector = None
+        self.watched_fd = None
+        #bytes counters and time (time.monotonic()) of the end of the last write and of the last read
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.last_write_time = None
+        self.last_read_time = None
+        #capture_writer (see RR_duino_capture) recording the traffic, None when not capturing
+        self.capture = None
+        self.capture_channel = None
 
     def start(self):
         if not self.ser_port.is_open:
             self.ser_port.open()
+            self.selector = PortSelector()
+            self.watched_fd = None
+
     def stop(self):
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
         if self.ser_port.is_open:
             self.ser_port.close()
 
     def set_port(self,port):
         self.stop()
-        self.ser_port.port = port
+        self.ser_port = new_port(port,self.ser_port.baudrate)
+
+    def port_fd(self):
+        #file descriptor to wait on, None if there is none (windows, some URLs, socket reconnecting)
+        try:
+            return self.ser_port.fileno()
+        except (AttributeError,OSError,ValueError,NotImplementedError):
+            return None
 
     def set_baud(self,baud):
         self.stop()
         self.ser_port.baudrate = baud
 
+    def start_capture(self,capture):
+        #record every byte written and read in capture (RR_duino_capture.capture_writer)
+        self.capture = capture
+        self.capture_channel = capture.open_channel("serial:"+str(self.ser_port.port))
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close_channel(self.capture_channel)
+            self.capture = None
+
+    def byte_time(self):
+        #time (s) to transmit one byte on the wire: start bit, data bits, parity bit and stop bits
+        bits = 1+self.ser_port.bytesize+self.ser_port.stopbits
+        if self.ser_port.parity != serial.PARITY_NONE:
+            bits += 1
+        return bits/self.ser_port.baudrate
+
     def send(self,msg): #msg must be bytes array
-        if len(self.to_send)>0:
-            print("overrun of the sending buffer")
-        self.to_send=msg
+        #queue the message, messages are sent in order and coalesced in as few writes as possible
+        self.send_buffer.extend(msg)
 
     def sending(self):
-        return len(self.to_send)>0
+        return self.send_pos < len(self.send_buffer)
+
+    def read_views(self):
+        """
+        return all the received bytes as a list of (at most 2) memoryviews, without copying them
+        the bytes are consumed: the views are only valid until the next call to process_IO
+        """
+        if self.rcv_len == 0:
+            return []
+        end = self.rcv_start+self.rcv_len
+        if end <= len(self.rcv_buffer):
+            views = [self.rcv_view[self.rcv_start:end]]
+        else:
+            views = [self.rcv_view[self.rcv_start:],self.rcv_view[:end-len(self.rcv_buffer)]]
+        #buffer is empty now, restart at the beginning to avoid wrapping
+        self.rcv_start = 0
+        self.rcv_len = 0
+        return views
 
     def read(self):
-        if len(self.rcv_buffer)>0:
-            res = self.rcv_buffer
-            self.rcv_buffer = b""
-            return res
+        #return all the received bytes (copied) or None
+        views = self.read_views()
+        if views:
+            return b"".join(views)
         else:
             return None
 
     def available(self):
-        return len(self.rcv_buffer)
-    
-    def process_IO(self):
-        if self.to_send:  #still sending
-            if self.to_send_pos < len(self.to_send):
-                #print("sending msg=",self.to_send[self.to_send_pos:])
-                try:
-                    nb = self.ser_port.write(self.to_send[self.to_send_pos:])
-                    self.to_send_pos += nb
-                except BaseException:
-                    pass
-            else:
-                self.to_send = b""
-                self.to_send_pos = 0
-                #print("sending is done")
-        else:   #see if we have received something
+        return self.rcv_len
+
+    def wait_IO(self,deadline):
+        """
+        sleep until the port is readable (or writable while sending) or until deadline
+        deadline is a time.monotonic() value
+        returns True if the port is ready
+        """
+        timeout = deadline-time.monotonic()
+        if timeout<=0:
+            return False
+        fd = self.port_fd() if self.selector is not None else None
+        if fd is None:
+            #no file descriptor for this port, fall back to polling
+            time.sleep(min(timeout,serial_bus.POLL_PERIOD))
+            return False
+        events = selectors.EVENT_READ
+        if self.sending():
+            events |= selectors.EVENT_WRITE
+        if fd != self.watched_fd:
+            #first wait or new connection
+            if self.watched_fd is not None:
+                self.selector.unregister(self.watched_fd)
+            self.selector.register(fd,events)
+            self.watched_fd = fd
+        else:
+            self.selector.modify(fd,events)
+        return len(self.selector.select(timeout))>0
+
+    def process_IO(self,deadline=None):
+        #if deadline is given (time.monotonic() value), wait until there is something to do or the deadline has passed
+        if deadline is not None:
+            self.wait_IO(deadline)
+        if self.capture is not None:
+            self.capture.flush_due()
+        if self.sending():
             try:
-                self.rcv_buffer +=  self.ser_port.read()
+                with memoryview(self.send_buffer) as view:
+                    nb = self.ser_port.write(view[self.send_pos:])
+                    if nb and self.capture is not None:
+                        self.capture.record(RR_duino_capture.TX,self.capture_channel,view[self.send_pos:self.send_pos+nb])
+                self.send_pos += nb
+                self.tx_bytes += nb
             except BaseException:
-                print("exception while read serial")
+                pass
+            if not self.sending():
+                #all sent
+                self.send_buffer.clear()
+                self.send_pos = 0
+                self.last_write_time = time.monotonic()
+        #see if we have received something
+        free = len(self.rcv_buffer)-self.rcv_len
+        if free == 0:
+            #buffer full, the bytes wait in the port until the next read
+            return
+        try:
+            waiting = self.ser_port.in_waiting
+            if waiting:
+                end = (self.rcv_start+self.rcv_len) % len(self.rcv_buffer)
+                #fill the contiguous free part only, the rest will come on next call
+                size = min(waiting,free,len(self.rcv_buffer)-end)
+                nb = self.ser_port.readinto(self.rcv_view[end:end+size])
+                if nb and self.capture is not None:
+                    self.capture.record(RR_duino_capture.RX,self.capture_channel,self.rcv_view[end:end+nb])
+                self.rcv_len += nb
+                self.rx_bytes += nb
+                self.last_read_time = time.monotonic()
+        except BaseException:
+            print("exception while read serial")
+
+class async_serial_bus:
+    """
+    asyncio variant of serial_bus: the port file descriptor is watched by the event loop
+    (loop.add_reader/add_writer) and the received bytes are decoded into frames as they come
+    start() must be called from a coroutine running in the event loop that will drive the port
+    """
+    #max number of received frames kept while nobody calls recv_frame, the oldest are dropped
+    MAX_FRAMES = 256
+
+    def __init__(self,port,baudrate):
+        self.ser_port = serial.Serial()
+        self.ser_port.port = port
+        self.ser_port.baudrate = baudrate
+        self.ser_port.timeout=0
+        self.ser_port.write_timeout = 0
+        self.decoder = RRduino.RR_duino_frame_decoder()
+        self.frames = collections.deque(maxlen=async_serial_bus.MAX_FRAMES)
+        self.frame_waiter = None  #future set when a frame arrives
+        self.send_buffer = bytearray()
+        self.drained = None       #future set when the send buffer is empty
+        self.loop = None
+
+    def start(self):
+        if not self.ser_port.is_open:
+            self.loop = asyncio.get_running_loop()
+            self.ser_port.open()
+            self.loop.add_reader(self.ser_port.fileno(),self.on_readable)
+
+    def stop(self):
+        if self.ser_port.is_open:
+            self.loop.remove_reader(self.ser_port.fileno())
+            self.loop.remove_writer(self.ser_port.fileno())
+            self.ser_port.close()
+        self.send_buffer.clear()
+        for fut in (self.frame_waiter,self.drained):
+            if fut is not None and not fut.done():
+                fut.set_exception(ConnectionError("serial port closed"))
+        self.drained = None
+
+    def on_readable(self):
+        try:
+            data = self.ser_port.read(self.ser_port.in_waiting or 1)
+        except OSError:
+            #SerialException or ioctl error (device unplugged, hangup): the port would stay readable
+            #forever, stop watching it and wake up the waiters
+            print("exception while read serial, closing the port")
+            self.stop()
+            return
+        if data:
+            self.frames.extend(self.decoder.feed(data))
+            if self.frames and self.frame_waiter is not None and not self.frame_waiter.done():
+                self.frame_waiter.set_result(None)
+
+    def write_pending(self):
+        #write as much of the send buffer as the port takes
+        try:
+            with memoryview(self.send_buffer) as view:
+                nb = self.ser_port.write(view)
+        except serial.SerialException:
+            nb = 0
+        del self.send_buffer[:nb]
+
+    def on_writable(self):
+        self.write_pending()
+        if not self.send_buffer:
+            self.loop.remove_writer(self.ser_port.fileno())
+            if self.drained is not None and not self.drained.done():
+                self.drained.set_result(None)
+            self.drained = None
+
+    async def send(self,frame):
+        #queue frame (bytes like) and return once it (and all frames queued before) has been written
+        if not self.ser_port.is_open:
+            raise ConnectionError("serial port closed")
+        if self.send_buffer:
+            #already waiting for the port, on_writable will send it
+            self.send_buffer.extend(frame)
+        else:
+            #try to write right away, wait for the port only if it did not take everything
+            self.send_buffer.extend(frame)
+            self.write_pending()
+            if not self.send_buffer:
+                return
+            self.loop.add_writer(self.ser_port.fileno(),self.on_writable)
+        if self.drained is None:
+            self.drained = self.loop.create_future()
+        await self.drained
+
+    async def recv_frame(self,timeout=None):
+        #return the next received frame (RR_duino_frame) or None if timeout (s) elapsed before
+        #only one coroutine can wait for the frames
+        if not self.frames:
+            if self.frame_waiter is not None:
+                raise RuntimeError("another coroutine is already waiting for a frame")
+            if not self.ser_port.is_open:
+                raise ConnectionError("serial port closed")
+            self.frame_waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.frame_waiter,timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self.frame_waiter = None
+        return self.frames.popleft()
@@ -0,0 +1,70 @@
+import random
+import pytest
+import RR_duino_messages as RRduino
+import RR_duino_node_sim as sim
+
+M = RRduino.RR_duino_message
+
+def frame(data):
+    return RRduino.RR_duino_frame(bytearray(data))
+
+#read all sensors answer of the firmware for 10 sensors valued 1,0,1,1,0,0,0,1,1,0: 7 values per byte, LSB first
+READ_ALL_10 = bytes((0xFF,0x40,5 | 0x40,0x0D,0x03,0x80))
+VALUES_10 = [1,0,1,1,0,0,0,1,1,0]
+
+def test_read_all_answer():
+    answer = frame(READ_ALL_10)
+    assert answer.get_all_values(10) == VALUES_10
+    assert answer.get_all_values_mask(10) == 0b0110001101
+    #the MSB of a byte is never a value
+    assert frame((0xFF,0x40,5 | 0x40,0x7F,0x7F,0x80)).get_all_values(14) == [1]*14
+
+def test_read_all_answer_ended_by_an_error():
+    #only the values before the error code are there
+    answer = frame((0xFF,0x40,5 | 0x40,0x0D,0x83))
+    assert answer.get_all_values(10) == VALUES_10[:7]
+
+def test_read_all_answers_of_the_simulated_firmware():
+    node = sim.RR_duino_sim_node(5)
+    sim.populate_node(node,63,20)
+    rng = random.Random(3)
+    for sensor in node.sensors.values():
+        sensor.value = rng.randint(0,1)
+    for turnout in node.turnouts.values():
+        turnout.pos = rng.randint(0,1)
+    sensors = frame(node.read_all(bytearray((0x41,5 | 0x40)),False)[0])
+    assert sensors.get_all_values(63) == [s.value for s in node.sorted_sensors()]
+    turnouts = frame(node.read_all(bytearray((0x51,5 | 0x40)),True)[0])
+    assert turnouts.get_all_values(20) == [t.pos for t in node.sorted_turnouts()]
+
+def test_table_mask():
+    #show sensors table: inputs 1 and 8, output 2
+    answer = frame(bytes((0xFF,0xC8,5 | 0x80,0x01,0x01))+bytes(7)+bytes((0x02,))+bytes(8)+bytes((0x80,)))
+    mask = answer.get_table_mask()
+    assert RRduino.mask_positions(mask) == [0,7,64]
+
+def test_changed_values():
+    old = RRduino.bits_to_mask((0x0D,0x03))
+    new = RRduino.bits_to_mask((0x0C,0x43))
+    #bit 0 cleared, bit 13 set
+    assert list(RRduino.changed_values(old,new)) == [(1,0),(14,1)]
+    subaddresses = list(range(10,24))
+    assert list(RRduino.changed_values(old,new,subaddresses)) == [(10,0),(23,1)]
+    #bits beyond the known subaddresses are ignored
+    assert list(RRduino.changed_values(old,new,subaddresses[:5])) == [(10,0)]
+    assert list(RRduino.changed_values(old,old)) == []
+
+def test_batch_matches_pure_python():
+    numpy = pytest.importorskip("numpy")
+    rng = random.Random(5)
+    msgs = []
+    for i in range(20):
+        nb_bytes = rng.randint(1,9)
+        payload = bytes(rng.randint(0,0x7F) for i in range(nb_bytes))
+        end = 0x80 if rng.random() < 0.8 else 0x83
+        msgs.append(frame(bytes((0xFF,0x40,5 | 0x40))+payload+bytes((end,))))
+    batch = RRduino.all_values_batch(msgs,63)
+    assert batch.shape == (20,63)
+    for row,msg in zip(batch,msgs):
+        values = msg.get_all_values(63)
+        assert list(row) == values+[0]*(63-len(values))
@@ -0,0 +1,87 @@
+import random
+import pytest
+import RR_duino_messages as RRduino
+
+M = RRduino.RR_duino_message
+D = RRduino.RR_duino_frame_decoder
+
+def turnout_cfg(subadd,relays):
+    #positions above 127 have their MSB set, like the end bytes
+    if relays:
+        return M.encode_turnout_config((subadd,10,40,150,20,21,True,False))
+    return M.encode_turnout_config((subadd,10,40,150))
+
+#one frame of each kind: (kind,frame)
+FRAMES = [
+    (D.FIXED,bytes((0xFF,0x05,5))),                                   #async command
+    (D.FIXED,bytes((0xFF,0x41,5 | 0x40))),                            #read all sensors
+    (D.FIXED,bytes((0xFF,0x01,5,3))),                                 #read one sensor
+    (D.FIXED,bytes((0xFF,0x00,5,0x43))),                              #its answer
+    (D.FIXED,bytes((0xFF,0x81,5))+M.encode_sensor_config((1,5,M.INPUT_SENSOR_PULLUP))),  #config one sensor
+    (D.FIXED,bytes((0xFF,0xE9,5,3,90))),                              #turnout fine tuning
+    (D.TERMINATED,bytes((0xFF,0x00,5 | 0x40,0x01,0x42,0x80))),        #list answer
+    (D.TERMINATED,bytes((0xFF,0x80,5,0x83))),                         #config error answer
+    (D.TERMINATED,bytes((0xFF,0x40,5 | 0x40,0x7F,0x01,0x80))),        #read all answer
+    (D.SENSORS_CFG,bytes((0xFF,0x81,5 | 0x40))+M.encode_sensor_config((1,5,M.INPUT_SENSOR_PULLUP))
+                   +M.encode_sensor_config((2,6,M.OUTPUT_SENSOR))+b"\x80"),
+    (D.SENSORS_CFG,bytes((0xFF,0xC8,5 | 0x40))+M.encode_sensor_config((3,100,M.INPUT_SENSOR_PULLUP))+b"\x80"),
+    (D.TURNOUTS_CFG,bytes((0xFF,0x91,5 | 0x40))+turnout_cfg(1,False)+turnout_cfg(2,True)+b"\x80"),
+    (D.TURNOUTS_CFG,bytes((0xFF,0xD8,5 | 0x40))+turnout_cfg(1,True)+turnout_cfg(2,False)+b"\x80"),
+    (D.TURNOUT_CFG,bytes((0xFF,0x91,5))+turnout_cfg(1,False)),
+    (D.TURNOUT_CFG,bytes((0xFF,0x91,5))+turnout_cfg(2,True)),
+    (D.VERSION,bytes((0xFF,0x88,5,3,0x80))),                          #version answer
+    (D.VERSION,bytes((0xFF,0x88,5,0x83))),                            #version error answer
+]
+
+def decoded(chunks):
+    decoder = D()
+    frames = []
+    for chunk in chunks:
+        frames.extend(bytes(frame.raw_message) for frame in decoder.feed(chunk))
+    return frames,decoder
+
+@pytest.mark.parametrize("kind,frame",FRAMES)
+def test_each_frame_kind(kind,frame):
+    assert D.FRAME_KINDS[(frame[1] << 2) | (frame[2] >> 6)][0] == kind
+    frames,decoder = decoded([frame])
+    assert frames == [frame]
+    assert decoder.frame is None
+    #nothing is swallowed: a frame that follows is decoded too
+    frames,decoder = decoded([frame+FRAMES[0][1]])
+    assert frames == [frame,FRAMES[0][1]]
+
+def test_frames_split_across_feeds():
+    stream = b"".join(frame for kind,frame in FRAMES)
+    expected = [frame for kind,frame in FRAMES]
+    assert decoded([stream])[0] == expected
+    assert decoded([stream[i:i+1] for i in range(len(stream))])[0] == expected
+    rng = random.Random(1)
+    for i in range(20):
+        cuts = sorted(rng.sample(range(1,len(stream)),10))
+        chunks = [stream[a:b] for a,b in zip([0]+cuts,cuts+[len(stream)])]
+        assert decoded(chunks)[0] == expected
+
+def test_resync_after_garbage():
+    version = FRAMES[15][1]
+    frames,decoder = decoded([b"\x12\x80\x00"+version+b"\x55"+version])
+    assert frames == [version,version]
+    assert decoder.discarded == 4
+
+def test_start_byte_restarts_the_frame():
+    #a frame cut by a start byte is dropped, the device does the same
+    version = FRAMES[15][1]
+    frames,decoder = decoded([version[:3]+version])
+    assert frames == [version]
+    assert decoder.discarded == 3
+
+def test_too_long_frame_dropped():
+    #a list that never ends is dropped once it exceeds the device buffer
+    frames,decoder = decoded([bytes((0xFF,0x00,5 | 0x40))+b"\x01"*100+FRAMES[15][1]])
+    assert frames == [FRAMES[15][1]]
+
+def test_version_above_127():
+    #the version byte ends the frame, the 0x80 that follows is not garbage
+    frames,decoder = decoded([bytes((0xFF,0x88,5,200)),b"\x80"+FRAMES[0][1]])
+    assert frames == [bytes((0xFF,0x88,5,200)),FRAMES[0][1]]
+    assert RRduino.RR_duino_frame(bytearray(frames[0])).get_version() == 200
+    assert decoder.discarded == 0
@@ -0,0 +1,60 @@
+import RR_duino_messages as RRduino
+
+M = RRduino.RR_duino_message
+
+#the predicates as they were written before the flags tables: bit arithmetic on the header bytes
+OLD_COMMAND_PREDICATES = {
+    "is_answer": lambda c: (c & (1 << M.CMD_ANSW_BIT)) == 0,
+    "is_last_answer": lambda c: (c & (1 << M.CMD_LAST_ANSW_BIT)) == 0,
+    "is_config_cmd": lambda c: (c & (1 << M.CMD_CONFIG_BIT)) != 0,
+    "is_read_cmd": lambda c: not (c & (1 << M.CMD_CONFIG_BIT)) and (c & (1 << M.CMD_RW_BIT)) == 0,
+    "is_write_cmd": lambda c: not (c & (1 << M.CMD_CONFIG_BIT)) and (c & (1 << M.CMD_RW_BIT)) != 0,
+    "is_special_config_cmd": lambda c: (c & (1 << M.CMD_CONFIG_BIT)) != 0 and (c & (1 << M.CMD_SPECIAL_CONFIG_BIT)) != 0,
+    "on_turnout": lambda c: (c & (1 << M.CMD_SENSOR_TURNOUT_BIT)) != 0,
+    "async_events_pending": lambda c: (c & (1 << M.CMD_ASYNC_BIT)) != 0,
+}
+OLD_ADDRESS_PREDICATES = {
+    "is_show_table": lambda a: (a & (1 << M.ADD_TABLE_BIT)) != 0,
+    "is_list": lambda a: (a & (1 << M.ADD_LIST_BIT)) != 0,
+}
+
+def old_is_all(c,a):
+    return (a & (1 << M.ADD_LIST_BIT)) != 0 and (c & (1 << M.CMD_ALL_BIT)) != 0
+
+def messages(command,address):
+    #the same header as a message and as a decoded frame
+    raw = bytearray((M.START,command,address,0x80))
+    return (M(raw),RRduino.RR_duino_frame(bytearray(raw)))
+
+def test_command_predicates():
+    for command in range(256):
+        for msg in messages(command,5):
+            for name,old in OLD_COMMAND_PREDICATES.items():
+                assert getattr(msg,name)() == old(command),(name,command)
+
+def test_address_predicates():
+    for address in range(256):
+        for msg in messages(0x01,address):
+            for name,old in OLD_ADDRESS_PREDICATES.items():
+                assert getattr(msg,name)() == old(address),(name,address)
+
+def test_is_all():
+    for command in range(256):
+        for address in range(256):
+            msg,frame = messages(command,address)
+            assert msg.is_all() == frame.is_all() == old_is_all(command,address),(command,address)
+
+def test_frame_set_header():
+    frame = RRduino.RR_duino_frame(bytearray((M.START,0x01,5,0x80)))
+    frame.set_header(0x48,5 | 0x40)
+    assert frame.raw_message == bytearray((M.START,0x48,5 | 0x40))
+    for name,old in OLD_COMMAND_PREDICATES.items():
+        assert getattr(frame,name)() == old(0x48),name
+    assert frame.is_list() and frame.is_all()
+
+def test_frame_kinds_table():
+    #only the list and table bits of the address matter
+    D = RRduino.RR_duino_frame_decoder
+    for command in range(256):
+        for address in range(256):
+            assert D.FRAME_KINDS[(command << 2) | (address >> 6)] == D.frame_kind(command,address),(command,address)
@@ -0,0 +1,71 @@
+import pytest
+import RR_duino_messages as RRduino
+import RR_duino_node_sim as sim
+
+M = RRduino.RR_duino_message
+
+def ask(node,msg):
+    #answer of the simulated firmware to msg
+    answers = node.process(RRduino.RR_duino_frame(bytearray(msg.raw_message)))
+    assert len(answers) == 1
+    return RRduino.RR_duino_frame(bytearray(answers[0]))
+
+@pytest.fixture
+def node():
+    node = sim.RR_duino_sim_node(5)
+    sim.populate_node(node,63,63)
+    return node
+
+def test_split_at_max_list_len():
+    values = {subadd:subadd % 2 for subadd in range(1,64)}
+    msgs = M.build_list_rw_cmds(5,values,for_sensor=False)
+    assert [len(msg.raw_message) for msg in msgs] == [3+M.MAX_LIST_LEN+1,3+63-M.MAX_LIST_LEN+1]
+    decoded = {}
+    for msg in msgs:
+        assert msg.raw_message[-1] == 0x80
+        assert msg.is_write_cmd() and msg.is_list() and msg.on_turnout()
+        assert len(msg.raw_message) <= M.MAX_CMD_LEN+1
+        decoded.update(msg.get_list_of_values())
+    assert decoded == values
+
+def test_read_list_ignores_values():
+    msgs = M.build_list_rw_cmds(5,{3:1,1:1},read=True)
+    assert len(msgs) == 1
+    assert bytes(msgs[0].raw_message[3:]) == bytes((1,3,0x80))
+    assert msgs[0].is_read_cmd()
+    #an iterable of subaddresses is fine too
+    assert msgs[0].raw_message == M.build_list_rw_cmds(5,[3,1],read=True)[0].raw_message
+
+@pytest.mark.parametrize("subadd",[0,64,-1])
+def test_invalid_subaddress(subadd):
+    with pytest.raises(ValueError):
+        M.build_list_rw_cmds(5,{1:0,subadd:1})
+
+def test_read_results(node):
+    node.sensors[2].value = 1
+    cmd = M.build_list_rw_cmds(5,[1,2,3],read=True)[0]
+    results,error = ask(node,cmd).get_list_results(cmd)
+    assert results == {1:0,2:1,3:0}
+    assert error is None
+
+def test_write_ok_gets_a_simple_answer(node):
+    cmd = M.build_list_rw_cmds(5,{1:1,2:0,3:1},for_sensor=False)[0]
+    answer = ask(node,cmd)
+    assert len(answer.raw_message) == 4
+    results,error = answer.get_list_results(cmd)
+    assert results == {1:1,2:0,3:1}
+    assert error is None
+
+def test_error_answer_reports_the_failing_subaddress(node):
+    del node.turnouts[3]
+    cmd = M.build_list_rw_cmds(5,{1:1,2:1,3:1,4:1},for_sensor=False)[0]
+    results,error = ask(node,cmd).get_list_results(cmd)
+    assert results == {1:1,2:1}
+    assert error == (3,sim.UNKNOWN_DEV)
+
+def test_read_error_on_first_subaddress(node):
+    del node.sensors[1]
+    cmd = M.build_list_rw_cmds(5,[1,2],read=True)[0]
+    results,error = ask(node,cmd).get_list_results(cmd)
+    assert results == {}
+    assert error == (1,sim.UNKNOWN_DEV)
@@ -0,0 +1,105 @@
+import pytest
+import RR_duino_messages as RRduino
+import RR_duino_node_sim as sim
+import serial_bus
+
+M = RRduino.RR_duino_message
+
+def ask(node,msg):
+    #answers of node to msg, as frames
+    frame = RRduino.RR_duino_frame(bytearray(msg.raw_message))
+    return [RRduino.RR_duino_frame(bytearray(answer)) for answer in node.process(frame)]
+
+@pytest.fixture
+def node():
+    node = sim.RR_duino_sim_node(5,version=3)
+    sim.populate_node(node,20,20)
+    return node
+
+def test_version(node):
+    answers = ask(node,M.build_version_cmd(5))
+    assert len(answers) == 1
+    assert answers[0].is_answer_to_version_cmd()
+    assert answers[0].get_version() == 3
+
+def test_other_address_ignored(node):
+    assert ask(node,M.build_version_cmd(6)) == []
+
+def test_show_sensors_in_several_answers():
+    #63 sensors do not fit in one answer
+    node = sim.RR_duino_sim_node(5)
+    sim.populate_node(node,63,0)
+    configs = {}
+    nb_answers = 0
+    while True:
+        answers = ask(node,M.build_show_cmd(5))
+        assert len(answers) == 1
+        nb_answers += 1
+        configs.update(answers[0].get_list_of_sensors_config())
+        if not node.answers:
+            break
+    assert nb_answers > 1
+    assert configs == {s.subadd:(s.pin,s.io_type) for s in node.sensors.values()}
+
+def test_read_unknown_sensor(node):
+    answers = ask(node,M.build_simple_rw_cmd(5,40))
+    assert answers[0].get_error_code() == sim.UNKNOWN_DEV
+
+def test_write_input_sensor_refused(node):
+    subadd = next(s.subadd for s in node.sorted_sensors() if s.is_input())
+    answers = ask(node,M.build_simple_rw_cmd(5,subadd,read=False,value=1))
+    assert answers[0].get_error_code() == sim.UNVALID_DEV
+
+def test_turnout_move_sends_async_event(node):
+    answers = ask(node,M.build_simple_rw_cmd(5,3,read=False,for_sensor=False,value=1))
+    assert answers[0].get_error_code() == 0
+    #the turnout reaches its position after the servo move
+    now = 0
+    node.tick(now)
+    while node.turnouts[3].moving:
+        now += sim.RR_duino_sim_bus.TICK
+        node.tick(now)
+    answers = ask(node,M.build_version_cmd(5))
+    assert answers[0].async_events_pending()
+    events = list(ask(node,M.build_async_cmd(5))[0].iter_async_events())
+    assert events == [(3,1,True)]
+
+def test_input_change_debounced(node):
+    subadd = next(s.subadd for s in node.sorted_sensors() if s.is_input())
+    node.set_input(subadd,1,0)
+    node.tick(sim.SENSOR_DEBOUNCE/2)
+    assert not node.async_pending()
+    node.tick(sim.SENSOR_DEBOUNCE*2)
+    assert node.async_pending()
+    events = list(ask(node,M.build_async_cmd(5))[0].iter_async_events())
+    assert events == [(subadd,1,False)]
+    assert not node.async_pending()
+
+def test_eeprom_load_restores_configs(node):
+    sensors = {s.subadd:s.eeprom_entry() for s in node.sensors.values()}
+    node.sensors.clear()
+    assert ask(node,M.build_load_from_eeprom(5))[0].get_error_code() == 0
+    assert {s.subadd:s.eeprom_entry() for s in node.sensors.values()} == sensors
+
+def test_bus_over_pty(node):
+    #two nodes behind the pty, each one answers its own address
+    other = sim.RR_duino_sim_node(7,version=4)
+    sim_bus = sim.RR_duino_sim_bus([node,other])
+    sim_bus.start()
+    bus = serial_bus.serial_bus(sim_bus.port,38400)
+    bus.start()
+    try:
+        decoder = RRduino.RR_duino_frame_decoder()
+        versions = {}
+        for address in (5,7):
+            bus.send(M.build_version_cmd(address).raw_message)
+            while address not in versions:
+                bus.process_IO()
+                for view in bus.read_views():
+                    for frame in decoder.feed(view):
+                        versions[frame.get_address()] = frame.get_version()
+        assert versions == {5:3,7:4}
+        assert sim_bus.commands == 2 and sim_bus.answers == 2
+    finally:
+        bus.stop()
+        sim_bus.close()
@@ -0,0 +1,84 @@
+import time
+import pytest
+import RR_duino_messages as RRduino
+import RR_duino_node_sim as sim
+import RR_duino_transactions
+import serial_bus
+
+M = RRduino.RR_duino_message
+
+@pytest.fixture
+def transactions():
+    #one simulated node at address 5 on a pty
+    node = sim.RR_duino_sim_node(5,version=2)
+    sim.populate_node(node,4,2)
+    sim_bus = sim.RR_duino_sim_bus([node])
+    sim_bus.start()
+    bus = serial_bus.serial_bus(sim_bus.port,38400)
+    bus.start()
+    yield RR_duino_transactions.RR_duino_transactions(bus)
+    bus.stop()
+    sim_bus.close()
+
+def test_version_of_present_node(transactions):
+    result = transactions.transact(M.build_version_cmd(5))
+    assert result.ok()
+    assert result.tries == 1
+    assert result.answer.get_version() == 2
+    assert result.request <= result.sent <= result.first_byte <= result.last_byte
+
+def test_absent_node_times_out_quickly(transactions):
+    beg = time.monotonic()
+    result = transactions.transact(M.build_version_cmd(6))
+    elapsed = time.monotonic()-beg
+    assert result.error == RR_duino_transactions.RR_duino_transaction.TIMEOUT
+    assert result.answer is None
+    assert result.tries == 1+transactions.policy.retries
+    #a few tens of milliseconds per try, not seconds
+    assert elapsed < 0.5
+
+def test_retry_policy_override(transactions):
+    policy = RR_duino_transactions.RR_duino_retry_policy(retries=0)
+    result = transactions.transact(M.build_version_cmd(6),policy=policy)
+    assert result.tries == 1
+
+def test_read_sensor(transactions):
+    result = transactions.transact(M.build_simple_rw_cmd(5,1))
+    assert result.ok()
+    assert result.answer.get_value()[0] == 1
+
+def test_timeout_computation(transactions):
+    byte_time = transactions.bus.byte_time()
+    version = M.build_version_cmd(5)
+    assert transactions.timeout(version) == max(RR_duino_transactions.RR_duino_transactions.MIN_TIMEOUT,
+                                                (3+5)*byte_time+RR_duino_transactions.RR_duino_transactions.NODE_LATENCY)
+    #a store can write the whole EEPROM: more than 3.3s on a 1KB EEPROM
+    assert transactions.timeout(M.build_save_to_eeprom(5)) > 0.0033*1024
+    assert transactions.timeout(M.build_load_from_eeprom(5)) >= RR_duino_transactions.RR_duino_transactions.EEPROM_LATENCY
+
+def test_stats_recorded(transactions):
+    transactions.transact(M.build_version_cmd(5))
+    transactions.transact(M.build_version_cmd(6),policy=RR_duino_transactions.RR_duino_retry_policy(retries=0))
+    assert transactions.stats.by_address[5].transactions == 1
+    assert transactions.stats.by_address[6].timeouts == 1
+
+def test_continuations():
+    is_continuation = RR_duino_transactions.RR_duino_transactions.is_continuation
+    assert is_continuation(M.build_show_cmd(5))
+    assert is_continuation(M.build_show_cmd(5,on_turnout=True))
+    assert is_continuation(M.build_async_cmd(5))
+    #a show table is a single answer
+    assert not is_continuation(M.build_show_cmd(5,table=True))
+    assert not is_continuation(M.build_version_cmd(5))
+    assert not is_continuation(M.build_simple_rw_cmd(5,1))
+
+def test_continuation_timeout_not_retried(transactions):
+    #resending would make the node skip the lost part of the answer
+    result = transactions.transact(M.build_show_cmd(6))
+    assert result.error == RR_duino_transactions.RR_duino_transaction.TIMEOUT
+    assert result.tries == 1
+    result = transactions.transact(M.build_async_cmd(6))
+    assert result.tries == 1
+    policy = RR_duino_transactions.RR_duino_retry_policy(retry_continuations=True)
+    result = transactions.transact(M.build_show_cmd(6),policy=policy)
+    assert result.tries == 1+policy.retries
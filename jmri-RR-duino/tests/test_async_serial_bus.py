@@ -0,0 +1,141 @@
+import asyncio,os,tty
+import pytest
+import RR_duino_messages as RRduino
+import serial_bus
+
+M = RRduino.RR_duino_message
+
+@pytest.fixture
+def pty_pair():
+    #master is the device end, the bus opens the slave as its serial port
+    master,slave = os.openpty()
+    tty.setraw(slave)
+    os.set_blocking(master,False)
+    yield master,os.ttyname(slave)
+    os.close(master)
+    os.close(slave)
+
+def version_answer(address,version):
+    return bytes((M.START,0b10001000,address,version,0x80))
+
+def read_master(master,size,timeout=2):
+    #read size bytes written by the bus
+    async def reader():
+        loop = asyncio.get_running_loop()
+        data = bytearray()
+        done = loop.create_future()
+        def on_readable():
+            try:
+                data.extend(os.read(master,65536))
+            except BlockingIOError:
+                return
+            if len(data) >= size and not done.done():
+                done.set_result(None)
+        loop.add_reader(master,on_readable)
+        try:
+            await asyncio.wait_for(done,timeout)
+        finally:
+            loop.remove_reader(master)
+        return bytes(data)
+    return reader()
+
+def test_version_request_and_answer(pty_pair):
+    master,port = pty_pair
+    async def run():
+        bus = serial_bus.async_serial_bus(port,38400)
+        bus.start()
+        try:
+            cmd = M.build_version_cmd(5)
+            await bus.send(cmd.raw_message)
+            assert await read_master(master,len(cmd.raw_message)) == bytes(cmd.raw_message)
+            os.write(master,version_answer(5,3))
+            frame = await bus.recv_frame(1)
+            assert frame is not None and frame.is_answer_to_msg(cmd)
+            assert frame.get_version() == 3
+        finally:
+            bus.stop()
+    asyncio.run(run())
+
+def test_several_frames_in_one_chunk(pty_pair):
+    master,port = pty_pair
+    async def run():
+        bus = serial_bus.async_serial_bus(port,38400)
+        bus.start()
+        try:
+            os.write(master,b"".join(version_answer(address,1) for address in (1,2,3)))
+            addresses = []
+            for i in range(3):
+                frame = await bus.recv_frame(1)
+                addresses.append(frame.get_address())
+            assert addresses == [1,2,3]
+        finally:
+            bus.stop()
+    asyncio.run(run())
+
+def test_recv_frame_timeout(pty_pair):
+    master,port = pty_pair
+    async def run():
+        bus = serial_bus.async_serial_bus(port,38400)
+        bus.start()
+        try:
+            assert await bus.recv_frame(0.05) is None
+        finally:
+            bus.stop()
+    asyncio.run(run())
+
+def test_large_send_waits_for_the_port(pty_pair):
+    #more than the pty buffer: the end of the data goes out from the writer callback
+    master,port = pty_pair
+    data = bytes(range(256))*400
+    async def run():
+        bus = serial_bus.async_serial_bus(port,38400)
+        bus.start()
+        try:
+            received = asyncio.ensure_future(read_master(master,len(data),timeout=5))
+            await bus.send(data)
+            assert not bus.send_buffer
+            assert await received == data
+        finally:
+            bus.stop()
+    asyncio.run(run())
+
+def test_concurrent_receive_rejected(pty_pair):
+    master,port = pty_pair
+    async def run():
+        bus = serial_bus.async_serial_bus(port,38400)
+        bus.start()
+        try:
+            first = asyncio.ensure_future(bus.recv_frame(1))
+            await asyncio.sleep(0)
+            with pytest.raises(RuntimeError):
+                await bus.recv_frame(1)
+            #the first receive still gets its frame
+            os.write(master,version_answer(5,3))
+            frame = await first
+            assert frame.get_version() == 3
+        finally:
+            bus.stop()
+    asyncio.run(run())
+
+def test_hangup_wakes_up_the_waiters():
+    #the device end of the pty goes away: the port must be closed, not polled forever
+    master,slave = os.openpty()
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+    async def run():
+        bus = serial_bus.async_serial_bus(port,38400)
+        bus.start()
+        waiter = asyncio.ensure_future(bus.recv_frame(5))
+        await asyncio.sleep(0.01)
+        os.close(master)
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(waiter,2)
+        assert not bus.ser_port.is_open
+        with pytest.raises(ConnectionError):
+            await bus.recv_frame(1)
+        with pytest.raises(ConnectionError):
+            await bus.send(b"\xff\x89\x05")
+    try:
+        asyncio.run(run())
+    finally:
+        os.close(slave)
@@ -0,0 +1,296 @@
+import json,os,signal,socket,subprocess,sys,time,urllib.request
+import pytest
+import RR_duino_capture
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"jmri_to_rr_duino_busses.py")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1",0))
+        return s.getsockname()[1]
+
+def connect(port,timeout=5):
+    #connect, retrying while the server starts
+    deadline = time.monotonic()+timeout
+    while True:
+        try:
+            sock = socket.create_connection(("127.0.0.1",port))
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    return sock
+
+def read_lines(sock,count,timeout=5):
+    #the first count lines received on sock
+    sock.settimeout(timeout)
+    data = b""
+    while data.count(b"\r\n") < count:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data.split(b"\r\n")[:count]
+
+class server:
+    #jmri_to_rr_duino_busses.py running in a subprocess with the given config entries
+    def __init__(self,tmp_path,**entries):
+        self.jmri_port = free_port()
+        self.busses_port = free_port()
+        self.config = {"listening_ip":"127.0.0.1","jmri_port":self.jmri_port,"rrduino_busses_port":self.busses_port}
+        self.config.update(entries)
+        cfg_file = tmp_path / "server.cfg"
+        cfg_file.write_text(json.dumps(self.config))
+        self.process = subprocess.Popen([sys.executable,SERVER,str(cfg_file)],cwd=os.path.dirname(SERVER),
+                                        stdout=subprocess.DEVNULL,stderr=subprocess.PIPE)
+
+    def stop(self,sig=signal.SIGTERM):
+        if self.process.poll() is None:
+            self.process.send_signal(sig)
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        return self.process.returncode
+
+@pytest.fixture
+def start_server(tmp_path):
+    servers = []
+    def start(**entries):
+        servers.append(server(tmp_path,**entries))
+        return servers[-1]
+    yield start
+    for s in servers:
+        s.stop()
+
+def get(port,path):
+    with urllib.request.urlopen("http://127.0.0.1:%d%s" % (port,path),timeout=5) as answer:
+        return answer.read()
+
+def captured(filename,kind):
+    #data of the records of that kind in the capture file
+    return b"".join(data for t,k,channel,data in RR_duino_capture.read_capture(filename) if k == kind)
+
+def test_capture_of_idle_traffic_is_flushed(start_server,tmp_path):
+    capture_file = str(tmp_path / "traffic.cap")
+    s = start_server(capture_file=capture_file)
+    bus = connect(s.busses_port)
+    bus.sendall(b"RRDUINO-BUS 1\r\n")
+    #nothing else comes, the record must reach the file anyway
+    time.sleep(RR_duino_capture.capture_writer.FLUSH_PERIOD*2)
+    assert b"RRDUINO-BUS 1" in captured(capture_file,RR_duino_capture.RX)
+    bus.close()
+
+def test_sigterm_closes_the_capture(start_server,tmp_path):
+    capture_file = str(tmp_path / "traffic.cap")
+    s = start_server(capture_file=capture_file)
+    bus = connect(s.busses_port)
+    jmri = connect(s.jmri_port)
+    bus.sendall(b"RRDUINO-BUS 1\r\nNEW-NODE:5,01,00,01,00,00\r\n")
+    read_lines(jmri,1)
+    assert s.stop() == 0
+    assert b"NEW-NODE:5" in captured(capture_file,RR_duino_capture.RX)
+    bus.close()
+    jmri.close()
+
+def read_until(sock,marker,timeout=5):
+    #what is received on sock up to the end of the line holding marker
+    sock.settimeout(timeout)
+    data = b""
+    while marker not in data or not data.endswith(b"\r\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def hex_bits(subaddresses):
+    #NEW-NODE field: bit subaddress-1 set for each subaddress, 7 bits per byte, in hex
+    mask = 0
+    for subadd in subaddresses:
+        mask |= 1 << (subadd-1)
+    return " ".join("%02X" % ((mask >> (7*i)) & 0x7F) for i in range((mask.bit_length()+6)//7))
+
+def test_snapshot_bigger_than_the_lag_allowance(start_server):
+    s = start_server()
+    jmri = connect(s.jmri_port)
+    #10 busses of 62 nodes with 49 sensors and 49 turnouts: the snapshot is well over 1MB
+    sensors = hex_bits(range(1,50))
+    turnouts = hex_bits(range(1,50))
+    busses = []
+    for nb in range(1,11):
+        bus = connect(s.busses_port)
+        bus.sendall(b"RRDUINO-BUS %d\r\n" % nb)
+        bus.sendall("".join("NEW-NODE:%d,%s,00,%s,00,00\r\n" % (node,sensors,turnouts) for node in range(1,63)).encode())
+        busses.append(bus)
+    #the first client gets the declarations and the states as they come
+    lines = read_lines(jmri,10*62*(1+98),timeout=30)
+    assert len(lines) == 10*62*(1+98)
+    size = sum(len(line)+2 for line in lines)
+    assert size > 1 << 20
+    #a new client gets all of it at once and must not be closed as too slow
+    late = connect(s.jmri_port)
+    assert len(read_lines(late,len(lines),timeout=30)) == len(lines)
+    assert s.process.poll() is None
+    for sock in busses+[jmri,late]:
+        sock.close()
+
+def test_metrics_with_capture(start_server,tmp_path):
+    #the metrics connections have no capture channel
+    capture_file = str(tmp_path / "traffic.cap")
+    metrics_port = free_port()
+    s = start_server(capture_file=capture_file,metrics_port=metrics_port)
+    bus = connect(s.busses_port)
+    jmri = connect(s.jmri_port)
+    bus.sendall(b"RRDUINO-BUS 1\r\nNEW-NODE:5,01,00,01,00,00\r\n")
+    read_lines(jmri,3)
+    for i in range(5):
+        assert b"rrduino_loop_passes_total" in get(metrics_port,"/metrics")
+        assert "loop" in json.loads(get(metrics_port,"/json"))
+    assert s.process.poll() is None
+    assert s.stop() == 0
+    kinds = {kind for t,kind,channel,data in RR_duino_capture.read_capture(capture_file)}
+    assert kinds == {RR_duino_capture.SESSION,RR_duino_capture.OPEN,RR_duino_capture.RX,RR_duino_capture.TX}
+    bus.close()
+    jmri.close()
+
+def test_workers_with_capture(start_server,tmp_path):
+    #the links to the workers have no capture channel, the capture only has the jmri side
+    capture_file = str(tmp_path / "traffic.cap")
+    metrics_port = free_port()
+    s = start_server(capture_file=capture_file,metrics_port=metrics_port,workers=2)
+    jmri = connect(s.jmri_port)
+    #the connections go to the workers in turn: the second one of bus 1 is in the other worker
+    for connection in range(2):
+        bus = connect(s.busses_port)
+        bus.sendall(b"RRDUINO-BUS 1\r\nNEW-NODE:5,01,00,01,00,00\r\n"+b"ISRS5:1,1\r\nISRS5:1,0\r\n"*5)
+        #the last state tells jmri that the bus is registered
+        assert b"ISRS1:5:1,0" in read_until(jmri,b"ISRS1:5:1,0")
+        jmri.sendall(b"ITRT1:5:1,1\r\n")
+        assert b"ITRT5:1,1\r\n" in read_until(bus,b"ITRT5:1,1")
+        bus.close()
+        time.sleep(0.2)
+    #the counts of both connections add up in the front
+    time.sleep(2.5)
+    bus_metrics = json.loads(get(metrics_port,"/json"))["busses"]["1"]
+    assert bus_metrics["connections"] == 2
+    assert bus_metrics["lines_in"] == 2*12
+    assert bus_metrics["lines_out"] >= 2
+    assert s.process.poll() is None
+    assert s.stop() == 0
+    assert b"ISRS1:5:1,0" in captured(capture_file,RR_duino_capture.TX)
+    assert captured(capture_file,RR_duino_capture.RX).count(b"ITRT1:5:1,1") == 2
+    jmri.close()
+
+def parse_exposition(text):
+    #metric name -> (type,samples) checking the grouping rules of the Prometheus text format
+    families = {}
+    current = None
+    help_seen = None
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            help_seen = line.split()[2]
+            assert help_seen not in families,"metric declared twice: "+help_seen
+        elif line.startswith("# TYPE "):
+            name,kind = line.split()[2:4]
+            assert name == help_seen,"TYPE without HELP: "+name
+            families[name] = (kind,[])
+            current = name
+        else:
+            sample = line.split("{")[0].split()[0]
+            allowed = {current}
+            if families[current][0] == "summary":
+                allowed |= {current+"_sum",current+"_count"}
+            assert sample in allowed,"sample %s outside of its group %s" % (sample,current)
+            families[current][1].append(line)
+    return families
+
+def test_prometheus_exposition(start_server):
+    metrics_port = free_port()
+    s = start_server(metrics_port=metrics_port)
+    jmri = connect(s.jmri_port)
+    busses = []
+    for nb in (1,2):
+        bus = connect(s.busses_port)
+        bus.sendall(b"RRDUINO-BUS %d\r\nNEW-NODE:5,01,00,01,00,00\r\n" % nb)
+        busses.append(bus)
+    read_until(jmri,b"ISRS2:5:1")
+    families = parse_exposition(get(metrics_port,"/metrics").decode())
+    kind,samples = families["rrduino_loop_pass_seconds"]
+    assert kind == "summary"
+    assert any(sample.startswith("rrduino_loop_pass_seconds_sum ") for sample in samples)
+    assert any(sample.startswith("rrduino_loop_pass_seconds_count ") for sample in samples)
+    kind,samples = families["rrduino_bus_lines_total"]
+    assert kind == "counter"
+    #both busses, both directions, in one group
+    assert len(samples) == 4
+    assert families["rrduino_jmri_clients"] == ("gauge",["rrduino_jmri_clients 1.0"])
+    for sock in busses+[jmri]:
+        sock.close()
+
+def worker_pids(s):
+    with open("/proc/%d/task/%d/children" % (s.process.pid,s.process.pid)) as children:
+        return [int(pid) for pid in children.read().split()]
+
+def routed(s,jmri,bus_nb,value=1):
+    #a bus connection that registers (jmri only gets the states that change) and gets a command from jmri
+    bus = connect(s.busses_port)
+    state = b"ISRS%d:5:1,%d" % (bus_nb,value)
+    bus.sendall(b"RRDUINO-BUS %d\r\nNEW-NODE:5,01,00,01,00,00\r\nISRS5:1,%d\r\n" % (bus_nb,value))
+    assert state in read_until(jmri,state)
+    jmri.sendall(b"ITRT%d:5:1,1\r\n" % bus_nb)
+    assert b"ITRT5:1,1\r\n" in read_until(bus,b"ITRT5:1,1")
+    return bus
+
+def test_connections_survive_a_stopped_worker(start_server):
+    s = start_server(workers=2)
+    jmri = connect(s.jmri_port)
+    busses = [routed(s,jmri,1)]
+    pids = worker_pids(s)
+    assert len(pids) == 2
+    def kill(pid):
+        #a connection handed over to a worker that is still dying is lost, the test waits for its end
+        os.kill(pid,signal.SIGKILL)
+        deadline = time.monotonic()+5
+        while time.monotonic() < deadline:
+            with open("/proc/%d/stat" % pid) as stat:
+                if stat.read().rpartition(")")[2].split()[0] == "Z":
+                    return
+            time.sleep(0.01)
+    #the connections go to the remaining worker
+    kill(pids[0])
+    busses += [routed(s,jmri,nb) for nb in (2,3)]
+    #then to the front process itself
+    kill(pids[1])
+    busses += [routed(s,jmri,1,0),routed(s,jmri,4)]
+    assert s.process.poll() is None
+    assert s.stop() == 0
+    for bus in busses:
+        bus.close()
+    jmri.close()
+
+def test_connections_skip_a_worker_not_reading(start_server):
+    s = start_server(workers=2)
+    jmri = connect(s.jmri_port)
+    busses = [routed(s,jmri,1)]
+    pids = worker_pids(s)
+    #the connections handed over to a suspended worker wait in its link until the send buffer
+    #is full (a few tens of them, see FD_LINK_SNDBUF), then the front process must not block
+    #but give them to the other worker
+    os.kill(pids[0],signal.SIGSTOP)
+    try:
+        for connection in range(100):
+            busses.append(socket.create_connection(("127.0.0.1",s.busses_port),timeout=5))
+            #within the listen backlog of the server
+            time.sleep(0.01)
+        busses += [routed(s,jmri,nb) for nb in (2,3)]
+    finally:
+        os.kill(pids[0],signal.SIGCONT)
+    assert s.process.poll() is None
+    assert s.stop() == 0
+    for bus in busses:
+        bus.close()
+    jmri.close()